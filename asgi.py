@@ -0,0 +1,30 @@
+# ASGI entry point of the asyncio scan API (see async_scans.py)
+#
+# Serves /charge, /stage1 .. /stage6 and /order/<barcode_number> next to the
+# Flask app, with the same settings: index is imported for its config, its
+# indexes and its token and label caches, and the scans are served on a
+# pymongo.AsyncMongoClient with the MONGO_* pool settings. Run it with any
+# ASGI server, e.g. on its own port behind the load balancer that sends the
+# scan routes there and everything else to serve.py:
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 5001 --workers 4
+#
+# One event loop holds thousands of scanner connections; raise
+# MONGO_MAX_POOL_SIZE rather than the worker count to get more scans in flight.
+
+from pymongo import AsyncMongoClient
+
+from async_scans import AsyncScanApp
+from index import app, label_cache, token_cache
+
+client = AsyncMongoClient(
+    app.config['MONGO_URI'],
+    maxPoolSize=app.config['MONGO_MAX_POOL_SIZE'],
+    minPoolSize=app.config['MONGO_MIN_POOL_SIZE'],
+    connectTimeoutMS=app.config['MONGO_CONNECT_TIMEOUT_MS'],
+    serverSelectionTimeoutMS=app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+    socketTimeoutMS=app.config['MONGO_SOCKET_TIMEOUT_MS'],
+    waitQueueTimeoutMS=app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS']
+)
+
+application = AsyncScanApp(client.get_default_database(), app.config, token_cache, label_cache, on_shutdown=client.close)
@@ -0,0 +1,234 @@
+# Asyncio scan API
+#
+# A scan is a token check, one or two indexed reads and one write: the Flask
+# routes spend nearly all of it holding a thread while waiting on MongoDB.
+# AsyncScanApp serves the same scan routes as a plain ASGI application on
+# pymongo's AsyncMongoClient, so one event loop keeps thousands of scanner
+# connections open on a single thread:
+#
+#   POST /charge, /stage1 .. /stage6    {"barcode_number": ...}, Authorization: <token>
+#   GET  /order/<barcode_number>
+#
+# A scan follows the same steps as the Flask route, stages.scan_steps, and the
+# records are written in the storage the Flask app is configured with
+# (app.config), so both can serve scans of the same database side by side and
+# answer alike. Session tokens and barcode labels go through the same
+# TokenCache and LabelCache classes as the Flask app; the shared SQLite tier of
+# the label cache is used from a thread, never on the event loop.
+#
+# The live WIP board of the Flask processes sees the scans written here through
+# its change stream (WIP_CHANGE_STREAM) or its polling (WIP_POLL_SECONDS), and
+# these requests are not counted in /metrics. See asgi.py to run it.
+
+import json
+from datetime import datetime
+
+import jwt
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+import barcode_codec
+import barcode_progress
+import order_progress
+from stages import STAGES, get_stage, scan_steps
+
+# Largest request body accepted, a scan is a few dozen bytes
+MAX_BODY_SIZE = 64 * 1024
+
+
+class AsyncScanApp:
+    #   db: database of a pymongo.AsyncMongoClient
+    #   config: the Flask app's config (storage, lookups and counters settings)
+    #   wip_board: a wip_board.WipBoard of this process to report the transitions to, if any
+    #   on_shutdown: coroutine function awaited when the server stops, e.g. to close the client
+    def __init__(self, db, config, token_cache, label_cache, wip_board=None, on_shutdown=None):
+        self.config = config
+        self.wip_board = wip_board
+        self.token_cache = token_cache
+        self.label_cache = label_cache
+        self.on_shutdown = on_shutdown
+        self.event_collections = [db[stage.collection] for stage in STAGES]
+        self.barcode_images_collection = db.barcode_images
+        self.barcode_progress_collection = db.barcode_progress
+        self.order_progress_collection = db.order_progress
+
+    # Latest recorded event of a barcode for a stage (None if not reached)
+    async def load_stage_event(self, barcode_number, stage):
+        if self.config['BARCODE_PROGRESS_STORAGE']:
+            progress = await self.barcode_progress_collection.find_one({'_id': barcode_number})
+            return barcode_progress.stage_event(progress, stage)
+        return await self.event_collections[stage].find_one(
+            {'barcode_number': barcode_number}, sort=[('created_at', pymongo.DESCENDING)]
+        )
+
+    # Record a stage event, returns False if the barcode already has it
+    async def save_stage_event(self, stage, document):
+        if self.config['BARCODE_PROGRESS_STORAGE']:
+            return await barcode_progress.push_event_async(self.barcode_progress_collection, stage, document)
+        try:
+            await self.event_collections[stage].insert_one(document)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    # Read the labels of barcodes from barcode_images, see index.find_labels
+    async def find_labels(self, barcode_numbers):
+        labels = {}
+        for barcode_number in barcode_numbers:
+            barcode_key = barcode_codec.pack(barcode_number) if self.config['BARCODE_KEY_LOOKUPS'] else None
+            query = {'barcode_key': barcode_key} if barcode_key is not None else {'barcode_number': barcode_number}
+            label = await self.barcode_images_collection.find_one(query, {'_id': 0, 'order_number': 1, 'shoe_size': 1})
+            if label:
+                labels[barcode_number] = label
+        return labels
+
+    # Resolve a scanned barcode to its order_number and shoe_size (None if unknown)
+    async def resolve_barcode(self, barcode_number):
+        try:
+            fields = barcode_codec.decode(barcode_number)
+        except ValueError:
+            fields = None
+        if fields and fields.checked:
+            return {'order_number': fields.order_number, 'shoe_size': fields.shoe_size}
+
+        labels = await self.label_cache.get_many_async([barcode_number], self.find_labels)
+        return labels.get(barcode_number)
+
+    # Count a new stage record in the order progress counters, see index.count_stage_records
+    async def count_stage_record(self, stage, document):
+        if not self.config['ORDER_PROGRESS_COUNTERS']:
+            return
+        shoe_size = document.get('shoe_size') or document.get('shoe_Size')
+        if not shoe_size:
+            try:
+                shoe_size = barcode_codec.decode(document['barcode_number']).shoe_size
+            except ValueError:
+                label = await self.resolve_barcode(document['barcode_number'])
+                shoe_size = label['shoe_size'] if label else None
+        if shoe_size is not None:
+            await self.order_progress_collection.update_one(
+                {'_id': document['order_number']}, order_progress.increment_update(shoe_size, stage), upsert=True
+            )
+
+    # Same steps as index.scan_stage (stages.scan_steps), on the asyncio collections
+    async def scan_stage(self, stage, username, data):
+        barcode_number = data.get('barcode_number')
+        unique_records = self.config['BARCODE_PROGRESS_STORAGE'] or self.config['UNIQUE_STAGE_RECORDS']
+        steps = scan_steps(stage, barcode_number, username, datetime.utcnow(), unique_records)
+        result = None
+        try:
+            while True:
+                operation = steps.send(result)
+                if operation[0] == 'load':
+                    result = await self.load_stage_event(barcode_number, operation[1])
+                elif operation[0] == 'resolve':
+                    result = await self.resolve_barcode(barcode_number)
+                elif operation[0] == 'save':
+                    result = await self.save_stage_event(stage.number, operation[1])
+                else:
+                    document = operation[1]
+                    await self.count_stage_record(stage.number, document)
+                    if self.wip_board:
+                        self.wip_board.advance(document['order_number'], barcode_number, stage.number)
+                    result = None
+        except StopIteration as done:
+            body, status = done.value
+        return status, body
+
+    # Username of the request's session token, or the (status, body) refusing it, as index.token_required
+    def verify_token(self, headers):
+        user_token = headers.get(b'authorization')
+        if not user_token:
+            return None, (401, {'message': 'User token is required!'})
+        try:
+            return self.token_cache.verify(user_token.decode('latin-1'))['username'], None
+        except jwt.ExpiredSignatureError:
+            return None, (401, {'message': 'Token has expired!'})
+        except (jwt.InvalidTokenError, KeyError):
+            return None, (401, {'message': 'Invalid token!'})
+
+    async def read_json(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None, None
+            body += message.get('body', b'')
+            if len(body) > MAX_BODY_SIZE:
+                return None, (413, {'message': 'Request body is too large!'})
+            if not message.get('more_body'):
+                break
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None, (400, {'message': 'Request body must be JSON!'})
+        if not isinstance(data, dict):
+            return None, (400, {'message': 'Request body must be a JSON object!'})
+        return data, None
+
+    # (status, body) of a request
+    async def handle(self, method, path, headers, receive):
+        parts = path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'order':
+            if method != 'GET':
+                return 405, {'message': 'Method not allowed!'}
+            label = await self.resolve_barcode(parts[1])
+            if not label:
+                return 404, {'message': 'Order not found for the given barcode number!'}
+            return 200, {'order_number': label['order_number']}
+
+        stage = get_stage(parts[0]) if len(parts) == 1 else None
+        if stage is None:
+            return 404, {'message': 'Not found!'}
+        if method != 'POST':
+            return 405, {'message': 'Method not allowed!'}
+
+        username, refusal = self.verify_token(headers)
+        if refusal:
+            return refusal
+        data, refusal = await self.read_json(receive)
+        if refusal or data is None:
+            return refusal
+        return await self.scan_stage(stage, username, data)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.on_shutdown:
+                    await self.on_shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        headers = dict(scope['headers'])
+        # Any origin may call the API, as with the Flask app's CORS settings
+        cors_headers = [(b'access-control-allow-origin', b'*')]
+        if scope['method'] == 'OPTIONS':
+            cors_headers += [
+                (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+                (b'access-control-allow-headers', headers.get(b'access-control-request-headers', b'*')),
+            ]
+            await send({'type': 'http.response.start', 'status': 200, 'headers': cors_headers + [(b'content-length', b'0')]})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        response = await self.handle(scope['method'], scope['path'], headers, receive)
+        if response is None:
+            # The client went away before sending its body
+            return
+        status, body = response
+        payload = (json.dumps(body, separators=(',', ':'), sort_keys=True) + '\n').encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': cors_headers + [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode())]
+        })
+        await send({'type': 'http.response.body', 'body': payload})
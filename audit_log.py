@@ -0,0 +1,131 @@
+# Buffered audit writes
+#
+# Login activity is an audit trail nobody reads on the request path, so the
+# login route should not wait for it to be written. Events are appended to an
+# in-memory buffer and a background thread writes them with one insert_many
+# per batch, as soon as max_batch events are waiting or every flush_interval
+# seconds. The buffer is flushed once more when the process exits.
+#
+# The buffer is bounded: if the database is unreachable for long, the oldest
+# pending events are dropped rather than growing the process without limit.
+# At exit the flush is retried a few times, and the count of events that still
+# could not be written is logged. Events added after close are written directly.
+
+import atexit
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+
+class AuditBuffer:
+    def __init__(self, collection, max_batch=500, flush_interval=1.0, max_pending=50000,
+                 close_retries=3, close_retry_delay=1.0):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.close_retries = close_retries
+        self.close_retry_delay = close_retry_delay
+        self._pending = deque(maxlen=max_pending)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self.written = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    # Start the flush thread on first use, so it is created in the serving process
+    def start(self):
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._work, name='audit-flush', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def add(self, document):
+        self.start()
+        with self._lock:
+            # Once closed nothing flushes the buffer any more, the event is written directly
+            closed = self._stopping
+            if not closed:
+                if len(self._pending) == self._pending.maxlen:
+                    self.dropped += 1
+                self._pending.append(document)
+                full = len(self._pending) >= self.max_batch
+        if closed:
+            self._write_now(document)
+        elif full:
+            self._wakeup.set()
+
+    # Write everything pending, max_batch documents per insert_many
+    def flush(self):
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+                if not batch:
+                    return
+                try:
+                    self.collection.insert_many(batch, ordered=False)
+                except Exception:
+                    traceback.print_exc()
+                    self.failed_flushes += 1
+                    # Keep the batch for the next flush, ahead of newer events, dropping its oldest if full
+                    with self._lock:
+                        kept = batch[max(0, len(batch) - (self._pending.maxlen - len(self._pending))):]
+                        self.dropped += len(batch) - len(kept)
+                        self._pending.extendleft(reversed(kept))
+                    return
+                self.written += len(batch)
+
+    def _write_now(self, document):
+        try:
+            self.collection.insert_one(document)
+        except Exception:
+            traceback.print_exc()
+            with self._lock:
+                self.dropped += 1
+            return
+        with self._lock:
+            self.written += 1
+
+    # Stop the flush thread after writing what is still pending, retrying close_retries times
+    # close_retry_delay seconds apart; what still cannot be written is discarded and counted
+    def close(self):
+        with self._lock:
+            thread = self._thread
+            self._stopping = True
+        self._wakeup.set()
+        if thread and thread is not threading.current_thread():
+            thread.join(timeout=10)
+        for attempt in range(self.close_retries + 1):
+            if attempt:
+                time.sleep(self.close_retry_delay)
+            self.flush()
+            with self._lock:
+                if not self._pending:
+                    return
+        with self._lock:
+            discarded = len(self._pending)
+            self._pending.clear()
+            self.dropped += discarded
+        print(f'Audit buffer closed: {discarded} events could not be written and were discarded', file=sys.stderr)
+
+    def _work(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed_flushes': self.failed_flushes
+            }
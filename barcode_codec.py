@@ -0,0 +1,88 @@
+# Barcode codec
+#
+# A barcode number is positional: 10 characters of zero-padded order number,
+# 3 digits of shoe size x 10 and a 3 digit serial number (see
+# label_generation.generate_barcode). New barcodes can carry a 17th GS1
+# mod-10 check digit; those are trusted to be decoded locally, without
+# looking the barcode up in barcode_images. Legacy 16 character barcodes
+# decode the same way but have nothing to validate them.
+#
+# Numeric barcodes also pack into a 64-bit integer key for smaller indexes.
+# Bit 62 marks the 17 digit (check digit) form so the two lengths never collide.
+
+from collections import namedtuple
+
+BarcodeFields = namedtuple('BarcodeFields', ['order_number', 'shoe_size', 'serial_number', 'checked'])
+
+PAYLOAD_LENGTH = 16
+CHECKED_LENGTH = PAYLOAD_LENGTH + 1
+CHECKED_FLAG = 1 << 62
+
+
+# GS1 mod-10 check digit of a string of digits
+def check_digit(payload):
+    if not payload.isdigit():
+        raise ValueError(f'Check digits need a numeric barcode, got {payload!r}')
+    total = sum(int(digit) * (3 if index % 2 == 0 else 1) for index, digit in enumerate(reversed(payload)))
+    return str((10 - total % 10) % 10)
+
+
+# Append the check digit to a 16 character barcode number
+def add_check_digit(barcode_number):
+    return barcode_number + check_digit(barcode_number)
+
+
+# Shoe size as written in orders from its 3 digit code: '080' -> '8', '105' -> '10.5'
+def format_shoe_size(size_code):
+    tenths = int(size_code)
+    if tenths % 10 == 0:
+        return str(tenths // 10)
+    return f'{tenths // 10}.{tenths % 10}'
+
+
+# Canonical form of a shoe size, so '8', '8.0' and '08' compare equal
+def canonical_shoe_size(shoe_size):
+    try:
+        return format_shoe_size(str(int(float(shoe_size) * 10)))
+    except (TypeError, ValueError):
+        return shoe_size
+
+
+# Split a barcode number into its fields, raises ValueError if it is malformed or its check digit is wrong
+def decode(barcode_number):
+    if not isinstance(barcode_number, str):
+        raise ValueError(f'Barcode {barcode_number!r} is not a string')
+    if len(barcode_number) == CHECKED_LENGTH:
+        payload = barcode_number[:PAYLOAD_LENGTH]
+        if not barcode_number.isdigit() or check_digit(payload) != barcode_number[-1]:
+            raise ValueError(f'Invalid check digit in barcode {barcode_number!r}')
+        checked = True
+    elif len(barcode_number) == PAYLOAD_LENGTH:
+        payload = barcode_number
+        checked = False
+    else:
+        raise ValueError(f'Barcode {barcode_number!r} is not {PAYLOAD_LENGTH} or {CHECKED_LENGTH} characters long')
+
+    size_code = payload[10:13]
+    serial_code = payload[13:16]
+    if not size_code.isdigit() or not serial_code.isdigit():
+        raise ValueError(f'Malformed barcode {barcode_number!r}')
+
+    return BarcodeFields(payload[:10], format_shoe_size(size_code), int(serial_code), checked)
+
+
+# Packed 64-bit key of a barcode number, None for barcodes that are not numeric
+def pack(barcode_number):
+    if not isinstance(barcode_number, str) or not barcode_number.isdigit() or len(barcode_number) not in (PAYLOAD_LENGTH, CHECKED_LENGTH):
+        return None
+    key = int(barcode_number)
+    if len(barcode_number) == CHECKED_LENGTH:
+        key |= CHECKED_FLAG
+    return key
+
+
+# Barcode number of a packed key
+def unpack(key):
+    if key & CHECKED_FLAG:
+        return str(key ^ CHECKED_FLAG).zfill(CHECKED_LENGTH)
+    return str(key).zfill(PAYLOAD_LENGTH)
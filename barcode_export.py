@@ -0,0 +1,88 @@
+# Streaming export of an order's barcodes
+#
+# /view/<orderNumber> sends every barcode of an order. Rather than building
+# the whole list (and then its JSON) in memory, rows are serialised straight
+# from the cursor and sent in chunks of about CHUNK_SIZE bytes, so a request
+# holds one cursor batch and one chunk whatever the size of the order. The
+# rows can be sent as a JSON array, as NDJSON (one object per line, usable
+# before the last line arrives) or as CSV for the label printer software, and
+# gzip-compressed on the fly.
+
+import csv
+import io
+import json
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+FIELDS = ['barcode_number', 'shoe_size']
+
+# format -> mimetype
+FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+# Export format from ?format=, else from the Accept header, else json; None if unknown
+def negotiate_format(requested, accept_mimetypes):
+    if requested:
+        return requested if requested in FORMATS else None
+    best = accept_mimetypes.best_match(list(FORMATS.values()) + ['*/*'])
+    for export_format, mimetype in FORMATS.items():
+        if mimetype == best:
+            return export_format
+    return 'json'
+
+
+def _json_array(documents):
+    yield '['
+    for index, document in enumerate(documents):
+        yield (',' if index else '') + json.dumps(document, separators=(',', ':'), sort_keys=True)
+    yield ']\n'
+
+
+def _ndjson(documents):
+    for document in documents:
+        yield json.dumps(document, separators=(',', ':'), sort_keys=True) + '\n'
+
+
+def _csv(documents):
+    line = io.StringIO()
+    writer = csv.writer(line)
+    writer.writerow(FIELDS)
+    for document in documents:
+        writer.writerow([document.get(field, '') for field in FIELDS])
+        yield line.getvalue()
+        line.seek(0)
+        line.truncate()
+    # The header alone, for an empty export
+    if line.getvalue():
+        yield line.getvalue()
+
+
+# Serialise documents in the given format, yielding chunks of about chunk_size bytes
+def export_chunks(documents, export_format, chunk_size=CHUNK_SIZE):
+    rows = {'json': _json_array, 'ndjson': _ndjson, 'csv': _csv}[export_format](documents)
+    buffer = []
+    size = 0
+    for row in rows:
+        data = row.encode()
+        buffer.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+# gzip a stream of chunks as it goes
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
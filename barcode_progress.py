@@ -0,0 +1,219 @@
+# Unified per-barcode progress storage
+#
+# Opt-in alternative to the charges/stage1..stage6 collections: every pair has
+# one barcode_progress document keyed by its barcode number, holding the
+# ordered list of its stage events. The charge is stage 0, followed by
+# stage 1..6. A transition is one read of that document plus one conditional
+# $push, and the order report is one scan of this collection.
+#
+#   {
+#       '_id': '0000012345080001',       # barcode number
+#       'barcode_number': '0000012345080001',
+#       'order_number': '0000012345',
+#       'shoe_size': '8',
+#       'current_stage': 2,
+#       'stages': [{'stage': 0, 'username': ..., 'start_time': ..., ...}, ...],
+#       'updated_at': ...
+#   }
+
+import uuid
+from datetime import datetime
+
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from stages import STAGES
+
+CHARGE_STAGE = 0
+LAST_STAGE = len(STAGES) - 1
+
+
+# Return the recorded event for a stage from a progress document (None if not reached)
+def stage_event(progress, stage):
+    if not progress:
+        return None
+    for event in progress['stages']:
+        if event['stage'] == stage:
+            return event
+    return None
+
+
+def _event(stage, event):
+    event = dict(event, stage=stage)
+    event.pop('_id', None)
+    return event
+
+
+# New progress document starting with the charge event
+def _new_document(events, now):
+    charge = events[0]
+    return {
+        '_id': charge['barcode_number'],
+        'barcode_number': charge['barcode_number'],
+        'order_number': charge['order_number'],
+        'shoe_size': charge['shoe_size'],
+        'current_stage': events[-1]['stage'],
+        'stages': events,
+        'updated_at': now
+    }
+
+
+# Append a stage event to a barcode's progress document
+# Returns False if the barcode already passed this stage (or never reached the previous one)
+def push_event(collection, stage, event):
+    event = _event(stage, event)
+    now = datetime.utcnow()
+
+    if stage == CHARGE_STAGE:
+        try:
+            collection.insert_one(_new_document([event], now))
+        except DuplicateKeyError:
+            return False
+        return True
+
+    # Only move forward from the previous stage, so concurrent scans cannot record a stage twice
+    result = collection.update_one(
+        {'_id': event['barcode_number'], 'current_stage': stage - 1},
+        {'$push': {'stages': event}, '$set': {'current_stage': stage, 'updated_at': now}}
+    )
+    return result.modified_count == 1
+
+
+# push_event on an asyncio collection (pymongo.AsyncMongoClient)
+async def push_event_async(collection, stage, event):
+    event = _event(stage, event)
+    now = datetime.utcnow()
+
+    if stage == CHARGE_STAGE:
+        try:
+            await collection.insert_one(_new_document([event], now))
+        except DuplicateKeyError:
+            return False
+        return True
+
+    result = await collection.update_one(
+        {'_id': event['barcode_number'], 'current_stage': stage - 1},
+        {'$push': {'stages': event}, '$set': {'current_stage': stage, 'updated_at': now}}
+    )
+    return result.modified_count == 1
+
+
+# Load the recorded events of many barcodes: {(barcode_number, stage): event}
+def load_events(collection, barcode_numbers):
+    events = {}
+    for progress in collection.find({'_id': {'$in': barcode_numbers}}, {'stages': 1}):
+        for event in progress['stages']:
+            events[(progress['_id'], event['stage'])] = event
+    return events
+
+
+# Append the events of many barcodes with one bulk write
+#   events: [(key, stage, event)] in order, each barcode's events following each other stage by stage
+# Returns the keys of the events that could not be written because another scan got there first
+def push_events_bulk(collection, events):
+    now = datetime.utcnow()
+    # Tags the documents written by this call, to tell which conditional updates matched
+    write_id = uuid.uuid4().hex
+
+    by_barcode = {}
+    for key, stage, event in events:
+        by_barcode.setdefault(event['barcode_number'], []).append((key, _event(stage, event)))
+
+    operations = []
+    operation_keys = []
+    updated = set()
+    for barcode_number, barcode_events in by_barcode.items():
+        stage_events = [event for _, event in barcode_events]
+        first_stage = stage_events[0]['stage']
+        if first_stage == CHARGE_STAGE:
+            operations.append(InsertOne(dict(_new_document(stage_events, now), write_id=write_id)))
+        else:
+            operations.append(UpdateOne(
+                {'_id': barcode_number, 'current_stage': first_stage - 1},
+                {'$push': {'stages': {'$each': stage_events}},
+                 '$set': {'current_stage': stage_events[-1]['stage'], 'updated_at': now, 'write_id': write_id}}
+            ))
+            updated.add(barcode_number)
+        operation_keys.append([key for key, _ in barcode_events])
+
+    failed = set()
+    try:
+        result = collection.bulk_write(operations, ordered=False)
+        matched = result.matched_count
+    except BulkWriteError as e:
+        for error in e.details['writeErrors']:
+            failed.update(operation_keys[error['index']])
+        matched = e.details['nMatched']
+
+    # Some conditional updates found the barcode moved on, find out which
+    if matched < len(updated):
+        written = {doc['_id'] for doc in collection.find({'_id': {'$in': list(updated)}, 'write_id': write_id}, {'_id': 1})}
+        for barcode_number, keys in zip(by_barcode, operation_keys):
+            if barcode_number in updated and barcode_number not in written:
+                failed.update(keys)
+
+    return failed
+
+
+# Build the report_engine inputs for an order with a single scan of the progress collection
+def report_inputs(collection, order_number):
+    charge_entries = []
+    stage_sets = [set() for _ in range(LAST_STAGE)]
+
+    cursor = collection.find(
+        {'order_number': order_number},
+        {'_id': 0, 'barcode_number': 1, 'shoe_size': 1, 'current_stage': 1}
+    )
+    for doc in cursor:
+        charge_entries.append((doc['barcode_number'], doc['shoe_size']))
+        for stage in range(1, doc['current_stage'] + 1):
+            stage_sets[stage - 1].add(doc['barcode_number'])
+
+    return charge_entries, stage_sets
+
+
+# Rebuild the progress documents of one order from the charges and stage collections
+def build_order_documents(order_number, charges_collection, stage_collections):
+    documents = {}
+    for charge in charges_collection.find({'order_number': order_number}).sort('created_at', 1):
+        barcode_number = charge['barcode_number']
+        if barcode_number in documents:
+            continue
+        charge.pop('_id', None)
+        documents[barcode_number] = {
+            '_id': barcode_number,
+            'barcode_number': barcode_number,
+            'order_number': order_number,
+            'shoe_size': charge['shoe_size'],
+            'current_stage': CHARGE_STAGE,
+            'stages': [dict(charge, stage=CHARGE_STAGE)],
+            'updated_at': charge['created_at']
+        }
+
+    for stage, collection in enumerate(stage_collections, start=1):
+        for event in collection.find({'order_number': order_number}).sort('created_at', 1):
+            document = documents.get(event['barcode_number'])
+            # Skip events whose previous stage is missing or that were recorded twice
+            if not document or document['current_stage'] != stage - 1:
+                continue
+            event.pop('_id', None)
+            document['stages'].append(dict(event, stage=stage))
+            document['current_stage'] = stage
+            document['updated_at'] = event['created_at']
+
+    return list(documents.values())
+
+
+# Backfill the progress collection from the existing collections, one order at a time
+def backfill(progress_collection, charges_collection, stage_collections, batch_size=1000):
+    migrated = 0
+    for order_number in charges_collection.distinct('order_number'):
+        documents = build_order_documents(order_number, charges_collection, stage_collections)
+        for start in range(0, len(documents), batch_size):
+            batch = documents[start:start + batch_size]
+            progress_collection.bulk_write(
+                [ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in batch],
+                ordered=False
+            )
+            migrated += len(batch)
+    return migrated
@@ -0,0 +1,95 @@
+# Benchmark of password verification during a login burst
+#
+# Simulates a shift start: --clients threads log in as fast as they can while
+# one thread keeps scanning (a token check plus a small JSON body, the CPU
+# work of a scan request without the database). Logins are verified either
+# inline on the client threads, as the routes used to, or through
+# password_hashing.PasswordHasher with --workers threads. Reports the login
+# throughput and the scan latency under each mode. No database is involved.
+#
+#   python benchmarks/login_throughput.py --clients 32 --seconds 10 --method scrypt
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import jwt
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from password_hashing import PasswordHasher, PasswordHasherBusy
+
+SECRET_KEY = 'benchmark-secret-key-of-32-bytes!!'
+
+
+def scan_once(token):
+    claims = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+    return json.dumps({'barcode_number': '0000012345080001', 'username': claims['username']})
+
+
+# Run the burst for seconds, returns (logins, refused, scan latencies in ms)
+def run(verify, clients, seconds, password_hash):
+    stop = threading.Event()
+    counts = {'logins': 0, 'refused': 0}
+    lock = threading.Lock()
+
+    def client():
+        while not stop.is_set():
+            try:
+                verify(password_hash, 'secret')
+                key = 'logins'
+            except PasswordHasherBusy:
+                key = 'refused'
+                time.sleep(0.01)
+            with lock:
+                counts[key] += 1
+
+    latencies = []
+    token = jwt.encode({'username': 'operator', 'exp': datetime.utcnow() + timedelta(hours=1)}, SECRET_KEY, algorithm='HS256')
+
+    def scanner():
+        while not stop.is_set():
+            started = time.perf_counter()
+            scan_once(token)
+            latencies.append((time.perf_counter() - started) * 1000)
+            time.sleep(0.005)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)] + [threading.Thread(target=scanner)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return counts['logins'], counts['refused'], latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Login throughput and scan latency during a login burst')
+    parser.add_argument('--clients', type=int, default=32, help='threads logging in concurrently')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2), help='password hash pool size')
+    parser.add_argument('--queue', type=int, default=64, help='logins allowed to wait for the pool')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of each run')
+    parser.add_argument('--method', default='scrypt', help='werkzeug hash method')
+    args = parser.parse_args()
+
+    password_hash = generate_password_hash('secret', method=args.method)
+    hasher = PasswordHasher(method=args.method, workers=args.workers, max_pending=args.queue)
+
+    modes = [('inline', check_password_hash), (f'pool of {args.workers}', hasher.verify)]
+    for name, verify in modes:
+        logins, refused, latencies = run(verify, args.clients, args.seconds, password_hash)
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+        print(f'{name:>12}: {logins / args.seconds:.1f} logins/sec, {refused} refused, '
+              f'scan p50 {statistics.median(latencies):.2f} ms, p99 {p99:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+# Load test of the order-to-report pipeline
+#
+# Seeds synthetic orders shaped like test.json (three sizes per order) until
+# --pairs pairs exist, then drives the routes the floor uses, in order:
+#
+#   seed     /submit_order for every order
+#   labels   /generate_barcode for every order (then /view to learn the barcodes)
+#   scan     --scanners threads take pairs off a shared queue and scan each one
+#            through /charge and /stage1 to /stage6, while a supervisor thread
+#            polls /report of random orders every --report-interval seconds
+#   report   /report of every order once the scanning is done
+#
+# Every request is timed; p50/p95/p99 latency per route and the throughput of
+# each phase are written to a JSON file. Passing a previous file as --compare
+# flags the routes whose p95 grew, and the phases whose throughput fell, by
+# more than --tolerance, and exits with status 1 if any did.
+#
+# By default the app is imported in this process (index.py, with the flask
+# test client) and uses a dedicated database on a local mongod, dropped first:
+#
+#   python benchmarks/scan_pipeline.py --pairs 1000 10000 --scanners 16
+#   python benchmarks/scan_pipeline.py --mongomock --pairs 1000 --compare scan_pipeline_baseline.json
+#
+# --mongomock replaces the database with an in-memory mongomock one (pip
+# install mongomock): no server needed, but its latencies are mongomock's, so
+# only compare such runs with each other. --url drives a running server over
+# HTTP instead, leaving its database alone; its order numbers then start with
+# --order-prefix so that runs do not collide.
+#
+# The app's settings come from the environment as usual. Unless set, labels are
+# drawn as vectors without stored images, so the label phase measures the
+# database writes rather than the PNG rendering (see label_rendering.py).
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+STAGE_ROUTES = ['/charge'] + [f'/stage{number}' for number in range(1, 7)]
+SIZES = ['8', '9', '10']
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark-password'
+
+
+class InProcessClient:
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    # (status, body bytes) of a request, json is sent as the JSON body
+    def request(self, method, path, json_body=None, token=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        headers = {'Authorization': token} if token else {}
+        response = client.open(path, method=method, json=json_body, headers=headers)
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    def __init__(self, url, timeout=60):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.https = parts.scheme == 'https'
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            connection = self._local.connection = connection_class(self.host, self.port, timeout=self.timeout)
+        return connection
+
+    # One keep-alive connection per thread, reopened once if the server closed it
+    def request(self, method, path, json_body=None, token=None):
+        headers = {}
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body)
+            headers['Content-Type'] = 'application/json'
+        if token:
+            headers['Authorization'] = token
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # route -> [latency in ms], route -> requests answered with an unexpected status
+        self.latencies = {}
+        self.errors = {}
+
+    # Time a request, counting it as an error when its status is not one of expected
+    def call(self, client, route, method, path, json_body=None, token=None, expected=(200, 201)):
+        started = time.perf_counter()
+        try:
+            status, body = client.request(method, path, json_body, token)
+        except Exception:
+            status, body = None, b''
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.latencies.setdefault(route, []).append(elapsed)
+            if status not in expected:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return status, body
+
+
+# Nearest-rank percentile of sorted values
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))]
+
+
+def summarize(latencies, errors, seconds):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+        'requests_per_second': round(len(latencies) / seconds, 1) if seconds else 0.0
+    }
+
+
+# Orders shaped like test.json adding up to pairs, the last one smaller if need be
+def synthetic_orders(pairs, order_pairs, prefix):
+    orders = []
+    remaining = pairs
+    while remaining > 0:
+        quantity = min(order_pairs, remaining)
+        quantities = [quantity // len(SIZES)] * len(SIZES)
+        quantities[0] += quantity - sum(quantities)
+        index = len(orders)
+        orders.append({
+            'order_number': f'{prefix}{index:06d}'[-10:].zfill(10),
+            'article_number': f'ART{index:06d}',
+            'color': random.choice(['Red', 'Blue', 'Black', 'White']),
+            'gender': random.choice(['Men', 'Women', 'Unisex']),
+            'shoe_type': random.choice(['Sneakers', 'Boots', 'Sandals']),
+            'order_pairs': quantity,
+            'oef_number': f'OEF{index:06d}',
+            'customer': f'Customer {index % 50}',
+            'size_type': 'US',
+            'style': 'Sport',
+            'fit': 'Regular',
+            'season': random.choice(['Summer', 'Winter']),
+            'delivery_date': '2024-10-15',
+            'sizes_quantities': [{'size': size, 'quantity': size_quantity}
+                                 for size, size_quantity in zip(SIZES, quantities) if size_quantity]
+        })
+        remaining -= quantity
+    return orders
+
+
+# Run work(item) for every item on threads threads, returns the elapsed seconds
+def run_concurrently(items, threads, work):
+    pending = queue.Queue()
+    for item in items:
+        pending.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            work(item)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def login(client):
+    client.request('POST', '/register', {'username': USERNAME, 'password': PASSWORD})
+    status, body = client.request('POST', '/login', {'username': USERNAME, 'password': PASSWORD})
+    if status != 200:
+        raise SystemExit(f'Could not log in as {USERNAME}: {status} {body[:200]!r}')
+    return json.loads(body)['token']
+
+
+def run(client, pairs, args, prefix):
+    recorder = Recorder()
+    token = login(client)
+    orders = synthetic_orders(pairs, args.order_pairs, prefix)
+    phases = {}
+
+    def submit(order):
+        recorder.call(client, '/submit_order', 'POST', '/submit_order', order)
+
+    seconds = run_concurrently(orders, args.scanners, submit)
+    phases['seed'] = {'seconds': seconds, 'routes': ['/submit_order']}
+
+    barcodes = []
+    barcodes_lock = threading.Lock()
+
+    def label(order):
+        recorder.call(client, '/generate_barcode', 'POST', '/generate_barcode', {'order_number': order['order_number']})
+        status, body = recorder.call(client, '/view', 'GET', f"/view/{order['order_number']}?format=ndjson")
+        if status == 200:
+            order_barcodes = [json.loads(line)['barcode_number'] for line in body.splitlines() if line.strip()]
+            with barcodes_lock:
+                barcodes.extend(order_barcodes)
+
+    seconds = run_concurrently(orders, max(1, min(args.scanners, args.label_threads)), label)
+    phases['labels'] = {'seconds': seconds, 'routes': ['/generate_barcode', '/view']}
+    if len(barcodes) != pairs:
+        print(f'  {len(barcodes)} barcodes generated for {pairs} pairs', file=sys.stderr)
+
+    # Pairs are scanned in a shuffled order, as they reach the scanners from several lines
+    random.shuffle(barcodes)
+    scanning = threading.Event()
+    scanning.set()
+
+    def supervisor():
+        while scanning.is_set():
+            order_number = random.choice(orders)['order_number']
+            recorder.call(client, '/report (during scan)', 'GET', f'/report/{order_number}')
+            time.sleep(args.report_interval)
+
+    def scan(barcode_number):
+        for route in STAGE_ROUTES:
+            recorder.call(client, route, 'POST', route, {'barcode_number': barcode_number}, token=token)
+
+    supervisors = []
+    if args.report_interval > 0:
+        supervisors = [threading.Thread(target=supervisor)]
+        supervisors[0].start()
+    seconds = run_concurrently(barcodes, args.scanners, scan)
+    scanning.clear()
+    for thread in supervisors:
+        thread.join()
+    phases['scan'] = {'seconds': seconds, 'routes': STAGE_ROUTES + ['/report (during scan)'],
+                      'pairs_per_second': round(len(barcodes) / seconds, 1) if seconds else 0.0}
+
+    def report(order):
+        recorder.call(client, '/report', 'GET', f"/report/{order['order_number']}")
+
+    seconds = run_concurrently(orders, args.scanners, report)
+    phases['report'] = {'seconds': seconds, 'routes': ['/report']}
+
+    routes = {}
+    for phase in phases.values():
+        requests = 0
+        for route in phase.pop('routes'):
+            if route in recorder.latencies:
+                routes[route] = summarize(recorder.latencies[route], recorder.errors.get(route, 0), phase['seconds'])
+                requests += routes[route]['requests']
+        phase['requests'] = requests
+        phase['requests_per_second'] = round(requests / phase['seconds'], 1) if phase['seconds'] else 0.0
+        phase['seconds'] = round(phase['seconds'], 3)
+
+    return {'orders': len(orders), 'pairs': len(barcodes), 'phases': phases, 'routes': routes}
+
+
+# Regressions of results against a baseline: [(pairs, what, baseline value, value)]
+def compare(results, baseline, tolerance):
+    regressions = []
+    for pairs, run_results in results['runs'].items():
+        base = baseline.get('runs', {}).get(pairs)
+        if not base:
+            continue
+        for route, stats in run_results['routes'].items():
+            base_stats = base['routes'].get(route)
+            if base_stats and stats['p95_ms'] > base_stats['p95_ms'] * (1 + tolerance):
+                regressions.append((pairs, f'{route} p95 ms', base_stats['p95_ms'], stats['p95_ms']))
+            if base_stats and stats['errors'] > base_stats['errors']:
+                regressions.append((pairs, f'{route} errors', base_stats['errors'], stats['errors']))
+        for name, phase in run_results['phases'].items():
+            base_phase = base['phases'].get(name)
+            if base_phase and phase['requests_per_second'] < base_phase['requests_per_second'] * (1 - tolerance):
+                regressions.append((pairs, f'{name} requests/sec', base_phase['requests_per_second'],
+                                    phase['requests_per_second']))
+    return regressions
+
+
+# Import the app against a fresh benchmark database, or against mongomock
+def local_app(args):
+    os.environ.setdefault('LABEL_RENDER_MODE', 'vector')
+    os.environ.setdefault('STORE_BARCODE_IMAGES', '0')
+
+    if args.mongomock:
+        import flask_pymongo
+        import mongomock
+        from mongomock.gridfs import enable_gridfs_integration
+
+        class MongomockPyMongo:
+            def __init__(self, app=None, *args, **kwargs):
+                self.cx = mongomock.MongoClient()
+                self.db = self.cx.florence_benchmark
+
+            def init_app(self, app, *args, **kwargs):
+                pass
+
+        flask_pymongo.PyMongo = MongomockPyMongo
+        # Label job PDFs are kept in GridFS
+        enable_gridfs_integration()
+        # mongomock has no collMod or explain
+        os.environ.setdefault('ENSURE_INDEXES', '0')
+    else:
+        from pymongo import MongoClient, uri_parser
+
+        database = uri_parser.parse_uri(args.mongo_uri)['database']
+        if not database or 'bench' not in database:
+            raise SystemExit(f"Refusing to drop database {database!r}: use a dedicated one, e.g. .../florence_benchmark")
+        MongoClient(args.mongo_uri).drop_database(database)
+        os.environ['MONGO_URI'] = args.mongo_uri
+
+    import index
+    return index.app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency and throughput of the order, label, scan and report routes')
+    parser.add_argument('--pairs', type=int, nargs='+', default=[1000], help='pairs to seed, one run per value (e.g. 1000 10000 100000)')
+    parser.add_argument('--scanners', type=int, default=8, help='concurrent simulated scanners')
+    parser.add_argument('--order-pairs', type=int, default=300, help='pairs per synthetic order')
+    parser.add_argument('--label-threads', type=int, default=2, help='orders whose labels are generated at once')
+    parser.add_argument('--report-interval', type=float, default=0.5, help='seconds between supervisor /report polls while scanning, 0 to disable')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/florence_benchmark', help='database of the in-process app, dropped first')
+    parser.add_argument('--mongomock', action='store_true', help='run the in-process app on mongomock instead of mongod')
+    parser.add_argument('--url', help='drive a running server (e.g. http://localhost:5000) instead of an in-process app')
+    parser.add_argument('--order-prefix', default=None, help='leading digits of the order numbers (default: from the clock with --url)')
+    parser.add_argument('--output', default='scan_pipeline_baseline.json', help='JSON file the results are written to')
+    parser.add_argument('--compare', help='previous results to check these against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative p95 growth / throughput drop')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the synthetic data')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if args.url:
+        client = HttpClient(args.url)
+        backend = args.url
+        prefix = args.order_prefix or str(int(time.time()) % 1000).zfill(3)
+    else:
+        client = InProcessClient(local_app(args))
+        backend = 'mongomock' if args.mongomock else args.mongo_uri
+        prefix = args.order_prefix or '9'
+
+    results = {
+        'created_at': datetime.utcnow().isoformat(),
+        'backend': backend,
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'settings': {'scanners': args.scanners, 'order_pairs': args.order_pairs,
+                     'label_threads': args.label_threads, 'report_interval': args.report_interval},
+        'runs': {}
+    }
+    for run_index, pairs in enumerate(args.pairs):
+        print(f'{pairs} pairs, {args.scanners} scanners ({backend})')
+        run_results = run(client, pairs, args, f'{prefix}{run_index}')
+        results['runs'][str(pairs)] = run_results
+        for name, phase in run_results['phases'].items():
+            print(f"  {name:>6}: {phase['requests']} requests in {phase['seconds']:.1f} s, "
+                  f"{phase['requests_per_second']:.1f} requests/sec")
+        for route, stats in run_results['routes'].items():
+            print(f"  {route:>22}: p50 {stats['p50_ms']:.2f} ms, p95 {stats['p95_ms']:.2f} ms, "
+                  f"p99 {stats['p99_ms']:.2f} ms, {stats['errors']} errors")
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for pairs, what, before, after in regressions:
+            print(f'REGRESSION {pairs} pairs: {what} {before} -> {after}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regression beyond {args.tolerance:.0%} against {args.compare}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,146 @@
-from flask import Flask, request, jsonify, send_file
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context, make_response, g
 from flask_pymongo import PyMongo
 import jwt
 from datetime import datetime, timedelta
-import random
 import io
-from barcode import Code128
-from barcode.writer import ImageWriter
 from PIL import Image
 from reportlab.pdfgen import canvas
-import base64
-from datetime import datetime, timedelta
 import pymongo
-from bson.json_util import dumps
 from flask_cors import CORS 
 import re
+import os
+from report_engine import build_report, report_inputs
+import order_progress
+import barcode_progress
+import barcode_codec
+from pymongo import UpdateOne, InsertOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from scan_batch import process_scan_batch
+from stages import STAGES, get_stage, scan_steps
+from functools import partial, lru_cache, wraps
+from indexes import ensure_indexes, ensure_login_retention, verify_query_plans, unique_event_indexes, dedupe_event_records
+from label_generation import generate_barcode, create_barcode_image, generate_order_labels, write_label_pdf, RENDER_MODES
+from label_jobs import LabelJobQueue, job_status, DONE
+from label_pdf_stream import stream_label_pdf
+from token_cache import TokenCache
+from audit_log import AuditBuffer
+from barcode_export import FORMATS as EXPORT_FORMATS, negotiate_format, export_chunks, gzip_chunks
+import itertools
+from order_import import IMPORT_FORMATS, validate_order, read_orders, import_orders, format_from_filename
+import click
+from sequences import BlockSequence, SequenceExhausted
+from label_cache import LabelCache, SharedLabelStore
+from metrics import Metrics, MongoCommandListener
+from wip_board import WipBoard, poll_changes, watch_changes
+import json
+import queue
+import threading
+from order_listing import listing_query, find_orders, stream_orders
+from password_hashing import PasswordHasher, PasswordHasherBusy
 
 app = Flask(__name__)
-app.config['MONGO_URI'] = 'mongodb://localhost:27017/florence'  # Replace with your MongoDB URI
+app.config['MONGO_URI'] = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/florence')  # Replace with your MongoDB URI
 app.config['SECRET_KEY'] = 'your_secret_key'  # Replace with your secret key
+# Keep one barcode_progress document per pair instead of the charges/stage collections
+app.config['BARCODE_PROGRESS_STORAGE'] = os.environ.get('BARCODE_PROGRESS_STORAGE') == '1'
+# Create the required indexes at startup, and optionally check the hot queries use them
+app.config['ENSURE_INDEXES'] = os.environ.get('ENSURE_INDEXES', '1') == '1'
+app.config['VERIFY_QUERY_PLANS'] = os.environ.get('VERIFY_QUERY_PLANS') == '1'
+# Label generation: render worker processes of each server process (default: all cores, divide them
+# by WEB_WORKERS under serve.py) and barcode_images insert chunk size
+app.config['LABEL_RENDER_WORKERS'] = int(os.environ.get('LABEL_RENDER_WORKERS', os.cpu_count() or 1))
+app.config['LABEL_INSERT_CHUNK_SIZE'] = int(os.environ.get('LABEL_INSERT_CHUNK_SIZE', 1000))
+# Draw the labels on the PDF as 'image' (rendered PNGs) or 'vector' (bars drawn directly, much cheaper)
+app.config['LABEL_RENDER_MODE'] = os.environ.get('LABEL_RENDER_MODE', 'image')
+if app.config['LABEL_RENDER_MODE'] not in RENDER_MODES:
+    # Refuse to start rather than fail every label generation
+    raise ValueError(f"LABEL_RENDER_MODE must be one of {', '.join(RENDER_MODES)}, not {app.config['LABEL_RENDER_MODE']!r}")
+# Stream the labels PDF page by page instead of building it in memory first
+app.config['LABEL_PDF_STREAMING'] = os.environ.get('LABEL_PDF_STREAMING') == '1'
+# Store the base64 PNG in barcode_images, or only the metadata and render images on demand
+app.config['STORE_BARCODE_IMAGES'] = os.environ.get('STORE_BARCODE_IMAGES', '1') == '1'
+# Number of rendered PNGs kept in memory for on-demand rendering
+app.config['BARCODE_IMAGE_CACHE_SIZE'] = int(os.environ.get('BARCODE_IMAGE_CACHE_SIZE', 1024))
+# Append a check digit to new barcodes; scans of such barcodes are decoded without a database read
+app.config['BARCODE_CHECK_DIGIT'] = os.environ.get('BARCODE_CHECK_DIGIT') == '1'
+# Look barcodes up by their packed 64-bit barcode_key (run backfill-barcode-keys first)
+app.config['BARCODE_KEY_LOOKUPS'] = os.environ.get('BARCODE_KEY_LOOKUPS') == '1'
+# Largest number of scans accepted by /scan_batch
+app.config['SCAN_BATCH_MAX_EVENTS'] = int(os.environ.get('SCAN_BATCH_MAX_EVENTS', 5000))
+# Background label jobs: worker threads per process (the finished PDFs are kept in GridFS)
+app.config['LABEL_JOB_WORKERS'] = int(os.environ.get('LABEL_JOB_WORKERS', 1))
+# Verified session tokens kept per process, and for how long at most (a token is never kept past its exp)
+app.config['TOKEN_CACHE_SIZE'] = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+app.config['TOKEN_CACHE_TTL'] = int(os.environ.get('TOKEN_CACHE_TTL', 300))
+# Login activity is written in the background, in batches of up to LOGIN_AUDIT_BATCH_SIZE
+# at least every LOGIN_AUDIT_FLUSH_INTERVAL seconds, and kept LOGIN_RETENTION_DAYS (0 keeps it forever)
+app.config['LOGIN_AUDIT_BATCH_SIZE'] = int(os.environ.get('LOGIN_AUDIT_BATCH_SIZE', 500))
+app.config['LOGIN_AUDIT_FLUSH_INTERVAL'] = float(os.environ.get('LOGIN_AUDIT_FLUSH_INTERVAL', 1.0))
+app.config['LOGIN_RETENTION_DAYS'] = float(os.environ.get('LOGIN_RETENTION_DAYS', 90))
+# Password hash parameters (a werkzeug method such as 'scrypt' or 'pbkdf2:sha256:600000'), stored
+# passwords are rehashed on login when they change. At most PASSWORD_HASH_WORKERS hashes run at once
+# and PASSWORD_HASH_QUEUE wait, further logins are refused with a 503 until the burst is absorbed
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+app.config['PASSWORD_SALT_LENGTH'] = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 64))
+# Largest page of /orders
+app.config['ORDERS_PAGE_MAX'] = int(os.environ.get('ORDERS_PAGE_MAX', 1000))
+# Documents per cursor batch when streaming the barcodes of an order from /view
+app.config['VIEW_BATCH_SIZE'] = int(os.environ.get('VIEW_BATCH_SIZE', 2000))
+# Orders upserted per bulk_write by /import_orders and the import-orders command
+app.config['ORDER_IMPORT_BATCH_SIZE'] = int(os.environ.get('ORDER_IMPORT_BATCH_SIZE', 1000))
+# Sl.No. numbers each process reserves at once
+app.config['SL_NO_BLOCK_SIZE'] = int(os.environ.get('SL_NO_BLOCK_SIZE', 100))
+# Live WIP board: also follow the transitions written by other processes through a change stream
+# (needs a replica set), and send a keep-alive comment to idle subscribers every WIP_HEARTBEAT_SECONDS
+app.config['WIP_CHANGE_STREAM'] = os.environ.get('WIP_CHANGE_STREAM') == '1'
+app.config['WIP_HEARTBEAT_SECONDS'] = float(os.environ.get('WIP_HEARTBEAT_SECONDS', 15))
+# Without the change stream, the boards read their orders' stages again every WIP_POLL_SECONDS to
+# pick up the scans of the other workers (0 only counts this process's scans: a single worker)
+app.config['WIP_POLL_SECONDS'] = float(os.environ.get('WIP_POLL_SECONDS', 5))
+# Each open board holds a server thread for as long as it is watched: at most WIP_MAX_STREAMS per
+# process, further boards get a 503 (keep it well below WEB_THREADS so scans still have threads)
+app.config['WIP_MAX_STREAMS'] = int(os.environ.get('WIP_MAX_STREAMS', 4))
+# Keep per-order progress counters up to date on every scan and serve /report from them
+# (run 'flask --app index rebuild-order-progress' once before turning this on)
+app.config['ORDER_PROGRESS_COUNTERS'] = os.environ.get('ORDER_PROGRESS_COUNTERS') == '1'
+# Resolved barcode labels kept per process, and optionally in a SQLite file shared by the
+# workers of a host (e.g. /dev/shm/florence_labels.db, empty to disable)
+app.config['LABEL_CACHE_SIZE'] = int(os.environ.get('LABEL_CACHE_SIZE', 100000))
+app.config['LABEL_CACHE_SHARED_PATH'] = os.environ.get('LABEL_CACHE_SHARED_PATH', '')
+# Requests issuing more database commands than this are logged as likely N+1 query loops
+app.config['N_PLUS_ONE_THRESHOLD'] = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 20))
+# MongoDB connection pool of each process: size it to the threads serving requests (see serve.py).
+# MONGO_SOCKET_TIMEOUT_MS and MONGO_WAIT_QUEUE_TIMEOUT_MS are unlimited when empty
+app.config['MONGO_MAX_POOL_SIZE'] = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+app.config['MONGO_MIN_POOL_SIZE'] = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+app.config['MONGO_CONNECT_TIMEOUT_MS'] = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000))
+app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'] = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 10000))
+app.config['MONGO_SOCKET_TIMEOUT_MS'] = int(os.environ['MONGO_SOCKET_TIMEOUT_MS']) if os.environ.get('MONGO_SOCKET_TIMEOUT_MS') else None
+app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'] = int(os.environ['MONGO_WAIT_QUEUE_TIMEOUT_MS']) if os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS') else None
+# Seconds /readyz waits for the database to answer a ping
+app.config['READINESS_TIMEOUT'] = float(os.environ.get('READINESS_TIMEOUT', 2))
+# Seconds clients may reuse a /view_barcode response before revalidating it with its ETag
+app.config['VIEW_BARCODE_MAX_AGE'] = int(os.environ.get('VIEW_BARCODE_MAX_AGE', 60))
 ngrok_origin_pattern = re.compile(r"https://[a-z0-9]+\.ngrok-free\.app")
 CORS(app, resources={r"/*": {"origins": ngrok_origin_pattern}})
 CORS(app, resources={r"/*": {"origins": "*"}})
 
-mongo = PyMongo(app)
+# Per-route latency, query counts and response sizes, and every MongoDB command, served on /metrics
+metrics = Metrics(n_plus_one_threshold=app.config['N_PLUS_ONE_THRESHOLD'], logger=app.logger)
+
+# Opened when index is imported: under serve.py that happens in each worker, after the fork
+mongo = PyMongo(
+    app,
+    event_listeners=[MongoCommandListener(metrics)],
+    maxPoolSize=app.config['MONGO_MAX_POOL_SIZE'],
+    minPoolSize=app.config['MONGO_MIN_POOL_SIZE'],
+    connectTimeoutMS=app.config['MONGO_CONNECT_TIMEOUT_MS'],
+    serverSelectionTimeoutMS=app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+    socketTimeoutMS=app.config['MONGO_SOCKET_TIMEOUT_MS'],
+    waitQueueTimeoutMS=app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS']
+)
 
 # Define two separate collections: one for users and one for login activities
 users_collection = mongo.db.users
@@ -31,33 +148,473 @@ logins_collection = mongo.db.logins
 orders_collection = mongo.db.orders
 barcodes_collection = mongo.db.barcodes
 barcode_images_collection = mongo.db.barcode_images
-charges_collection = mongo.db.charges
-stage1_collection = mongo.db.stage1
-stage2_collection = mongo.db.stage2
-stage3_collection = mongo.db.stage3
-stage4_collection = mongo.db.stage4
-stage5_collection = mongo.db.stage5
-stage6_collection = mongo.db.stage6
+barcode_progress_collection = mongo.db.barcode_progress
+label_jobs_collection = mongo.db.label_jobs
+counters_collection = mongo.db.counters
+order_progress_collection = mongo.db.order_progress
+
+# Collections holding the events of each stage of the stage table, the charge being stage 0
+event_collections = [mongo.db[stage.collection] for stage in STAGES]
+charges_collection = event_collections[0]
+stage_collections = event_collections[1:]
+
+# Rendered PNGs of the most recently viewed barcodes
+cached_barcode_image = lru_cache(maxsize=app.config['BARCODE_IMAGE_CACHE_SIZE'])(create_barcode_image)
+
+# Labels (order number and shoe size) of the barcodes scanned or generated recently
+label_cache = LabelCache(
+    max_size=app.config['LABEL_CACHE_SIZE'],
+    shared=SharedLabelStore(app.config['LABEL_CACHE_SHARED_PATH']) if app.config['LABEL_CACHE_SHARED_PATH'] else None
+)
+
+# Claims of the session tokens verified recently
+token_cache = TokenCache(app.config['SECRET_KEY'], algorithms=['HS256'],
+                         max_size=app.config['TOKEN_CACHE_SIZE'], ttl=app.config['TOKEN_CACHE_TTL'])
+
+# Pool hashing and checking passwords off the request threads
+password_hasher = PasswordHasher(
+    method=app.config['PASSWORD_HASH_METHOD'],
+    salt_length=app.config['PASSWORD_SALT_LENGTH'],
+    workers=app.config['PASSWORD_HASH_WORKERS'],
+    max_pending=app.config['PASSWORD_HASH_QUEUE']
+)
+
+# Login activity waiting to be written
+login_audit = AuditBuffer(logins_collection, max_batch=app.config['LOGIN_AUDIT_BATCH_SIZE'],
+                          flush_interval=app.config['LOGIN_AUDIT_FLUSH_INTERVAL'])
+
+# Whether the charge/stage collections refuse a second record of a barcode (their unique index exists),
+# otherwise the scan routes check for an existing record before writing
+app.config['UNIQUE_STAGE_RECORDS'] = False
+if app.config['ENSURE_INDEXES']:
+    # A missing index must not keep the app from starting: log it and serve without it
+    try:
+        for failure in ensure_indexes(mongo.db, strict=False):
+            app.logger.error(f'Index not created: {failure}')
+        ensure_login_retention(mongo.db, app.config['LOGIN_RETENTION_DAYS'])
+        app.config['UNIQUE_STAGE_RECORDS'] = unique_event_indexes(mongo.db)
+    except pymongo.errors.PyMongoError as e:
+        app.logger.error(f'Could not create the indexes: {e}')
+    if not app.config['UNIQUE_STAGE_RECORDS']:
+        app.logger.error('The unique barcode_number indexes of the charge/stage collections are missing, '
+                         'run "flask --app index dedupe-stage-records" to remove the repeated records and create them')
+if app.config['VERIFY_QUERY_PLANS']:
+    verify_query_plans(mongo.db)
+
+
+@app.before_request
+def start_request_metrics():
+    g.metrics, g.metrics_token = metrics.start_request()
+
+
+def request_route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@app.after_request
+def count_response_metrics(response):
+    stats = g.get('metrics')
+    if stats:
+        stats.status = response.status_code
+        if response.content_length is not None:
+            stats.bytes_out = response.content_length
+        else:
+            # Streamed: the request is finished once the body is sent
+            stats.streamed = True
+            response.response = metrics.stream_body(stats, g.metrics_token, request_route(), request.method, response.response)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exception):
+    stats = g.get('metrics')
+    if stats and not stats.streamed:
+        g.pop('metrics')
+        metrics.finish_request(stats, g.pop('metrics_token'), request_route(), request.method)
+
+
+# Cache and buffer gauges for /metrics
+def cache_metrics():
+    token_stats = token_cache.stats()
+    label_stats = label_cache.stats()
+    audit_stats = login_audit.stats()
+    return [
+        ('florence_token_cache_hits_total', 'counter', 'Session tokens answered from the verified token cache', [], token_stats['hits']),
+        ('florence_token_cache_misses_total', 'counter', 'Session tokens verified with jwt.decode', [], token_stats['misses']),
+        ('florence_token_verify_seconds_total', 'counter', 'Time spent verifying session tokens', [], token_stats['verify_seconds']),
+        ('florence_label_cache_lookups_total', 'counter', 'Barcode label lookups, by tier that answered', [('tier', 'process')], label_stats['hits']),
+        ('florence_label_cache_lookups_total', 'counter', 'Barcode label lookups, by tier that answered', [('tier', 'shared')], label_stats['shared_hits']),
+        ('florence_label_cache_lookups_total', 'counter', 'Barcode label lookups, by tier that answered', [('tier', 'database')], label_stats['misses']),
+        ('florence_label_cache_shared_errors_total', 'counter', 'SQLite errors of the shared label cache, answered by the database instead', [], label_stats['shared_errors']),
+        ('florence_login_audit_pending', 'gauge', 'Login events waiting to be written', [], audit_stats['pending']),
+        ('florence_login_audit_dropped_total', 'counter', 'Login events dropped because the audit buffer was full (the database was slow or unreachable)', [], audit_stats['dropped']),
+    ]
+
+
+metrics.collectors.append(cache_metrics)
+
+
+# Metrics of this process in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Liveness: the process answers requests, the database is not checked
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({'status': 'ok', 'pid': os.getpid()}), 200
+
+
+# Readiness: the database answers a ping within READINESS_TIMEOUT seconds, else 503 so the
+# load balancer stops sending scans to this process
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    try:
+        with pymongo.timeout(app.config['READINESS_TIMEOUT']):
+            mongo.cx.admin.command('ping')
+    except pymongo.errors.PyMongoError as e:
+        return jsonify({'status': 'unavailable', 'database': str(e)}), 503
+    return jsonify({'status': 'ready', 'pid': os.getpid()}), 200
+
+
+# Require a valid session token in the Authorization header, verified once per request
+# The token's claims are put on flask.g.token and its username on flask.g.username
+def token_required(view):
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        user_token = request.headers.get('Authorization')
+        if not user_token:
+            return jsonify({'message': 'User token is required!'}), 401
+
+        try:
+            g.token = token_cache.verify(user_token)
+            g.username = g.token['username']
+        except jwt.ExpiredSignatureError:
+            return jsonify({'message': 'Token has expired!'}), 401
+        except (jwt.InvalidTokenError, KeyError):
+            return jsonify({'message': 'Invalid token!'}), 401
+
+        return view(*args, **kwargs)
+    return decorated
+
+
+# Load the latest recorded event of a barcode for each given stage (None if not reached)
+def load_stage_events(barcode_number, *stages):
+    if app.config['BARCODE_PROGRESS_STORAGE']:
+        # A single indexed read answers every stage
+        progress = barcode_progress_collection.find_one({'_id': barcode_number})
+        return [barcode_progress.stage_event(progress, stage) for stage in stages]
+    return [
+        event_collections[stage].find_one({'barcode_number': barcode_number}, sort=[('created_at', pymongo.DESCENDING)])
+        for stage in stages
+    ]
+
+
+# Record a stage event, returns False if the barcode already has it
+def save_stage_event(stage, data):
+    if app.config['BARCODE_PROGRESS_STORAGE']:
+        return barcode_progress.push_event(barcode_progress_collection, stage, data)
+    try:
+        event_collections[stage].insert_one(data)
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+# Query matching a barcode in barcode_images
+def barcode_lookup_filter(barcode_number):
+    barcode_key = barcode_codec.pack(barcode_number) if app.config['BARCODE_KEY_LOOKUPS'] else None
+    if barcode_key is not None:
+        return {'barcode_key': barcode_key}
+    return {'barcode_number': barcode_number}
+
+
+# Resolve a scanned barcode to its order_number and shoe_size (None if unknown)
+def resolve_barcode(barcode_number):
+    # Barcodes with a valid check digit carry everything needed, no database read
+    try:
+        fields = barcode_codec.decode(barcode_number)
+    except ValueError:
+        fields = None
+    if fields and fields.checked:
+        return {'order_number': fields.order_number, 'shoe_size': fields.shoe_size}
+
+    return label_cache.get(barcode_number, find_labels)
+
+
+# Read the labels of barcodes from barcode_images: {barcode_number: {'order_number', 'shoe_size'}}
+def find_labels(barcode_numbers):
+    if len(barcode_numbers) == 1:
+        label = barcode_images_collection.find_one(barcode_lookup_filter(barcode_numbers[0]), {'_id': 0, 'order_number': 1, 'shoe_size': 1})
+        return {barcode_numbers[0]: label} if label else {}
+
+    barcode_keys = [barcode_codec.pack(barcode_number) for barcode_number in barcode_numbers] if app.config['BARCODE_KEY_LOOKUPS'] else []
+    if barcode_keys and None not in barcode_keys:
+        query = {'barcode_key': {'$in': barcode_keys}}
+    else:
+        query = {'barcode_number': {'$in': barcode_numbers}}
+    labels = {}
+    for label in barcode_images_collection.find(query, {'_id': 0, 'barcode_number': 1, 'order_number': 1, 'shoe_size': 1}):
+        labels.setdefault(label['barcode_number'], label)
+    return labels
+
+
+# Shoe size a stage record is counted under: recorded on the charge and the first stages, else from the barcode
+def record_shoe_size(document):
+    shoe_size = document.get('shoe_size') or document.get('shoe_Size')
+    if shoe_size:
+        return shoe_size
+    try:
+        return barcode_codec.decode(document['barcode_number']).shoe_size
+    except ValueError:
+        label = resolve_barcode(document['barcode_number'])
+        return label['shoe_size'] if label else None
+
+
+# Count newly written stage records [(stage, document)] in the order progress counters
+def count_stage_records(records):
+    if not app.config['ORDER_PROGRESS_COUNTERS']:
+        return
+    transitions = [(document['order_number'], record_shoe_size(document), stage) for stage, document in records]
+    order_progress.increment_many(order_progress_collection, [t for t in transitions if t[1] is not None])
+
+
+# Charge entries and stage sets of an order from whichever storage is in use, see report_engine.build_report
+def order_report_inputs(order_number):
+    if app.config['BARCODE_PROGRESS_STORAGE']:
+        # A single scan of the progress collection
+        return barcode_progress.report_inputs(barcode_progress_collection, order_number)
+    return report_inputs(order_number, charges_collection, stage_collections)
+
+
+# Latest recorded events of many barcodes for the given stages: {(barcode_number, stage): event}
+def load_stage_events_bulk(barcode_numbers, stages):
+    if app.config['BARCODE_PROGRESS_STORAGE']:
+        return barcode_progress.load_events(barcode_progress_collection, barcode_numbers)
+
+    events = {}
+    for stage in stages:
+        cursor = event_collections[stage].find({'barcode_number': {'$in': barcode_numbers}}).sort('created_at', pymongo.ASCENDING)
+        for event in cursor:
+            events[(event['barcode_number'], stage)] = event
+    return events
+
+
+# Record many stage events with bulk writes
+#   events: [(key, stage, data, depends_on)] in scan order, depends_on being the key of the event
+#   whose record is this one's prerequisite, or None
+# Returns the keys of the events that were not written: the barcode already had them, or the event
+# they depend on was not written
+def save_stage_events_bulk(events):
+    if app.config['BARCODE_PROGRESS_STORAGE']:
+        # A barcode's events are written by a single conditional update, all of them or none
+        return barcode_progress.push_events_bulk(barcode_progress_collection, [
+            (key, stage, data) for key, stage, data, depends_on in events
+        ])
+
+    failed = set()
+    for stage, collection in enumerate(event_collections):
+        stage_events = []
+        for key, event_stage, data, depends_on in events:
+            if event_stage != stage:
+                continue
+            # Stages are written in order, so the prerequisite's outcome is known
+            if depends_on in failed:
+                failed.add(key)
+            else:
+                stage_events.append((key, data))
+        if not stage_events:
+            continue
+        try:
+            collection.bulk_write([InsertOne(data) for _, data in stage_events], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                failed.add(stage_events[error['index']][0])
+    return failed
+
+
+# Resolve many scanned barcodes: {barcode_number: {'order_number', 'shoe_size'}}
+def resolve_barcodes(barcode_numbers):
+    labels = {}
+    unresolved = []
+    for barcode_number in barcode_numbers:
+        try:
+            fields = barcode_codec.decode(barcode_number)
+        except ValueError:
+            fields = None
+        if fields and fields.checked:
+            labels[barcode_number] = {'order_number': fields.order_number, 'shoe_size': fields.shoe_size}
+        else:
+            unresolved.append(barcode_number)
+
+    if unresolved:
+        labels.update(label_cache.get_many(unresolved, find_labels))
+    return labels
+
+
+# Backfill the barcode_progress collection from the charges and stage collections
+@app.cli.command('backfill-progress')
+def backfill_progress_command():
+    migrated = barcode_progress.backfill(barcode_progress_collection, charges_collection, stage_collections)
+    print(f'Backfilled {migrated} barcode progress documents')
+
+
+# Store the packed barcode_key on barcode_images documents generated before it existed
+@app.cli.command('backfill-barcode-keys')
+def backfill_barcode_keys_command():
+    updated = 0
+    batch = []
+    for doc in barcode_images_collection.find({'barcode_key': {'$exists': False}}, {'barcode_number': 1}):
+        barcode_key = barcode_codec.pack(doc['barcode_number'])
+        if barcode_key is None:
+            continue
+        batch.append(UpdateOne({'_id': doc['_id']}, {'$set': {'barcode_key': barcode_key}}))
+        if len(batch) == 1000:
+            updated += barcode_images_collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += barcode_images_collection.bulk_write(batch, ordered=False).modified_count
+    print(f'Stored the barcode key of {updated} barcodes')
+
+
+# Strip the stored base64 images from barcode_images, they are rendered on demand afterwards
+@app.cli.command('strip-barcode-images')
+def strip_barcode_images_command():
+    result = barcode_images_collection.update_many({'image': {'$exists': True}}, {'$unset': {'image': ''}})
+    print(f'Stripped the image of {result.modified_count} barcodes')
+
+
+# Upsert the orders of an ERP file (JSON array, NDJSON or CSV) by order number, e.g.
+#   flask --app index import-orders orders.json
+@app.cli.command('import-orders')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'import_format', type=click.Choice(IMPORT_FORMATS), help='defaults to the file extension')
+def import_orders_command(path, import_format):
+    import_format = import_format or format_from_filename(path)
+    if not import_format:
+        raise click.UsageError('Cannot tell the format from the file name, use --format')
+
+    with open(path, encoding='utf-8', newline='') as text_stream:
+        summary = import_orders(orders_collection, read_orders(text_stream, import_format), generate_sl_no,
+                                batch_size=app.config['ORDER_IMPORT_BATCH_SIZE'])
+    for error in summary['errors']:
+        print(f"record {error['record']} ({error['order_number']}): {error['message']}")
+    print(f"Imported orders: {summary['inserted']} inserted, {summary['updated']} updated, {summary['failed']} failed")
+
+
+# Recompute the order progress counters from the stage records, of every order or of --order
+# With --verify, only report the counters that drifted from the records
+@app.cli.command('rebuild-order-progress')
+@click.option('--order', 'order_number', help='only this order number')
+@click.option('--verify', is_flag=True, help='compare without writing')
+def rebuild_order_progress_command(order_number, verify):
+    order_numbers = [order_number] if order_number else charges_collection.distinct('order_number')
+    if app.config['BARCODE_PROGRESS_STORAGE'] and not order_number:
+        order_numbers = barcode_progress_collection.distinct('order_number')
+
+    drifted = 0
+    for number in order_numbers:
+        charge_entries, stage_sets = order_report_inputs(number)
+        if verify:
+            differences = order_progress.verify_order(order_progress_collection, number, charge_entries, stage_sets)
+            for size, stage_name, stored, recomputed in differences:
+                print(f'{number} size {size} {stage_name}: counter {stored}, records {recomputed}')
+            drifted += bool(differences)
+        else:
+            order_progress.rebuild_order(order_progress_collection, number, charge_entries, stage_sets)
+
+    if verify:
+        print(f'{drifted} of {len(order_numbers)} orders have drifted counters')
+    else:
+        print(f'Rebuilt the progress counters of {len(order_numbers)} orders')
+
+
+# Move the repeated records of a barcode out of the charge/stage collections (to stage_duplicates,
+# keeping the earliest) and create their unique barcode_number indexes
+# Must run before those indexes can be enforced on a database written without them
+@app.cli.command('dedupe-stage-records')
+@click.option('--dry-run', is_flag=True, help='Only count the repeated records.')
+def dedupe_stage_records_command(dry_run):
+    moved = dedupe_event_records(mongo.db, dry_run=dry_run)
+    for collection_name, count in moved.items():
+        print(f"{collection_name}: {count} repeated records{'' if dry_run else ' moved to stage_duplicates'}")
+    if not dry_run:
+        ensure_indexes(mongo.db)
+        print('The unique barcode_number indexes are in place, restart the app to rely on them')
+
+
+# Create the required indexes and fail if a hot query still scans a whole collection
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    ensure_indexes(mongo.db)
+    verify_query_plans(mongo.db)
+    print('All hot queries are backed by an index')
 
 
 @app.route('/', methods=['GET'])
 def test():
     return "hellow"
 
+# List orders as a JSON array, oldest first, streamed as they are read
+# Filters: customer, season, delivery_from, delivery_to; fields=a,b,c projects; limit=N pages the
+# listing, the next page is requested with cursor=<X-Next-Cursor header of the previous page>
 @app.route('/orders', methods=['GET'])
 def getAllOrders():
-    data = dumps(orders_collection.find())
-    print(data)
-    return data
+    try:
+        query, projection, limit = listing_query(request.args, app.config['ORDERS_PAGE_MAX'])
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    orders, next_cursor = find_orders(orders_collection, query, projection, limit)
+    response = Response(stream_with_context(stream_orders(orders)), mimetype='application/json')
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 @app.route("/order/<id>", methods=['GET'])
 def getOrderByBarCode(id):
-    orderNumber = barcode_images_collection.find_one({'barcode_number': id})
+    orderNumber = resolve_barcode(id)
+    if not orderNumber:
+        return jsonify({'message': 'Order not found for the given barcode number!'}), 404
     return {"order_number": orderNumber["order_number"]}
 
 @app.route("/view_barcode/<orderId>", methods=['GET'])
 def getBarcodeByOrderId(orderId):
-    return barcode_images_collection.find_one({'order_number': orderId})
+    barcode_data = barcode_images_collection.find_one({'order_number': orderId}, {'_id': 0})
+    if not barcode_data:
+        return jsonify({'message': 'Order not found!'}), 404
+
+    # Labels stored without their image are rendered on demand
+    if 'image' not in barcode_data:
+        barcode_data['image'] = cached_barcode_image(barcode_data['barcode_number'])
+
+    # The label of an order changes when its labels are generated again: cache it briefly and
+    # let clients revalidate it with an ETag of the body, answered with a 304 while it is unchanged
+    response = make_response(jsonify(barcode_data))
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['VIEW_BARCODE_MAX_AGE']
+    return response.make_conditional(request)
+
+# Too many passwords waiting to be hashed
+def busy_response():
+    response = jsonify({'message': 'Too many logins at once, try again shortly!'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+
+def rehash_password(user, password):
+    try:
+        future = password_hasher.submit_hash(password)
+    except PasswordHasherBusy:
+        # Rehashed on a later login
+        return
+    future.add_done_callback(lambda done: users_collection.update_one(
+        {'_id': user['_id'], 'password': user['password']},
+        {'$set': {'password': done.result()}}
+    ))
+
 
 # Register a new user
 @app.route('/register', methods=['POST'])
@@ -74,13 +631,19 @@ def register():
     if user_exists:
         return jsonify({'message': 'User already exists!'}), 400
 
-    hashed_password = generate_password_hash(password)
+    try:
+        hashed_password = password_hasher.hash(password)
+    except PasswordHasherBusy:
+        return busy_response()
 
-    users_collection.insert_one({
-        'username': username,
-        'password': hashed_password,
-        'created_at': datetime.utcnow()
-    })
+    try:
+        users_collection.insert_one({
+            'username': username,
+            'password': hashed_password,
+            'created_at': datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        return jsonify({'message': 'User already exists!'}), 400
 
     return jsonify({'message': 'User registered successfully!'}), 201
 
@@ -97,17 +660,26 @@ def login():
 
     user = users_collection.find_one({'username': username})
 
-    if not user or not check_password_hash(user['password'], password):
+    try:
+        valid = user is not None and password_hasher.verify(user['password'], password)
+    except PasswordHasherBusy:
+        return busy_response()
+
+    if not valid:
         return jsonify({'message': 'Invalid credentials!'}), 401
 
+    # Stored with older hash parameters: rehash in the background, unless the password changed meanwhile
+    if password_hasher.needs_rehash(user['password']):
+        rehash_password(user, password)
+
     # Generate JWT token for the session
     token = jwt.encode({
         'username': user['username'],
         'exp': datetime.utcnow() + timedelta(hours=1)
     }, app.config['SECRET_KEY'], algorithm='HS256')
 
-    # Store login activity in the logins collection
-    logins_collection.insert_one({
+    # Store login activity in the logins collection, written in the background
+    login_audit.add({
         'username': username,
         'login_time': datetime.utcnow(),
         'token': token
@@ -116,9 +688,20 @@ def login():
     return jsonify({'token': token}), 200
 
 
-# Auto-generate a 6-digit number for Sl.No.
+# Next Sl.No. from the sl_no sequence, reserved SL_NO_BLOCK_SIZE at a time
 def generate_sl_no():
-    return random.randint(100000, 999999)
+    return sl_no_sequence.next()
+
+
+# Sl.No. given between first and limit, by the sequence or at random before it existed
+def taken_sl_nos(first, limit):
+    return orders_collection.distinct('sl_no', {'sl_no': {'$gte': first, '$lt': limit}})
+
+
+# Sl.No. keep their 6 digits: the sequence runs from 100000 to 999999, skipping the numbers
+# orders already have, and submitting an order fails once it is used up
+sl_no_sequence = BlockSequence(counters_collection, 'sl_no', block_size=app.config['SL_NO_BLOCK_SIZE'],
+                               initial_value=lambda: 100000, max_value=999999, taken=taken_sl_nos)
 
 
 # Submit Order Details with size and quantity breakdown
@@ -126,105 +709,49 @@ def generate_sl_no():
 def submit_order():
     data = request.get_json()
 
-    # Extracting mandatory fields from request
-    order_number = data.get('order_number')
-    article_number = data.get('article_number')
-    color = data.get('color')
-    gender = data.get('gender')
-    shoe_type = data.get('shoe_type')
-    order_pairs = data.get('order_pairs')  # Total pairs ordered
-    oef_number = data.get('oef_number')
-    customer = data.get('customer')
-    size_type = data.get('size_type')
-    style = data.get('style')
-    fit = data.get('fit')
-    season = data.get('season')
-    delivery_date = data.get('delivery_date')
-
-    # Sizes and quantities should be a list of dictionaries, e.g., [{"size": "10", "quantity": 50}, {"size": "11", "quantity": 50}]
-    sizes_quantities = data.get('sizes_quantities')
-
-    # Check if all fields are provided
-    if not all([order_number, article_number, color, gender, shoe_type, order_pairs, oef_number, customer, size_type, style, fit, season, delivery_date, sizes_quantities]):
-        return jsonify({'message': 'All fields are mandatory!'}), 400
-
-    # Ensure that sizes_quantities is a list and validate the quantity sum
-    if not isinstance(sizes_quantities, list) or len(sizes_quantities) == 0:
-        return jsonify({'message': 'Sizes and quantities must be provided!'}), 400
-
-    total_quantity = sum([item.get('quantity', 0) for item in sizes_quantities])
-
-    # Validate that the sum of quantities for all sizes matches the total order pairs
-    if total_quantity != int(order_pairs):
-        return jsonify({'message': f'Total quantity for all sizes ({total_quantity}) does not match order pairs ({order_pairs})!'}), 400
-
-    # Ensure the order_number is 10 digits by padding with zeros if necessary
-    order_number = str(order_number).zfill(10)
+    # Same rules as the bulk import: all fields, sizes adding up to order_pairs, 10-digit order number
+    order, message = validate_order(data)
+    if message:
+        return jsonify({'message': message}), 400
 
     # Generate a unique Sl.No.
-    sl_no = generate_sl_no()
+    try:
+        sl_no = generate_sl_no()
+    except SequenceExhausted as e:
+        app.logger.error(f'Order {order["order_number"]} not submitted: {e}')
+        return jsonify({'message': 'No Sl.No. left for new orders!'}), 503
 
     # Store the order in MongoDB
     orders_collection.insert_one({
         'sl_no': sl_no,
-        'order_number': order_number,
-        'article_number': article_number,
-        'color': color,
-        'gender': gender,
-        'shoe_type': shoe_type,
-        'order_pairs': order_pairs,
-        'oef_number': oef_number,
-        'customer': customer,
-        'size_type': size_type,
-        'style': style,
-        'fit': fit,
-        'season': season,
-        'delivery_date': delivery_date,
-        'sizes_quantities': sizes_quantities,  # Store sizes and quantities here
+        **order,
         'created_at': datetime.utcnow()
     })
 
     return jsonify({'message': 'Order submitted successfully!', 'sl_no': sl_no}), 201
 
-# Generate barcode number based on order number, shoe size, and serial number
-def generate_barcode(order_number, shoe_size, serial_number):
-    # Format order_number to be 10 digits (pad with zeros)
-    order_number_formatted = str(order_number).zfill(10)
-
-    # Format shoe_size (assuming it should contribute 3 digits; you can adjust this based on your requirement)
-    shoe_size_formatted = str(int(float(shoe_size) * 10)).zfill(3)  # Example: '10.5' becomes '105'
-
-    # Format serial_number to ensure it is the correct length to fit into the total of 16 digits
-    serial_number_formatted = str(serial_number).zfill(3)  # 3 digits
-
-    # Calculate the lengths of each part and ensure they add up to 16
-    total_length = len(order_number_formatted) + len(shoe_size_formatted) + len(serial_number_formatted)
-
-    # If total length is greater than 16, trim or adjust accordingly (custom logic may be needed based on specifics)
-    if total_length > 16:
-        raise ValueError("Combined length exceeds 16 digits.")
-    
-    # Calculate how many extra digits are needed to reach 16
-    extra_digits_needed = 16 - total_length
-
-    # Create the barcode
-    barcode_number = f"{order_number_formatted}{shoe_size_formatted}{serial_number_formatted}"
-
-    # If there's space left to fill, pad with zeros
-    barcode_number += '0' * extra_digits_needed
-
-    return barcode_number[:16]  # Ensure only the first 16 digits are returned
-
+# Import a file of orders from the ERP: the request body is a JSON array (like test.json), NDJSON or CSV
+# The format is ?format=json|ndjson|csv or the Content-Type; orders are upserted by order number
+@app.route('/import_orders', methods=['POST'])
+def import_orders_route():
+    import_format = request.args.get('format') or {
+        'application/json': 'json',
+        'application/x-ndjson': 'ndjson',
+        'text/csv': 'csv',
+    }.get(request.mimetype)
+    if import_format not in IMPORT_FORMATS:
+        return jsonify({'message': f"Format must be one of {', '.join(IMPORT_FORMATS)}!"}), 400
+
+    text_stream = io.TextIOWrapper(request.stream, encoding=request.mimetype_params.get('charset', 'utf-8'), newline='')
+    try:
+        summary = import_orders(orders_collection, read_orders(text_stream, import_format), generate_sl_no,
+                                batch_size=app.config['ORDER_IMPORT_BATCH_SIZE'])
+    except SequenceExhausted as e:
+        # The batches written before are kept
+        app.logger.error(f'Order import stopped: {e}')
+        return jsonify({'message': 'No Sl.No. left for new orders!'}), 503
+    return jsonify(summary), 200 if not summary['failed'] else 207
 
-# Create barcode image
-def create_barcode_image(barcode_number):
-    barcode = Code128(barcode_number[:], writer=ImageWriter())
-    buffer = io.BytesIO()
-    barcode.write(buffer)
-    buffer.seek(0)
-    # Convert the image to base64
-    image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-    return image_base64
 # Create PDF with multiple barcode images
 def create_pdf_with_barcodes(order_number, shoe_size, total_pairs):
     buffer = io.BytesIO()
@@ -251,6 +778,33 @@ def create_pdf_with_barcodes(order_number, shoe_size, total_pairs):
     buffer.seek(0)
     return buffer
 
+# Generate and store the labels of an order with the configured batching, storage and render mode
+def order_labels(order_number, sizes_quantities, stats):
+    labels = generate_order_labels(
+        order_number, sizes_quantities, barcode_images_collection,
+        chunk_size=app.config['LABEL_INSERT_CHUNK_SIZE'],
+        workers=app.config['LABEL_RENDER_WORKERS'],
+        stats=stats,
+        store_images=app.config['STORE_BARCODE_IMAGES'],
+        # Vector labels are drawn without a bitmap
+        render_images=app.config['LABEL_RENDER_MODE'] == 'image',
+        check_digit=app.config['BARCODE_CHECK_DIGIT']
+    )
+    return warm_label_cache(order_number, labels)
+
+
+# Pass labels through, adding them to the label cache as they are generated
+def warm_label_cache(order_number, labels, chunk_size=1000):
+    generated = {}
+    for shoe_size, barcode_number, image in labels:
+        generated[barcode_number] = {'order_number': order_number, 'shoe_size': shoe_size}
+        if len(generated) >= chunk_size:
+            label_cache.warm(generated)
+            generated = {}
+        yield shoe_size, barcode_number, image
+    label_cache.warm(generated)
+
+
 # Route to generate and download barcodes as a single PDF and store barcode images in the database
 @app.route('/generate_barcode', methods=['POST'])
 def generate_barcode_route():
@@ -270,592 +824,277 @@ def generate_barcode_route():
     if not sizes_quantities or len(sizes_quantities) == 0:
         return jsonify({'message': 'No sizes found for this order!'}), 400
 
-    # Create a PDF buffer
+    # Job mode: generate in the background and let the client poll for the PDF
+    if data.get('async'):
+        job = label_job_queue.submit(order_number)
+        return jsonify(dict(
+            job_status(job),
+            status_url=f"/label_jobs/{job['_id']}",
+            download_url=f"/label_jobs/{job['_id']}/pdf"
+        )), 202
+
+    # Render the barcodes of every size in a process pool, storing the images in MongoDB in chunks
+    stats = {}
+    labels = order_labels(order_number, sizes_quantities, stats)
+
+    # Streaming mode: send each page as soon as it is full, memory stays flat whatever the order size
+    if app.config['LABEL_PDF_STREAMING']:
+        render_mode = app.config['LABEL_RENDER_MODE']
+
+        def generate_pdf():
+            yield from stream_label_pdf(labels, render_mode=render_mode)
+            app.logger.info(f"Generated {stats['labels']} labels for order {order_number} at {stats['labels_per_second']:.1f} labels/sec")
+
+        return Response(
+            stream_with_context(generate_pdf()),
+            mimetype='application/pdf',
+            headers={'Content-Disposition': f'attachment; filename=barcodes_{order_number}.pdf'}
+        ), 201
+
+    # Create a PDF buffer and lay the labels out on it
     pdf_buffer = io.BytesIO()
-    pdf = canvas.Canvas(pdf_buffer)
-
-    # Initial PDF position settings for 3 rows and 4 columns per page
-    y_position = 750  # Start Y position for the first row (adjust for each new row)
-    x_position = 70   # Start X position for the first column (adjust for each new column)
-    barcode_width = 130  # Width of each barcode image
-    barcode_height = 75  # Height of each barcode image
-    row_count = 0  # Track rows
-    col_count = 0  # Track columns
-
-    # Iterate through each size and generate barcodes
-    for size_info in sizes_quantities:
-        shoe_size = size_info.get('size')
-        total_pairs = size_info.get('quantity')  # Use quantity for that size to generate barcodes
-
-        # Generate barcodes for this size
-        for serial_number in range(1, total_pairs + 1):
-            barcode_number = generate_barcode(order_number, shoe_size, serial_number)
-
-            # Create barcode image as base64
-            barcode_img_base64 = create_barcode_image(barcode_number)
-            
-            # Store the barcode image in MongoDB
-            barcode_images_collection.insert_one({
-                'order_number': order_number,
-                'shoe_size': shoe_size,
-                'barcode_number': barcode_number,
-                'image': barcode_img_base64,  # Store base64 image
-                'serial_number': serial_number,
-                'created_at': datetime.utcnow()
-            })
-
-            # Decode the base64 image to display in PDF
-            barcode_img = io.BytesIO(base64.b64decode(barcode_img_base64))
-            image = Image.open(barcode_img)
-
-            # Draw barcode image on the PDF
-            pdf.drawInlineImage(image, x_position, y_position, width=barcode_width, height=barcode_height)
-
-            # Add text details below the barcode image
-            # pdf.setFont("Helvetica", 12)
-            # pdf.drawString(x_position, y_position - 15, f"Shoe Size: {shoe_size}")
-            # pdf.drawString(x_position, y_position - 30, f"Barcode: {barcode_number}")
-
-            # Update column count and x_position for the next barcode
-            col_count += 1
-            x_position += barcode_width + 50  # Move right for the next barcode column
-
-            # If 4 columns are filled, reset x_position and move to the next row
-            if col_count == 3:
-                x_position = 70  # Reset x_position to the first column
-                y_position -= barcode_height + 100  # Move down for the next row
-                col_count = 0  # Reset column count
-                row_count += 1  # Increase the row count
-
-            # If 3 rows are filled, create a new page
-            if row_count == 6:
-                pdf.showPage()  # Finalize the current page
-                pdf.setFont("Helvetica", 7)  # Reset font
-                y_position = 750  # Reset y_position for the new page
-                row_count = 0  # Reset row count
-
-    # Finalize and save the PDF
-    pdf.save()
+    write_label_pdf(pdf_buffer, labels, render_mode=app.config['LABEL_RENDER_MODE'])
     pdf_buffer.seek(0)
 
-    # Return the PDF as a downloadable file
-    return send_file(pdf_buffer, as_attachment=True, download_name=f"barcodes_{order_number}.pdf", mimetype='application/pdf'),201
+    # Report the generation throughput so the label printers' feed can be sized
+    app.logger.info(f"Generated {stats['labels']} labels for order {order_number} at {stats['labels_per_second']:.1f} labels/sec")
 
-# Charge route that starts a 45-minute timer based on barcode number
-@app.route('/charge', methods=['POST'])
-def charge():
-    data = request.get_json()
-    barcode_number = data.get('barcode_number')
-    user_token = request.headers.get('Authorization')
-
-    if not barcode_number:
-        return jsonify({'message': 'Barcode number is required!'}), 400
-
-    if not user_token:
-        return jsonify({'message': 'User token is required!'}), 401
-
-    # Verify JWT token to get user data
-    try:
-        decoded_token = jwt.decode(user_token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        username = decoded_token['username']
-    except jwt.ExpiredSignatureError:
-        return jsonify({'message': 'Token has expired!'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'message': 'Invalid token!'}), 401
-    
-    # Check if the barcode is already in the charges collection
-    existing_charge = charges_collection.find_one({'barcode_number': barcode_number})
-    if existing_charge:
-        return jsonify({'message': 'Barcode is already in use for an active charge!'}), 400
-    
-    # Find the order data based on the barcode number
-    order_data = barcode_images_collection.find_one({'barcode_number': barcode_number})
-
-    if not order_data:
-        return jsonify({'message': 'Order not found for the given barcode number!'}), 404
-
-    # Extract order details from the order_data
-    order_number = order_data['order_number']
-    shoe_size = order_data['shoe_size']
-
-    # Start a 45-minute timer from the current time
-    start_time = datetime.utcnow()
-    end_time = start_time + timedelta(minutes=45)
-
-    # Store the charge information in the charges collection
-    charge_data = {
-        'username': username,
-        'barcode_number': barcode_number,
-        'order_number': order_number,
-        'shoe_size': shoe_size,
-        'start_time': start_time,
-        'end_time': end_time,
-        'created_at': datetime.utcnow()
-    }
-
-    charges_collection.insert_one(charge_data)
-
-    return jsonify({
-        'message': 'Charge started successfully!',
-        'barcode_number': barcode_number,
-        'order_number': order_number,
-        'username': username,
-        'start_time': start_time.isoformat(),
-        'end_time': end_time.isoformat()
-    }), 201
-
-@app.route('/stage1', methods=['POST'])
-def stage1():
-    data = request.get_json()
-    barcode_number = data.get('barcode_number')
-    user_token = request.headers.get('Authorization')
-
-    if not barcode_number:
-        return jsonify({'message': 'Barcode number is required!'}), 400
-
-    if not user_token:
-        return jsonify({'message': 'User token is required!'}), 401
-    
-    # Verify JWT token to get user data
-    try:
-        decoded_token = jwt.decode(user_token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        username = decoded_token['username']
-    except jwt.ExpiredSignatureError:
-        return jsonify({'message': 'Token has expired!'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'message': 'Invalid token!'}), 401
-    
-    # Check if the barcode is already in the charges collection
-    existing_charge = stage1_collection.find_one({'barcode_number': barcode_number})
-    if existing_charge:
-        return jsonify({'message': 'Barcode is already in use for an active stage1!'}), 400
-
-    # Check if a completed charge exists for this barcode number
-    charge_data = charges_collection.find_one({'barcode_number': barcode_number})
-    
-    if not charge_data:
-        return jsonify({'message': 'Charge process for this barcode is not completed. Cannot proceed to Stage 1.'}), 400
-
-    # Fetch the order number from the order collection based on the barcode number
-    order_data = charges_collection.find_one({'barcode_number': barcode_number})
-
-    if not order_data:
-        return jsonify({'message': 'Order not found for the given barcode number!'}), 404
-
-    order_number = order_data['order_number']
-    shoe_size = order_data['shoe_size']
-
-    # Get the last charge entry for this barcode from charges_collection to check timing
-    last_charge = charges_collection.find_one(
-        {'barcode_number': barcode_number},
-        sort=[('created_at', pymongo.DESCENDING)]
-    )
-
-    if not last_charge:
-        return jsonify({'message': 'No previous charge record found for the barcode!'}), 404
-
-    # Calculate the elapsed time since the last charge
-    current_time = datetime.utcnow()
-    elapsed_time = current_time - last_charge['start_time']
-    delay_minutes = (elapsed_time.total_seconds() / 60) - 45  # subtract the 45-minute allowed time
-
-    # If elapsed time is over 45 minutes, mark it as delayed
-    if elapsed_time > timedelta(minutes=45):
-        delay_message = f"Delayed by {int(delay_minutes)} minutes"
-    else:
-        delay_message = "On time"
-
-    # Set up data for the new timing in stage1 collection
-    start_time = datetime.utcnow()
-    end_time = start_time + timedelta(minutes=45)
-
-    # Store this stage1 data in the stage1_collection
-    stage1_data = {
-        'username': username,
-        'barcode_number': barcode_number,
-        'order_number': order_number,
-        'shoe_size': shoe_size,
-        'stage': 1,
-        'start_time': start_time,
-        'end_time': end_time,
-        'created_at': datetime.utcnow(),
-        'delay_status': delay_message
-    }
-
-    stage1_collection.insert_one(stage1_data)
-
-    return jsonify({
-        'message': 'Stage 1 recorded successfully!',
-        'barcode_number': barcode_number,
-        'order_number': order_number,
-        'username': username,
-        'stage': 1,
-        'start_time': start_time.isoformat(),
-        'end_time': end_time.isoformat(),
-        'delay_status': delay_message
-    }), 201
-@app.route('/stage2', methods=['POST'])
-def stage2():
-    data = request.get_json()
-    barcode_number = data.get('barcode_number')
-    user_token = request.headers.get('Authorization')
-
-    if not barcode_number:
-        return jsonify({'message': 'Barcode number is required!'}), 400
-
-    if not user_token:
-        return jsonify({'message': 'User token is required!'}), 401
-    
-    # Verify JWT token to get user data
-    try:
-        decoded_token = jwt.decode(user_token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        username = decoded_token['username']
-    except jwt.ExpiredSignatureError:
-        return jsonify({'message': 'Token has expired!'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'message': 'Invalid token!'}), 401
-    
-    # Check if the barcode is already in the charges collection
-    existing_charge = stage2_collection.find_one({'barcode_number': barcode_number})
-    if existing_charge:
-        return jsonify({'message': 'Barcode is already in use for an active stage2!'}), 400
-
-    
-    #  Check if a completed charge exists for this barcode number
-    charge_data = stage1_collection.find_one({'barcode_number': barcode_number})
-        
-    if not charge_data:
-        return jsonify({'message': 'Charge process for this barcode is not completed. Cannot proceed to Stage 1.'}), 400
-
-
-    # Fetch the latest stage1 data for this barcode number
-    stage1_data = stage1_collection.find_one({'barcode_number': barcode_number}, sort=[('created_at', -1)])
-
-    if not stage1_data:
-        return jsonify({'message': 'Stage1 data not found for this barcode!'}), 404
-    shoe_size = stage1_data['shoe_size']
-
-    stage1_end_time = stage1_data['end_time']
-    current_time = datetime.utcnow()
-
-    # Check if there is a delay beyond 45 minutes from stage1 end time
-    if current_time > stage1_end_time:
-        delay_time = current_time - stage1_end_time
-        delay_message = f'Delayed by {delay_time.total_seconds() / 60:.2f} minutes'
-    else:
-        delay_message = 'On time'
-
-    # Start a new 45-minute timer for stage2
-    stage2_start_time = current_time
-    stage2_end_time = stage2_start_time + timedelta(minutes=45)
-
-    # Store this stage2 data in the stage2 collection
-    stage2_data = {
-        'username': username,
-        'barcode_number': barcode_number,
-        'order_number': stage1_data['order_number'],
-        'shoe_size':shoe_size,
-        'stage': 2,
-        'start_time': stage2_start_time,
-        'end_time': stage2_end_time,
-        'created_at': datetime.utcnow(),
-        'delay_message': delay_message
-    }
-
-    # Insert the stage2 data into the collection
-    stage2_collection.insert_one(stage2_data)
-
-    # Return the response including new stage2 timing and delay message
-    return jsonify({
-        'message': 'Stage2 submitted successfully!',
-        'barcode_number': barcode_number,
-        'order_number': stage1_data['order_number'],
-        'delay_message': delay_message,
-        'stage2_start_time': stage2_start_time.isoformat(),
-        'stage2_end_time': stage2_end_time.isoformat()
-    }), 201
-
-@app.route('/stage3', methods=['POST'])
-def stage3():
-    data = request.get_json()
-    barcode_number = data.get('barcode_number')
-    user_token = request.headers.get('Authorization')
-
-    if not barcode_number:
-        return jsonify({'message': 'Barcode number is required!'}), 400
-
-    if not user_token:
-        return jsonify({'message': 'User token is required!'}), 401
-
-    # Verify JWT token to get user data
-    try:
-        decoded_token = jwt.decode(user_token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        username = decoded_token['username']
-    except jwt.ExpiredSignatureError:
-        return jsonify({'message': 'Token has expired!'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'message': 'Invalid token!'}), 401
-    
-    # Check if the barcode is already in the charges collection
-    existing_charge = stage3_collection.find_one({'barcode_number': barcode_number})
-    if existing_charge:
-        return jsonify({'message': 'Barcode is already in use for an active stage3!'}), 400
-
-    # Check if stage2 was completed for this barcode number
-    stage2_data = stage2_collection.find_one({'barcode_number': barcode_number}, sort=[('created_at', -1)])
-
-    if not stage2_data:
-        return jsonify({'message': 'Stage2 data not found for this barcode!'}), 404
-    shoe_size = stage2_data['shoe_size']
-
-
-    # Check if there is a delay beyond the stage2 end time
-    stage2_end_time = stage2_data['end_time']
-    current_time = datetime.utcnow()
-
-    if current_time > stage2_end_time:
-        delay_time = current_time - stage2_end_time
-        delay_message = f'Delayed by {delay_time.total_seconds() / 60:.2f} minutes'
-    else:
-        delay_message = 'On time'
-
-    # Start a new 45-minute timer for stage3
-    stage3_start_time = current_time
-    stage3_end_time = stage3_start_time + timedelta(minutes=5)
-
-    # Store this stage3 data in the stage3 collection
-    stage3_data = {
-        'username': username,
-        'barcode_number': barcode_number,
-        'order_number': stage2_data['order_number'],
-        'shoe_Size':shoe_size,
-        'stage': 3,
-        'start_time': stage3_start_time,
-        'end_time': stage3_end_time,
-        'created_at': datetime.utcnow(),
-        'delay_message': delay_message
-    }
-
-    # Insert the stage3 data into the collection
-    stage3_collection.insert_one(stage3_data)
-
-    # Return the response including new stage3 timing and delay message
-    return jsonify({
-        'message': 'Stage3 submitted successfully!',
-        'barcode_number': barcode_number,
-        'order_number': stage2_data['order_number'],
-        'delay_message': delay_message,
-        'stage3_start_time': stage3_start_time.isoformat(),
-        'stage3_end_time': stage3_end_time.isoformat()
-    }), 201
-
-@app.route('/stage4', methods=['POST'])
-def stage4():
-    data = request.get_json()
-    barcode_number = data.get('barcode_number')
-    user_token = request.headers.get('Authorization')
-
-    if not barcode_number:
-        return jsonify({'message': 'Barcode number is required!'}), 400
-
-    if not user_token:
-        return jsonify({'message': 'User token is required!'}), 401
-
-    # Verify JWT token to get user data
-    try:
-        decoded_token = jwt.decode(user_token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        username = decoded_token['username']
-    except jwt.ExpiredSignatureError:
-        return jsonify({'message': 'Token has expired!'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'message': 'Invalid token!'}), 401
-    
-    # Check if the barcode is already in the charges collection
-    existing_charge = stage4_collection.find_one({'barcode_number': barcode_number})
-    if existing_charge:
-        return jsonify({'message': 'Barcode is already in use for an active stage4!'}), 400
-
-    # Check if stage3 was completed for this barcode number
-    stage3_data = stage3_collection.find_one({'barcode_number': barcode_number}, sort=[('created_at', -1)])
-
-    if not stage3_data:
-        return jsonify({'message': 'Stage3 data not found for this barcode!'}), 404
-    
-    # shoe_size = stage3_data['shoe_size']
-
-
-    # Check for delay beyond stage3 end time
-    stage3_end_time = stage3_data['end_time']
-    current_time = datetime.utcnow()
+    # Return the PDF as a downloadable file
+    response = send_file(pdf_buffer, as_attachment=True, download_name=f"barcodes_{order_number}.pdf", mimetype='application/pdf')
+    response.headers['X-Labels-Generated'] = str(stats['labels'])
+    response.headers['X-Labels-Per-Second'] = f"{stats['labels_per_second']:.1f}"
+    return response, 201
 
-    if current_time > stage3_end_time:
-        delay_time = current_time - stage3_end_time
-        delay_message = f'Delayed by {delay_time.total_seconds() / 60:.2f} minutes'
+# Generate the labels PDF of an order into the file object output for a background job
+def run_label_job(order_number, output, report_progress):
+    order = orders_collection.find_one({'order_number': order_number})
+    if not order or not order.get('sizes_quantities'):
+        raise ValueError(f'Order {order_number} not found or has no sizes')
+
+    sizes_quantities = order['sizes_quantities']
+    total = sum(size_info.get('quantity') for size_info in sizes_quantities)
+    stats = {}
+    labels = order_labels(order_number, sizes_quantities, stats)
+
+    def counted_labels():
+        for done, label in enumerate(labels, start=1):
+            yield label
+            report_progress(done, total)
+
+    if app.config['LABEL_PDF_STREAMING']:
+        for chunk in stream_label_pdf(counted_labels(), render_mode=app.config['LABEL_RENDER_MODE']):
+            output.write(chunk)
     else:
-        delay_message = 'On time'
-
-    # Start a new 45-minute timer for stage4
-    stage4_start_time = current_time
-    stage4_end_time = stage4_start_time + timedelta(minutes=45)
-
-    # Store this stage4 data in the stage4 collection
-    stage4_data = {
-        'username': username,
-        'barcode_number': barcode_number,
-        'order_number': stage3_data['order_number'],
-        # 'shoe_size':shoe_size,
-        'stage': 4,
-        'start_time': stage4_start_time,
-        'end_time': stage4_end_time,
-        'created_at': datetime.utcnow(),
-        'delay_message': delay_message
-    }
-
-    # Insert the stage4 data into the collection
-    stage4_collection.insert_one(stage4_data)
-
-    return jsonify({
-        'message': 'Stage4 submitted successfully!',
-        'barcode_number': barcode_number,
-        'order_number': stage3_data['order_number'],
-        'delay_message': delay_message,
-        'stage4_start_time': stage4_start_time.isoformat(),
-        'stage4_end_time': stage4_end_time.isoformat()
-    }), 201
-
-@app.route('/stage5', methods=['POST'])
-def stage5():
+        write_label_pdf(output, counted_labels(), render_mode=app.config['LABEL_RENDER_MODE'])
+    app.logger.info(f"Generated {stats['labels']} labels for order {order_number} at {stats['labels_per_second']:.1f} labels/sec")
+
+
+label_job_queue = LabelJobQueue(
+    label_jobs_collection, run_label_job, mongo.db, workers=app.config['LABEL_JOB_WORKERS']
+)
+
+
+# Status and progress of a background label job
+@app.route('/label_jobs/<job_id>', methods=['GET'])
+def get_label_job(job_id):
+    job = label_job_queue.get(job_id)
+    if not job:
+        return jsonify({'message': 'Job not found!'}), 404
+    return jsonify(job_status(job)), 200
+
+
+# Download the PDF of a finished label job
+@app.route('/label_jobs/<job_id>/pdf', methods=['GET'])
+def download_label_job(job_id):
+    job = label_job_queue.get(job_id)
+    if not job:
+        return jsonify({'message': 'Job not found!'}), 404
+    if job['status'] != DONE:
+        return jsonify(dict(job_status(job), message='Job is not finished yet!')), 409
+
+    pdf = label_job_queue.open_pdf(job)
+    if pdf is None:
+        return jsonify({'message': 'PDF not found, submit the order again!'}), 404
+    return send_file(pdf, as_attachment=True, download_name=f"barcodes_{job['order_number']}.pdf", mimetype='application/pdf')
+
+# Scan a barcode into a stage of the stage table (POST /charge, /stage1 ... /stage6)
+# The charge starts a 45-minute timer, each stage checks the previous one and records its own timing
+@token_required
+def scan_stage(stage):
     data = request.get_json()
     barcode_number = data.get('barcode_number')
-    user_token = request.headers.get('Authorization')
-
-    if not barcode_number:
-        return jsonify({'message': 'Barcode number is required!'}), 400
 
-    if not user_token:
-        return jsonify({'message': 'User token is required!'}), 401
-
-    # Verify JWT token to get user data
+    # A second record of the stage is refused on write by the unique barcode_number index (or by the
+    # progress document's stage condition), so only the prerequisite has to be read: one read, one write
+    unique_records = app.config['BARCODE_PROGRESS_STORAGE'] or app.config['UNIQUE_STAGE_RECORDS']
+    steps = scan_steps(stage, barcode_number, g.username, datetime.utcnow(), unique_records)
+    result = None
     try:
-        decoded_token = jwt.decode(user_token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        username = decoded_token['username']
-    except jwt.ExpiredSignatureError:
-        return jsonify({'message': 'Token has expired!'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'message': 'Invalid token!'}), 401
-    
-    # Check if the barcode is already in the charges collection
-    existing_charge = stage5_collection.find_one({'barcode_number': barcode_number})
-    if existing_charge:
-        return jsonify({'message': 'Barcode is already in use for an active stage5!'}), 400
-
-    # Check if stage4 was completed for this barcode number
-    stage4_data = stage4_collection.find_one({'barcode_number': barcode_number}, sort=[('created_at', -1)])
-
-    if not stage4_data:
-        return jsonify({'message': 'Stage4 data not found for this barcode!'}), 404
-    # shoe_size = stage4_data['shoe_size']
-
-
-    # Check for delay beyond stage4 end time
-    stage4_end_time = stage4_data['end_time']
-    current_time = datetime.utcnow()
-
-    if current_time > stage4_end_time:
-        delay_time = current_time - stage4_end_time
-        delay_message = f'Delayed by {delay_time.total_seconds() / 60:.2f} minutes'
-    else:
-        delay_message = 'On time'
-
-    # Start a new 45-minute timer for stage5
-    stage5_start_time = current_time
-    stage5_end_time = stage5_start_time + timedelta(minutes=45)
-
-    # Store this stage5 data in the stage5 collection
-    stage5_data = {
-        'username': username,
-        'barcode_number': barcode_number,
-        'order_number': stage4_data['order_number'],
-        # "shoe_size":shoe_size,
-        'stage': 5,
-        'start_time': stage5_start_time,
-        'end_time': stage5_end_time,
-        'created_at': datetime.utcnow(),
-        'delay_message': delay_message
-    }
-
-    # Insert the stage5 data into the collection
-    stage5_collection.insert_one(stage5_data)
-
-    return jsonify({
-        'message': 'Stage5 submitted successfully!',
-        'barcode_number': barcode_number,
-        'order_number': stage4_data['order_number'],
-        'delay_message': delay_message,
-        'stage5_start_time': stage5_start_time.isoformat(),
-        'stage5_end_time': stage5_end_time.isoformat()
-    }), 201
-@app.route('/stage6', methods=['POST'])
-def stage6():
-    # Retrieve barcode_number and user_token from the request
+        while True:
+            operation = steps.send(result)
+            if operation[0] == 'load':
+                result = load_stage_events(barcode_number, operation[1])[0]
+            elif operation[0] == 'resolve':
+                result = resolve_barcode(barcode_number)
+            elif operation[0] == 'save':
+                result = save_stage_event(stage.number, operation[1])
+            else:
+                document = operation[1]
+                count_stage_records([(stage.number, document)])
+                wip_board.advance(document['order_number'], barcode_number, stage.number)
+                result = None
+    except StopIteration as done:
+        body, status = done.value
+    return jsonify(body), status
+
+
+for _stage in STAGES:
+    app.add_url_rule(f'/{_stage.name}', _stage.name, partial(scan_stage, _stage), methods=['POST'])
+
+# Apply a batch of scans, e.g. queued by offline handhelds: {"events": [{"barcode_number", "stage", "scanned_at"}]}
+# stage is 'charge' or 'stage1'..'stage6'; each event gets the response its single-scan route would return
+@app.route('/scan_batch', methods=['POST'])
+@token_required
+def scan_batch():
     data = request.get_json()
-    barcode_number = data.get('barcode_number')
-    user_token = request.headers.get('Authorization')
+    events = data.get('events') if isinstance(data, dict) else data
 
-    if not barcode_number:
-        return jsonify({'message': 'Barcode number is required!'}), 400
-
-    if not user_token:
-        return jsonify({'message': 'User token is required!'}), 401
-
-    # Verify JWT token to get user data
-    try:
-        decoded_token = jwt.decode(user_token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        username = decoded_token['username']
-    except jwt.ExpiredSignatureError:
-        return jsonify({'message': 'Token has expired!'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'message': 'Invalid token!'}), 401
-    
-    # Check if the barcode is already in the charges collection
-    existing_charge = stage6_collection.find_one({'barcode_number': barcode_number})
-    if existing_charge:
-        return jsonify({'message': 'Barcode is already in use for an active stage6!'}), 400
+    if not isinstance(events, list) or len(events) == 0:
+        return jsonify({'message': 'Events are required!'}), 400
 
-    # Retrieve stage5 data for the given barcode_number
-    stage5_data = stage5_collection.find_one({'barcode_number': barcode_number}, sort=[('created_at', -1)])
+    if len(events) > app.config['SCAN_BATCH_MAX_EVENTS']:
+        return jsonify({'message': f"At most {app.config['SCAN_BATCH_MAX_EVENTS']} events per batch!"}), 413
 
-    if not stage5_data:
-        return jsonify({'message': 'Stage5 data not found for this barcode!'}), 404
+    # Count the records the batch managed to write
+    def save_documents(planned):
+        failed = save_stage_events_bulk(planned)
+        count_stage_records([(stage, document) for index, stage, document, _ in planned if index not in failed])
+        return failed
 
-    # Get the end time of Stage5 and calculate the start time for Stage6 (15 minutes after Stage5 ends)
-    stage5_end_time = stage5_data['end_time']
-    stage6_start_time = stage5_end_time + timedelta(minutes=15)
-    stage6_end_time = stage6_start_time + timedelta(minutes=45)
-
-    # Store Stage6 data in the stage6 collection
-    stage6_data = {
-        'username': username,
-        'barcode_number': barcode_number,
-        'order_number': stage5_data['order_number'],
-        # 'shoe_size': stage5_data['shoe_size'],
-        'stage': 6,
-        'start_time': stage6_start_time,
-        'end_time': stage6_end_time,
-        'created_at': datetime.utcnow(),
-        'delay_message': 'On time'  # Assuming no delay calculation for Stage 6
-    }
-
-    # Insert Stage6 data into the collection
-    stage6_collection.insert_one(stage6_data)
-
-    return jsonify({
-        'message': 'Stage6 submitted successfully!',
-        'barcode_number': barcode_number,
-        'order_number': stage5_data['order_number'],
-        'stage6_start_time': stage6_start_time.isoformat(),
-        'stage6_end_time': stage6_end_time.isoformat()
-    }), 201
+    results = process_scan_batch(
+        events, g.username, datetime.utcnow(),
+        load_records=load_stage_events_bulk,
+        resolve_labels=resolve_barcodes,
+        save_documents=save_documents
+    )
+    for result in results:
+        if result['status'] == 201:
+            wip_board.advance(result['response']['order_number'], result['barcode_number'], get_stage(result['stage']).number)
+    return jsonify({'results': results}), 200
+
+# Hit rates of the label cache tiers
+@app.route('/label_cache_stats', methods=['GET'])
+def label_cache_stats():
+    return jsonify(label_cache.stats()), 200
+
+# Hit rate of the verified token cache and the time spent verifying tokens it did not hold
+@app.route('/token_cache_stats', methods=['GET'])
+def token_cache_stats():
+    return jsonify(token_cache.stats()), 200
+
+# Current stage of every charged barcode of an order, read once when its board is first opened
+def load_wip_stages(order_number):
+    if app.config['BARCODE_PROGRESS_STORAGE']:
+        return {doc['barcode_number']: doc['current_stage'] for doc in barcode_progress_collection.find(
+            {'order_number': order_number}, {'_id': 0, 'barcode_number': 1, 'current_stage': 1})}
+
+    stages = {}
+    for stage, collection in enumerate(event_collections):
+        for doc in collection.find({'order_number': order_number}, {'_id': 0, 'barcode_number': 1}):
+            stages[doc['barcode_number']] = stage
+    return stages
+
+
+wip_board = WipBoard(load_wip_stages)
+wip_feed_lock = threading.Lock()
+wip_feed_stop = None
+
+
+wip_streams_lock = threading.Lock()
+wip_streams = 0
+
+
+# Start following the change stream (or polling) on first use, so the thread runs in the serving process
+def start_wip_feed():
+    global wip_feed_stop
+    if not app.config['WIP_CHANGE_STREAM'] and not app.config['WIP_POLL_SECONDS']:
+        return
+    with wip_feed_lock:
+        if wip_feed_stop:
+            return
+        wip_feed_stop = threading.Event()
+        if app.config['WIP_CHANGE_STREAM']:
+            stage_numbers = {stage.collection: stage.number for stage in STAGES}
+            threading.Thread(
+                target=watch_changes, name='wip-change-stream', daemon=True,
+                args=(mongo.db, wip_board, stage_numbers, barcode_progress_collection.name, wip_feed_stop)
+            ).start()
+        else:
+            threading.Thread(
+                target=poll_changes, name='wip-poll', daemon=True,
+                args=(wip_board, wip_feed_stop, app.config['WIP_POLL_SECONDS'])
+            ).start()
+
+
+# Take one of the WIP_MAX_STREAMS stream slots of the process, False if they are all taken
+def open_wip_stream():
+    global wip_streams
+    with wip_streams_lock:
+        if wip_streams >= app.config['WIP_MAX_STREAMS']:
+            return False
+        wip_streams += 1
+        return True
+
+
+def close_wip_stream():
+    global wip_streams
+    with wip_streams_lock:
+        wip_streams -= 1
+
+
+def sse_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+# Live WIP counts of an order as server-sent events: a 'snapshot' event with the pairs at each stage,
+# then a 'transition' event with the updated counts whenever a barcode of the order moves on
+@app.route('/wip/<orderNumber>/events', methods=['GET'])
+def wip_events(orderNumber):
+    start_wip_feed()
+    if not open_wip_stream():
+        response = jsonify({'message': 'Too many live boards open, try again shortly!'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+
+    # Subscribed only once the response is streamed, so a response that is never iterated
+    # (the client went away first) leaves no subscriber behind
+    def events():
+        subscriber = wip_board.subscribe(orderNumber)
+        try:
+            yield sse_event('snapshot', {'order_number': orderNumber, 'counts': wip_board.snapshot(orderNumber)})
+            while True:
+                try:
+                    event = subscriber.events.get(timeout=app.config['WIP_HEARTBEAT_SECONDS'])
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if subscriber.resync:
+                    # Events were dropped while the client was behind, start again from the current counts
+                    subscriber.resync = False
+                    while not subscriber.events.empty():
+                        subscriber.events.get_nowait()
+                    yield sse_event('snapshot', {'order_number': orderNumber, 'counts': wip_board.snapshot(orderNumber)})
+                    continue
+                yield sse_event('transition', event)
+        finally:
+            wip_board.unsubscribe(subscriber)
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    # The slot is given back when the server closes the response, iterated or not
+    response.call_on_close(close_wip_stream)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/report/<orderNumber>', methods=['GET'])
 def report(orderNumber):
@@ -869,78 +1108,14 @@ def report(orderNumber):
     if not order_data or 'sizes_quantities' not in order_data:
         return jsonify({'message': 'Order not found or missing sizes_quantities!'}), 404
     
-    # Initialize response structure based on sizes
-    report_data = {}
-    total_data = {
-        'total_quantity': 0,
-        'total_completed_charge': 0,
-        'total_pending_charge': 0,
-        'total_stage1_completed': 0,
-        'total_stage1_pending': 0,
-        'total_stage2_completed': 0,
-        'total_stage2_pending': 0,
-        'total_stage3_completed': 0,
-        'total_stage3_pending': 0,
-        'total_stage4_completed': 0,
-        'total_stage4_pending': 0,
-        'total_stage5_completed': 0,
-        'total_stage5_pending': 0,
-        'total_stage6_completed': 0,
-        'total_stage6_pending': 0,
-    }
-    
-    for item in order_data['sizes_quantities']:
-        size = item['size']
-        quantity = item['quantity']
-        report_data[size] = {
-            'quantity': quantity,
-            'completed_charge_count': 0,
-            'pending_charge_count': 0,
-            'stage_completion_counts': {
-                'stage1': {'completed': 0, 'pending': 0},
-                'stage2': {'completed': 0, 'pending': 0},
-                'stage3': {'completed': 0, 'pending': 0},
-                'stage4': {'completed': 0, 'pending': 0},
-                'stage5': {'completed': 0, 'pending': 0},
-                'stage6': {'completed': 0, 'pending': 0}
-            }
-        }
-        total_data['total_quantity'] += quantity
-    
-    # Helper function to check if barcode exists in a stage
-    def barcode_exists_in_stage(barcode_number, collection):
-        return collection.find_one({'barcode_number': barcode_number, 'order_number': order_number}) is not None
-    
-    # Retrieve all barcodes for the order from charge collection
-    charge_entries = charges_collection.find({'order_number': order_number})
-    
-    for charge_entry in charge_entries:
-        barcode_number = charge_entry['barcode_number']
-        shoe_size = charge_entry['shoe_size']
-        
-        if shoe_size not in report_data:
-            continue
-        
-        # Charge Stage
-        if barcode_exists_in_stage(barcode_number, stage1_collection):
-            report_data[shoe_size]['completed_charge_count'] += 1
-            total_data['total_completed_charge'] += 1
-        else:
-            report_data[shoe_size]['pending_charge_count'] += 1
-            total_data['total_pending_charge'] += 1
-        
-        # Stage Completion Checks
-        for stage_num in range(1, 6):
-            current_stage = f"stage{stage_num}_collection"
-            next_stage = f"stage{stage_num + 1}_collection"
-            
-            if barcode_exists_in_stage(barcode_number, globals()[current_stage]):
-                if barcode_exists_in_stage(barcode_number, globals()[next_stage]):
-                    report_data[shoe_size]['stage_completion_counts'][f'stage{stage_num}']['completed'] += 1
-                    total_data[f'total_stage{stage_num}_completed'] += 1
-                else:
-                    report_data[shoe_size]['stage_completion_counts'][f'stage{stage_num}']['pending'] += 1
-                    total_data[f'total_stage{stage_num}_pending'] += 1
+    if app.config['ORDER_PROGRESS_COUNTERS']:
+        # A single read of the order's counters
+        counts = order_progress.load_counts(order_progress_collection, order_number)
+        report_data, total_data = order_progress.report_from_counts(order_data['sizes_quantities'], counts)
+    else:
+        # Count every charged pair with one query per collection
+        charge_entries, stage_sets = order_report_inputs(order_number)
+        report_data, total_data = build_report(order_data['sizes_quantities'], charge_entries, stage_sets)
 
     # Adding the total counts to the response
     return jsonify({
@@ -948,6 +1123,8 @@ def report(orderNumber):
         'sizes': report_data,
         'total_summary': total_data
     }), 200
+# Barcodes of an order, streamed from the cursor as a JSON array (default), NDJSON or CSV
+# Pick the format with ?format=json|ndjson|csv or the Accept header; gzip-compressed when the client accepts it
 @app.route('/view/<orderNumber>', methods=['GET'])
 def view_data(orderNumber):
     # Get the order number from query parameters
@@ -956,24 +1133,33 @@ def view_data(orderNumber):
     if not order_number:
         return jsonify({"error": "Order number is required"}), 400
 
+    export_format = negotiate_format(request.args.get('format'), request.accept_mimetypes)
+    if not export_format:
+        return jsonify({"error": f"Format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+
     try:
         # Query the collection to find all documents with the given order number
-        documents = list(
-            barcode_images_collection.find(
-                {"order_number": order_number},
-                {"_id": 0, "barcode_number": 1, "shoe_size": 1}  # Project only the required fields
-            )
-        )
-        
-        if not documents:
+        documents = barcode_images_collection.find(
+            {"order_number": order_number},
+            {"_id": 0, "barcode_number": 1, "shoe_size": 1}  # Project only the required fields
+        ).batch_size(app.config['VIEW_BATCH_SIZE'])
+
+        first = next(documents, None)
+        if first is None:
             return jsonify({"error": "No data found for the given order number"}), 404
-        
-        # Return all matching documents with selected fields
-        return jsonify(documents), 200
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+    chunks = export_chunks(itertools.chain([first], documents), export_format)
+    headers = {'Vary': 'Accept-Encoding'}
+    if export_format == 'csv':
+        headers['Content-Disposition'] = f'attachment; filename=barcodes_{order_number}.csv'
+    if 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format], headers=headers)
 
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,181 @@
+# Index management
+#
+# Declares the indexes every hot lookup relies on, creates them idempotently
+# (create_indexes is a no-op for indexes that already exist) and checks with
+# explain() that none of the hot queries still falls back to a COLLSCAN.
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from stages import STAGES
+
+# Collections of the charge and every stage
+EVENT_COLLECTIONS = [stage.collection for stage in STAGES]
+
+
+# A barcode can only be charged / enter a stage once, the routes already refuse duplicates
+def _event_indexes():
+    return [
+        IndexModel([('barcode_number', ASCENDING)], unique=True, name='barcode_number_unique'),
+        IndexModel([('order_number', ASCENDING), ('barcode_number', ASCENDING)], name='order_number_barcode_number'),
+    ]
+
+
+# TTL index expiring old login activity, see ensure_login_retention
+LOGIN_TTL_INDEX = 'login_time_ttl'
+
+
+# Required indexes per collection
+REQUIRED_INDEXES = {
+    'users': [
+        IndexModel([('username', ASCENDING)], unique=True, name='username_unique'),
+    ],
+    'logins': [
+        IndexModel([('username', ASCENDING), ('login_time', DESCENDING)], name='username_login_time'),
+    ],
+    'orders': [
+        # Not unique: submit_order has never refused a repeated order number
+        IndexModel([('order_number', ASCENDING)], name='order_number'),
+        # Sl.No. already given, skipped by the sl_no sequence
+        IndexModel([('sl_no', DESCENDING)], name='sl_no'),
+        # Keyset pages of /orders, alone or filtered by customer or season
+        IndexModel([('created_at', ASCENDING), ('_id', ASCENDING)], name='created_at_id'),
+        IndexModel([('customer', ASCENDING), ('created_at', ASCENDING), ('_id', ASCENDING)], name='customer_created_at_id'),
+        IndexModel([('season', ASCENDING), ('created_at', ASCENDING), ('_id', ASCENDING)], name='season_created_at_id'),
+    ],
+    'barcodes': [
+        IndexModel([('barcode_number', ASCENDING)], name='barcode_number'),
+    ],
+    'barcode_images': [
+        # Not unique: labels of an order can be generated more than once
+        IndexModel([('barcode_number', ASCENDING)], name='barcode_number'),
+        IndexModel([('barcode_key', ASCENDING)], sparse=True, name='barcode_key'),
+        IndexModel([('order_number', ASCENDING), ('shoe_size', ASCENDING), ('serial_number', ASCENDING)],
+                   name='order_number_shoe_size_serial_number'),
+    ],
+    'barcode_progress': [
+        IndexModel([('order_number', ASCENDING)], name='order_number'),
+    ],
+    'label_jobs': [
+        # Set only while a job is queued or running, so an order has one job in flight
+        IndexModel([('dedupe_key', ASCENDING)], unique=True, sparse=True, name='dedupe_key_unique'),
+        IndexModel([('status', ASCENDING), ('created_at', ASCENDING)], name='status_created_at'),
+    ],
+}
+for _collection_name in EVENT_COLLECTIONS:
+    REQUIRED_INDEXES[_collection_name] = _event_indexes()
+
+
+# Hot queries checked by verify_query_plans: (collection, filter, sort)
+HOT_QUERIES = [
+    ('barcode_images', {'barcode_number': ''}, None),
+    ('barcode_images', {'barcode_key': 0}, None),
+    ('barcode_images', {'order_number': ''}, None),
+    ('orders', {'order_number': ''}, None),
+    ('orders', {}, [('created_at', ASCENDING), ('_id', ASCENDING)]),
+    ('orders', {'customer': ''}, [('created_at', ASCENDING), ('_id', ASCENDING)]),
+    ('users', {'username': ''}, None),
+    ('barcode_progress', {'order_number': ''}, None),
+    ('label_jobs', {'status': 'queued'}, [('created_at', ASCENDING)]),
+]
+for _collection_name in EVENT_COLLECTIONS:
+    HOT_QUERIES += [
+        (_collection_name, {'barcode_number': ''}, [('created_at', DESCENDING)]),
+        (_collection_name, {'barcode_number': '', 'order_number': ''}, None),
+        (_collection_name, {'order_number': ''}, None),
+    ]
+
+
+# Create every required index, raises RuntimeError listing the ones that could not be built,
+# or with strict=False returns that list
+def ensure_indexes(db, strict=True):
+    failures = []
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        for index in indexes:
+            try:
+                db[collection_name].create_indexes([index])
+            except OperationFailure as e:
+                # Typically duplicates left in the collection that block a unique index
+                failures.append(f"{collection_name}.{index.document['name']}: {e}")
+
+    if failures and strict:
+        raise RuntimeError('Could not create indexes:\n' + '\n'.join(failures))
+    return failures
+
+
+# Whether every charge/stage collection refuses a second record of a barcode
+def unique_event_indexes(db):
+    return all('barcode_number_unique' in db[collection_name].index_information()
+               for collection_name in EVENT_COLLECTIONS)
+
+
+# Remove the repeated records of a barcode from the charge/stage collections, which block their
+# unique barcode_number index: the earliest record is kept, the others are moved to stage_duplicates
+# Returns {collection name: records moved}, with dry_run=True only counts them
+def dedupe_event_records(db, dry_run=False):
+    moved = {}
+    for collection_name in EVENT_COLLECTIONS:
+        collection = db[collection_name]
+        duplicates = collection.aggregate([
+            {'$sort': {'barcode_number': ASCENDING, 'created_at': ASCENDING, '_id': ASCENDING}},
+            {'$group': {'_id': '$barcode_number', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+        ], allowDiskUse=True)
+        count = 0
+        for group in duplicates:
+            extra_ids = group['ids'][1:]
+            count += len(extra_ids)
+            if dry_run:
+                continue
+            records = list(collection.find({'_id': {'$in': extra_ids}}))
+            db['stage_duplicates'].insert_many([
+                {'collection': collection_name, 'record': record} for record in records
+            ])
+            collection.delete_many({'_id': {'$in': extra_ids}})
+        moved[collection_name] = count
+    return moved
+
+
+# Expire login activity retention_days after login_time with a TTL index, or keep it forever if None
+def ensure_login_retention(db, retention_days):
+    logins = db['logins']
+    current = logins.index_information().get(LOGIN_TTL_INDEX)
+
+    if not retention_days:
+        if current:
+            logins.drop_index(LOGIN_TTL_INDEX)
+        return
+
+    expire_after = int(retention_days * 24 * 60 * 60)
+    if not current:
+        logins.create_indexes([IndexModel([('login_time', ASCENDING)], expireAfterSeconds=expire_after, name=LOGIN_TTL_INDEX)])
+    elif current.get('expireAfterSeconds') != expire_after:
+        # The retention changed, update the existing index in place
+        db.command('collMod', 'logins', index={'name': LOGIN_TTL_INDEX, 'expireAfterSeconds': expire_after})
+
+
+# Collect the stage names of a query plan tree
+def _plan_stages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+
+# Run explain() on every hot query and raise RuntimeError if any of them scans a whole collection
+def verify_query_plans(db):
+    collection_scans = []
+    for collection_name, query, sort in HOT_QUERIES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in _plan_stages(winning_plan):
+            collection_scans.append(f'{collection_name} {query} sort={sort}')
+
+    if collection_scans:
+        raise RuntimeError('Hot queries doing a collection scan:\n' + '\n'.join(collection_scans))
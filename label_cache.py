@@ -0,0 +1,202 @@
+# Read-through cache of barcode labels
+#
+# The charge, /order/<id> and /scan_batch resolve a scanned barcode to the
+# order number and shoe size of its label. A label never changes once
+# generated, so resolved labels are kept in a size-bounded LRU in each
+# process and, optionally, in a SQLite file shared by the worker processes of
+# a host, and only barcodes found in neither are read from the database.
+# Unknown barcodes are not cached: their labels may be generated later.
+#
+# generate_barcode warms both tiers with the labels it writes, so the first
+# scan of a new label does not reach the database either.
+#
+# The shared tier is only a cache: when SQLite fails (database locked past the
+# busy timeout, unwritable path...) the error is counted and the lookup falls
+# through to the database.
+
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class SharedLabelStore:
+    # SQLite file shared by the processes of a host, e.g. under /dev/shm
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # SQLite errors met, the failed operation is treated as a miss / skipped
+        self.errors = 0
+        self.last_error = None
+        try:
+            connection = self._connection()
+            connection.execute('CREATE TABLE IF NOT EXISTS labels '
+                               '(barcode_number TEXT PRIMARY KEY, order_number TEXT, shoe_size TEXT)')
+            connection.commit()
+        except sqlite3.Error as e:
+            self._failed(e)
+
+    def _failed(self, error):
+        with self._lock:
+            self.errors += 1
+            self.last_error = str(error)
+        # Start from a new connection next time
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except sqlite3.Error:
+                pass
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            self._local.connection = connection
+        return connection
+
+    # Labels found in the file, those that could be read before an error
+    def get_many(self, barcode_numbers):
+        labels = {}
+        barcode_numbers = list(barcode_numbers)
+        try:
+            connection = self._connection()
+            # Stay under SQLite's limit of bound parameters
+            for start in range(0, len(barcode_numbers), 500):
+                chunk = barcode_numbers[start:start + 500]
+                rows = connection.execute(
+                    f"SELECT barcode_number, order_number, shoe_size FROM labels "
+                    f"WHERE barcode_number IN ({','.join('?' * len(chunk))})", chunk
+                )
+                for barcode_number, order_number, shoe_size in rows:
+                    labels[barcode_number] = {'order_number': order_number, 'shoe_size': shoe_size}
+        except sqlite3.Error as e:
+            self._failed(e)
+        return labels
+
+    # Returns False if the labels could not be written
+    def put_many(self, labels):
+        try:
+            connection = self._connection()
+            connection.executemany(
+                'INSERT OR REPLACE INTO labels VALUES (?, ?, ?)',
+                [(barcode_number, label['order_number'], label['shoe_size']) for barcode_number, label in labels.items()]
+            )
+            connection.commit()
+        except sqlite3.Error as e:
+            self._failed(e)
+            return False
+        return True
+
+
+class LabelCache:
+    def __init__(self, max_size=100000, shared=None):
+        self.max_size = max_size
+        self.shared = shared
+        # barcode_number -> {'order_number', 'shoe_size'}, least recently used first
+        self._labels = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _remember(self, labels):
+        with self._lock:
+            for barcode_number, label in labels.items():
+                self._labels[barcode_number] = label
+                self._labels.move_to_end(barcode_number)
+            while len(self._labels) > self.max_size:
+                self._labels.popitem(last=False)
+
+    # Labels held in this process, and the barcodes that are not
+    def _process_tier(self, barcode_numbers):
+        labels = {}
+        missing = []
+        with self._lock:
+            for barcode_number in barcode_numbers:
+                label = self._labels.get(barcode_number)
+                if label is None:
+                    missing.append(barcode_number)
+                else:
+                    self._labels.move_to_end(barcode_number)
+                    labels[barcode_number] = label
+            self.hits += len(labels)
+        return labels, missing
+
+    def _shared_tier(self, missing):
+        shared_labels = self.shared.get_many(missing)
+        if shared_labels:
+            self._remember(shared_labels)
+            with self._lock:
+                self.shared_hits += len(shared_labels)
+        return shared_labels
+
+    def _loaded(self, missing, loaded):
+        with self._lock:
+            self.misses += len(missing)
+        return {barcode_number: {'order_number': label['order_number'], 'shoe_size': label['shoe_size']}
+                for barcode_number, label in loaded.items()}
+
+    # Labels of many barcodes: {barcode_number: {'order_number', 'shoe_size'}}, unknown barcodes left out
+    #   load(barcode_numbers) reads the missing ones from the database in the same shape
+    def get_many(self, barcode_numbers, load):
+        labels, missing = self._process_tier(barcode_numbers)
+
+        if missing and self.shared:
+            labels.update(self._shared_tier(missing))
+            missing = [barcode_number for barcode_number in missing if barcode_number not in labels]
+
+        if missing:
+            loaded = self._loaded(missing, load(missing))
+            self.warm(loaded)
+            labels.update(loaded)
+
+        return {barcode_number: dict(label) for barcode_number, label in labels.items()}
+
+    # get_many for asyncio callers: load is a coroutine function, and the shared tier is read
+    # and written on a thread, so SQLite's busy timeout never blocks the event loop
+    async def get_many_async(self, barcode_numbers, load):
+        labels, missing = self._process_tier(barcode_numbers)
+
+        if missing and self.shared:
+            labels.update(await asyncio.to_thread(self._shared_tier, missing))
+            missing = [barcode_number for barcode_number in missing if barcode_number not in labels]
+
+        if missing:
+            loaded = self._loaded(missing, await load(missing))
+            if loaded:
+                self._remember(loaded)
+                if self.shared:
+                    await asyncio.to_thread(self.shared.put_many, loaded)
+            labels.update(loaded)
+
+        return {barcode_number: dict(label) for barcode_number, label in labels.items()}
+
+    def get(self, barcode_number, load):
+        return self.get_many([barcode_number], load).get(barcode_number)
+
+    # Add labels known to exist, e.g. just generated
+    def warm(self, labels):
+        if not labels:
+            return
+        self._remember(labels)
+        if self.shared:
+            self.shared.put_many(labels)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'size': len(self._labels),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+                'shared_errors': self.shared.errors if self.shared else 0,
+                'shared_last_error': self.shared.last_error if self.shared else None
+            }
@@ -0,0 +1,264 @@
+# Batched label generation for /generate_barcode
+#
+# Barcode images are rendered in a process pool and the barcode_images
+# documents are written with unordered insert_many in chunks, instead of one
+# render and one insert_one per pair on the request thread. The render helpers
+# live here (not in index.py) so the pool workers can import them.
+#
+# The pool is started once per process, on first use, and shared by every
+# request. Its workers are started with 'forkserver' (or 'spawn' where there is
+# no forkserver) rather than forked from the server process, whose threads and
+# MongoClient cannot safely be copied by a fork. Those start methods import
+# the main module of the server in the pool, so start the server with serve.py
+# (not python index.py) in production. Under several server worker processes,
+# size the pool so workers x pool size stays within the host's cores.
+
+import base64
+import io
+import atexit
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from barcode import Code128
+from barcode.writer import ImageWriter
+from reportlab.graphics.barcode.code128 import Code128 as VectorCode128
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+import barcode_codec
+
+# Below this many labels the pool start-up costs more than it saves
+MIN_PARALLEL_LABELS = 200
+
+# How labels are drawn on the PDF: 'image' places the rendered PNG, 'vector' draws the bars directly
+RENDER_MODES = ('image', 'vector')
+# Font size of the human readable number under vector barcodes
+LABEL_FONT_SIZE = 9
+# Size of a label on the sheet
+LABEL_WIDTH = 130
+LABEL_HEIGHT = 75
+
+
+# Generate barcode number based on order number, shoe size, and serial number
+def generate_barcode(order_number, shoe_size, serial_number):
+    # Format order_number to be 10 digits (pad with zeros)
+    order_number_formatted = str(order_number).zfill(10)
+
+    # Format shoe_size (assuming it should contribute 3 digits; you can adjust this based on your requirement)
+    shoe_size_formatted = str(int(float(shoe_size) * 10)).zfill(3)  # Example: '10.5' becomes '105'
+
+    # Format serial_number to ensure it is the correct length to fit into the total of 16 digits
+    serial_number_formatted = str(serial_number).zfill(3)  # 3 digits
+
+    # Calculate the lengths of each part and ensure they add up to 16
+    total_length = len(order_number_formatted) + len(shoe_size_formatted) + len(serial_number_formatted)
+
+    # If total length is greater than 16, trim or adjust accordingly (custom logic may be needed based on specifics)
+    if total_length > 16:
+        raise ValueError("Combined length exceeds 16 digits.")
+
+    # Calculate how many extra digits are needed to reach 16
+    extra_digits_needed = 16 - total_length
+
+    # Create the barcode
+    barcode_number = f"{order_number_formatted}{shoe_size_formatted}{serial_number_formatted}"
+
+    # If there's space left to fill, pad with zeros
+    barcode_number += '0' * extra_digits_needed
+
+    return barcode_number[:16]  # Ensure only the first 16 digits are returned
+
+
+# Create barcode image
+def create_barcode_image(barcode_number):
+    barcode = Code128(barcode_number[:], writer=ImageWriter())
+    buffer = io.BytesIO()
+    barcode.write(buffer)
+    buffer.seek(0)
+    # Convert the image to base64
+    image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return image_base64
+
+
+# List the labels of an order as (shoe_size, serial_number, barcode_number), in print order
+# With check_digit=True numeric barcodes get a trailing check digit (see barcode_codec)
+def order_label_specs(order_number, sizes_quantities, check_digit=False):
+    specs = []
+    for size_info in sizes_quantities:
+        shoe_size = size_info.get('size')
+        total_pairs = size_info.get('quantity')  # Use quantity for that size to generate barcodes
+        for serial_number in range(1, total_pairs + 1):
+            barcode_number = generate_barcode(order_number, shoe_size, serial_number)
+            if check_digit and barcode_number.isdigit():
+                barcode_number = barcode_codec.add_check_digit(barcode_number)
+            specs.append((shoe_size, serial_number, barcode_number))
+    return specs
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+# The process's render pool, started with workers processes on first use
+def render_pool(workers):
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _render_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+        return _render_pool
+
+
+def shutdown_render_pool():
+    global _render_pool
+    with _render_pool_lock:
+        pool, _render_pool = _render_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+atexit.register(shutdown_render_pool)
+
+
+# Render the barcode images, in the render pool for large batches
+def render_barcode_images(barcode_numbers, workers=None):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(barcode_numbers) < MIN_PARALLEL_LABELS:
+        yield from map(create_barcode_image, barcode_numbers)
+        return
+
+    chunksize = max(1, len(barcode_numbers) // (workers * 4))
+    try:
+        yield from render_pool(workers).map(create_barcode_image, barcode_numbers, chunksize=chunksize)
+    except BrokenProcessPool:
+        # A worker died, start a new pool for the next request
+        shutdown_render_pool()
+        raise
+
+
+# Generate and store the labels of an order
+# Yields (shoe_size, barcode_number, image_base64) in print order; the documents are
+# written to the collection in chunks of chunk_size and stats is filled with the throughput.
+# With store_images=False only the metadata is stored (images are rendered on demand), and
+# with render_images=False no image is rendered at all and None is yielded in its place.
+def generate_order_labels(order_number, sizes_quantities, collection, chunk_size=1000, workers=None, stats=None,
+                          store_images=True, render_images=True, check_digit=False):
+    started = time.perf_counter()
+    specs = order_label_specs(order_number, sizes_quantities, check_digit)
+    if render_images or store_images:
+        images = render_barcode_images([barcode_number for _, _, barcode_number in specs], workers)
+    else:
+        images = itertools.repeat(None)
+
+    batch = []
+    for (shoe_size, serial_number, barcode_number), barcode_img_base64 in zip(specs, images):
+        document = {
+            'order_number': order_number,
+            'shoe_size': shoe_size,
+            'barcode_number': barcode_number,
+            'serial_number': serial_number,
+            'created_at': datetime.utcnow()
+        }
+        barcode_key = barcode_codec.pack(barcode_number)
+        if barcode_key is not None:
+            document['barcode_key'] = barcode_key  # Packed 64-bit barcode for the index
+        if store_images:
+            document['image'] = barcode_img_base64  # Store base64 image
+        batch.append(document)
+        if len(batch) >= chunk_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+        yield shoe_size, barcode_number, barcode_img_base64
+
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+    if stats is not None:
+        elapsed = time.perf_counter() - started
+        stats['labels'] = len(specs)
+        stats['seconds'] = elapsed
+        stats['labels_per_second'] = len(specs) / elapsed if elapsed else 0.0
+
+
+# Draw a Code128 barcode as vector bars (with its number underneath) filling a width x height box at (x, y)
+def draw_barcode_vector(pdf, barcode_number, x, y, width, height):
+    # Size the bars so the symbol plus 10 modules of quiet zone on each side spans the box
+    modules = VectorCode128(barcode_number, barWidth=1, quiet=0).width + 20
+    bar_width = width / modules
+    text_height = LABEL_FONT_SIZE + 2
+
+    barcode = VectorCode128(
+        barcode_number, barWidth=bar_width, barHeight=height - text_height,
+        lquiet=10 * bar_width, rquiet=10 * bar_width,
+        humanReadable=True, fontSize=LABEL_FONT_SIZE
+    )
+    barcode.drawOn(pdf, x, y + text_height)
+
+
+# Positions of the labels on the sheet, 3 per row and 6 rows per page
+# Yields (x, y, end_of_page) for each label, end_of_page is True when the page is full after that label
+def label_layout():
+    # Initial PDF position settings for 3 rows and 4 columns per page
+    y_position = 750  # Start Y position for the first row (adjust for each new row)
+    x_position = 70   # Start X position for the first column (adjust for each new column)
+    row_count = 0  # Track rows
+    col_count = 0  # Track columns
+
+    while True:
+        label_x, label_y = x_position, y_position
+
+        # Update column count and x_position for the next barcode
+        col_count += 1
+        x_position += LABEL_WIDTH + 50  # Move right for the next barcode column
+
+        # If 4 columns are filled, reset x_position and move to the next row
+        if col_count == 3:
+            x_position = 70  # Reset x_position to the first column
+            y_position -= LABEL_HEIGHT + 100  # Move down for the next row
+            col_count = 0  # Reset column count
+            row_count += 1  # Increase the row count
+
+        # If 3 rows are filled, create a new page
+        end_of_page = row_count == 6
+        if end_of_page:
+            y_position = 750  # Reset y_position for the new page
+            row_count = 0  # Reset row count
+
+        yield label_x, label_y, end_of_page
+
+
+# Lay the labels out on a PDF written to output (a path or a file object)
+# labels is an iterable of (shoe_size, barcode_number, image_base64) as yielded by generate_order_labels,
+# the image is not used in 'vector' render mode
+def write_label_pdf(output, labels, render_mode='image'):
+    if render_mode not in RENDER_MODES:
+        raise ValueError(f"Unknown label render mode {render_mode!r}, expected one of {RENDER_MODES}")
+
+    pdf = canvas.Canvas(output)
+
+    for (shoe_size, barcode_number, barcode_img_base64), (x_position, y_position, end_of_page) in zip(labels, label_layout()):
+        if render_mode == 'vector':
+            # Draw the bars straight on the PDF, no bitmap involved
+            draw_barcode_vector(pdf, barcode_number, x_position, y_position, LABEL_WIDTH, LABEL_HEIGHT)
+        else:
+            # Decode the base64 image and draw it on the PDF, identical images are embedded once
+            barcode_img = io.BytesIO(base64.b64decode(barcode_img_base64))
+            pdf.drawImage(ImageReader(barcode_img), x_position, y_position, width=LABEL_WIDTH, height=LABEL_HEIGHT)
+
+        # Add text details below the barcode image
+        # pdf.setFont("Helvetica", 12)
+        # pdf.drawString(x_position, y_position - 15, f"Shoe Size: {shoe_size}")
+        # pdf.drawString(x_position, y_position - 30, f"Barcode: {barcode_number}")
+
+        if end_of_page:
+            pdf.showPage()  # Finalize the current page
+            pdf.setFont("Helvetica", 7)  # Reset font
+
+    # Finalize and save the PDF
+    pdf.save()
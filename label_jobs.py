@@ -0,0 +1,267 @@
+# Background label jobs for /generate_barcode
+#
+# Large orders are generated outside the request: the route enqueues a job and
+# returns its id, a background worker builds the barcodes and the PDF, and
+# the finished PDF is kept in GridFS, so any process of the deployment, on any
+# host, can serve it. Jobs are persisted in the label_jobs collection, so no
+# external broker is needed, queued jobs survive a restart and any worker
+# process of the deployment can pick them up.
+#
+#   {
+#       '_id': 'c0ffee...',             # job id
+#       'order_number': '0000012345',
+#       'dedupe_key': '0000012345',     # only while queued/running, unique
+#       'status': 'queued' | 'running' | 'done' | 'failed',
+#       'owner': 'a1b2...',             # claim of the worker running it
+#       'progress': {'done': 120, 'total': 5000},
+#       'file_id': 'c0ffee...-a1b2...', # GridFS file of the PDF once done
+#       'error': None,
+#       'created_at': ..., 'updated_at': ...
+#   }
+#
+# A running job is leased to the worker that claimed it: the worker renews
+# updated_at every HEARTBEAT_INTERVAL, and only a job whose lease ran out
+# (STALE_AFTER without a heartbeat, its worker died) is claimed again. Every
+# write of a worker is conditional on its claim, so a worker that lost its job
+# stops generating and its PDF is discarded.
+#
+# Only a queued or running job is shared by the submissions of its order: once
+# it is done, submitting the order again generates a new PDF (the labels may
+# have been generated again meanwhile), and the PDFs of the order's older jobs
+# are deleted when the new one is complete.
+
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from gridfs import GridFSBucket
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Seconds a worker sleeps before polling for jobs enqueued by other processes
+POLL_INTERVAL = 2
+# Seconds between two lease renewals of a running job
+HEARTBEAT_INTERVAL = 30
+# A running job whose lease was not renewed for this long is assumed orphaned and requeued
+STALE_AFTER = timedelta(minutes=10)
+# Labels between two progress updates of a job
+PROGRESS_EVERY = 100
+
+logger = logging.getLogger(__name__)
+
+
+# Raised in a worker whose job was claimed by another worker
+class JobLeaseLost(Exception):
+    pass
+
+
+# Public view of a job document
+def job_status(job):
+    return {
+        'job_id': job['_id'],
+        'order_number': job['order_number'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'error': job.get('error'),
+        'created_at': job['created_at'].isoformat(),
+        'updated_at': job['updated_at'].isoformat()
+    }
+
+
+class LabelJobQueue:
+    # run_job(order_number, output, report_progress) writes the PDF of an order to the file object output,
+    # calling report_progress(done, total) as labels are produced
+    # The PDFs are kept in the GridFS bucket bucket_name of db
+    def __init__(self, jobs_collection, run_job, db, bucket_name='label_pdfs', workers=1):
+        self.jobs_collection = jobs_collection
+        self.run_job = run_job
+        self.db = db
+        self.bucket_name = bucket_name
+        self._pdf_bucket = None
+        self.workers = workers
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    # GridFS bucket of the PDFs, created on first use so building the queue needs no database
+    @property
+    def pdf_bucket(self):
+        if self._pdf_bucket is None:
+            self._pdf_bucket = GridFSBucket(self.db, bucket_name=self.bucket_name)
+        return self._pdf_bucket
+
+    # Start the worker threads on first use, so they are created in the serving process
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'label-job-worker-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    # Enqueue the labels of an order, attaching to the order's queued or running job if there is one
+    def submit(self, order_number):
+        self.start()
+        now = datetime.utcnow()
+        job_id = uuid.uuid4().hex
+        # Jobs finished by earlier versions still hold their order's dedupe_key
+        self.jobs_collection.update_one({'dedupe_key': order_number, 'status': DONE}, {'$unset': {'dedupe_key': ''}})
+        try:
+            job = self.jobs_collection.find_one_and_update(
+                {'dedupe_key': order_number},
+                {'$setOnInsert': {
+                    '_id': job_id,
+                    'order_number': order_number,
+                    'status': QUEUED,
+                    'owner': None,
+                    'progress': {'done': 0, 'total': 0},
+                    'file_id': None,
+                    'error': None,
+                    'created_at': now,
+                    'updated_at': now
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Another request created the job concurrently
+            job = self.jobs_collection.find_one({'dedupe_key': order_number})
+
+        self._wakeup.set()
+        return job
+
+    def get(self, job_id):
+        self.start()
+        return self.jobs_collection.find_one({'_id': job_id})
+
+    # Readable file object of a finished job's PDF, None if it is gone
+    def open_pdf(self, job):
+        if job.get('file_id') is None:
+            return None
+        try:
+            return self.pdf_bucket.open_download_stream(job['file_id'])
+        except NoFile:
+            return None
+
+    # Atomically take the oldest queued (or orphaned running) job, leased to a new owner
+    def _claim(self):
+        now = datetime.utcnow()
+        return self.jobs_collection.find_one_and_update(
+            {'$or': [
+                {'status': QUEUED},
+                {'status': RUNNING, 'updated_at': {'$lt': now - STALE_AFTER}}
+            ]},
+            {'$set': {'status': RUNNING, 'owner': uuid.uuid4().hex, 'updated_at': now}},
+            sort=[('created_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    # Update a running job if this worker still holds it, returns False otherwise
+    def _update_owned(self, job, fields, unset=None):
+        update = {'$set': dict(fields, updated_at=datetime.utcnow())}
+        if unset:
+            update['$unset'] = unset
+        result = self.jobs_collection.update_one({'_id': job['_id'], 'status': RUNNING, 'owner': job['owner']}, update)
+        return result.matched_count == 1
+
+    # Renew the lease of a running job until stop is set, sets lost if another worker took it
+    def _heartbeat(self, job, stop, lost):
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                if not self._update_owned(job, {}):
+                    lost.set()
+                    return
+            except Exception:
+                logger.exception('Could not renew the lease of label job %s', job['_id'])
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception:
+                logger.exception('Could not claim a label job')
+                job = None
+
+            if not job:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            self._run(job)
+
+    def _run(self, job):
+        last_update = [0]
+        stop = threading.Event()
+        lost = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job, stop, lost), name='label-job-heartbeat', daemon=True).start()
+
+        def report_progress(done, total):
+            if lost.is_set():
+                raise JobLeaseLost(job['_id'])
+            if done - last_update[0] < PROGRESS_EVERY and done != total:
+                return
+            last_update[0] = done
+            if not self._update_owned(job, {'progress': {'done': done, 'total': total}}):
+                raise JobLeaseLost(job['_id'])
+
+        # Each claim writes its own file, only referenced by the job once complete,
+        # so a download never sees a half written PDF
+        file_id = f"{job['_id']}-{job['owner']}"
+        upload = self.pdf_bucket.open_upload_stream_with_id(
+            file_id, f"barcodes_{job['order_number']}.pdf", metadata={'job_id': job['_id']}
+        )
+        try:
+            started = time.perf_counter()
+            self.run_job(job['order_number'], upload, report_progress)
+            upload.close()
+            # Done, the order can be submitted again
+            if not self._update_owned(job, {'status': DONE, 'file_id': file_id, 'seconds': time.perf_counter() - started},
+                                      unset={'dedupe_key': ''}):
+                raise JobLeaseLost(job['_id'])
+        except JobLeaseLost:
+            logger.warning('Label job %s was taken over by another worker, its PDF is discarded', job['_id'])
+            self._discard(upload, file_id)
+        except Exception as e:
+            logger.exception('Label job %s failed', job['_id'])
+            self._discard(upload, file_id)
+            # Free the order so it can be submitted again
+            self._update_owned(job, {'status': FAILED, 'error': str(e)}, unset={'dedupe_key': ''})
+        else:
+            self._delete_older_pdfs(job)
+        finally:
+            stop.set()
+
+    def _discard(self, upload, file_id):
+        try:
+            if upload.closed:
+                self.pdf_bucket.delete(file_id)
+            else:
+                upload.abort()
+        except Exception:
+            logger.exception('Could not discard the PDF %s', file_id)
+
+    # Delete the PDFs of the order's jobs finished before job, superseded by its PDF
+    def _delete_older_pdfs(self, job):
+        older_jobs = self.jobs_collection.find(
+            {'order_number': job['order_number'], 'status': DONE, 'file_id': {'$ne': None},
+             '_id': {'$ne': job['_id']}, 'created_at': {'$lte': job['created_at']}},
+            {'file_id': 1}
+        )
+        for older_job in older_jobs:
+            try:
+                self.pdf_bucket.delete(older_job['file_id'])
+            except NoFile:
+                pass
+            except Exception:
+                logger.exception('Could not delete the PDF of label job %s', older_job['_id'])
+                continue
+            self.jobs_collection.update_one({'_id': older_job['_id']}, {'$set': {'file_id': None}})
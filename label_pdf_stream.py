@@ -0,0 +1,173 @@
+# Streaming label PDF writer
+#
+# ReportLab keeps the whole document in memory until save(), so the first byte
+# of a large label sheet only leaves once every label is drawn. This writer
+# emits the PDF incrementally instead: each page's objects are yielded as soon
+# as the page is full, only the object offsets (a few integers per page) are
+# kept until the cross-reference table at the end. Identical images are
+# embedded once and referenced from every page that uses them.
+#
+# The sheet uses the same layout as label_generation.write_label_pdf.
+
+import base64
+import hashlib
+import io
+import zlib
+
+from barcode import Code128
+from PIL import Image
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase.pdfmetrics import getAscent, stringWidth
+
+from label_generation import LABEL_FONT_SIZE, LABEL_HEIGHT, LABEL_WIDTH, RENDER_MODES, label_layout
+
+CATALOG_OBJECT = 1
+PAGES_OBJECT = 2
+FONT_OBJECT = 3
+
+
+def _number(value):
+    return f'{value:.4f}'.rstrip('0').rstrip('.')
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+# Content stream operators drawing a Code128 barcode as bars with its number underneath,
+# matching label_generation.draw_barcode_vector
+def vector_barcode_operators(barcode_number, x, y, width, height):
+    modules = Code128(barcode_number).build()[0]
+    # 10 modules of quiet zone on each side
+    bar_width = width / (len(modules) + 20)
+    text_height = LABEL_FONT_SIZE + 2
+    bar_bottom = y + text_height
+    bar_height = height - text_height
+
+    operators = []
+    left = x + 10 * bar_width
+    run_start = None
+    for index, module in enumerate(modules + '0'):
+        if module == '1' and run_start is None:
+            run_start = index
+        elif module == '0' and run_start is not None:
+            operators.append(f'{_number(left + run_start * bar_width)} {_number(bar_bottom)} '
+                             f'{_number((index - run_start) * bar_width)} {_number(bar_height)} re')
+            run_start = None
+    operators.append('f')
+
+    # Human readable number centred under the bars
+    font_size = LABEL_FONT_SIZE
+    text_width = stringWidth(barcode_number, 'Helvetica', font_size)
+    bars_width = len(modules) * bar_width
+    if text_width > bars_width:
+        font_size *= bars_width / text_width
+        text_width = bars_width
+    baseline = bar_bottom - 1.07 * getAscent('Helvetica') * font_size / 1000
+    operators.append(f'BT /F1 {_number(font_size)} Tf {_number(x + (width - text_width) / 2)} {_number(baseline)} Td '
+                     f'({_escape(barcode_number)}) Tj ET')
+    return operators
+
+
+class StreamingPdf:
+    def __init__(self):
+        self.offsets = {}
+        self.position = 0
+        # Object numbers 1-3 are the catalog, the page tree and the font
+        self.next_object = FONT_OBJECT + 1
+        self.page_objects = []
+        self.images = {}
+
+    def _emit(self, data):
+        self.position += len(data)
+        return data
+
+    def reserve(self):
+        number = self.next_object
+        self.next_object += 1
+        return number
+
+    def object(self, number, body, stream=None):
+        self.offsets[number] = self.position
+        data = f'{number} 0 obj\n'.encode() + body
+        if stream is not None:
+            data += b'\nstream\n' + stream + b'\nendstream'
+        data += b'\nendobj\n'
+        return self._emit(data)
+
+    def header(self):
+        return self._emit(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n') + \
+            self.object(CATALOG_OBJECT, f'<< /Type /Catalog /Pages {PAGES_OBJECT} 0 R >>'.encode()) + \
+            self.object(FONT_OBJECT, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+
+    # Embed an image once, returns (resource name, bytes to emit now)
+    def image(self, png_bytes):
+        digest = hashlib.sha1(png_bytes).digest()
+        if digest in self.images:
+            return self.images[digest], b''
+
+        image = Image.open(io.BytesIO(png_bytes)).convert('L')
+        number = self.reserve()
+        name = f'Im{number}'
+        self.images[digest] = name
+        stream = zlib.compress(image.tobytes())
+        body = (f'<< /Type /XObject /Subtype /Image /Width {image.width} /Height {image.height} '
+                f'/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode /Length {len(stream)} >>')
+        return name, self.object(number, body.encode(), stream)
+
+    def page(self, operators, image_names):
+        content = zlib.compress('\n'.join(operators).encode())
+        content_object = self.reserve()
+        page_object = self.reserve()
+        self.page_objects.append(page_object)
+
+        xobjects = ' '.join(f'/{name} {name[2:]} 0 R' for name in sorted(image_names))
+        resources = f'<< /Font << /F1 {FONT_OBJECT} 0 R >> /XObject << {xobjects} >> >>'
+        return self.object(content_object, f'<< /Length {len(content)} /Filter /FlateDecode >>'.encode(), content) + \
+            self.object(page_object, (f'<< /Type /Page /Parent {PAGES_OBJECT} 0 R '
+                                      f'/MediaBox [0 0 {_number(A4[0])} {_number(A4[1])}] '
+                                      f'/Resources {resources} /Contents {content_object} 0 R >>').encode())
+
+    def trailer(self):
+        kids = ' '.join(f'{number} 0 R' for number in self.page_objects)
+        data = self.object(PAGES_OBJECT, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.page_objects)} >>'.encode())
+
+        xref_position = self.position
+        xref = [f'xref\n0 {self.next_object}\n', '0000000000 65535 f \n']
+        for number in range(1, self.next_object):
+            xref.append(f'{self.offsets[number]:010d} 00000 n \n')
+        xref.append(f'trailer\n<< /Size {self.next_object} /Root {CATALOG_OBJECT} 0 R >>\n'
+                    f'startxref\n{xref_position}\n%%EOF\n')
+        return data + self._emit(''.join(xref).encode())
+
+
+# Yield the label PDF chunk by chunk, one page at a time
+# labels is an iterable of (shoe_size, barcode_number, image_base64) as yielded by generate_order_labels
+def stream_label_pdf(labels, render_mode='image'):
+    if render_mode not in RENDER_MODES:
+        raise ValueError(f"Unknown label render mode {render_mode!r}, expected one of {RENDER_MODES}")
+
+    pdf = StreamingPdf()
+    yield pdf.header()
+
+    operators = []
+    image_names = set()
+    for (shoe_size, barcode_number, barcode_img_base64), (x_position, y_position, end_of_page) in zip(labels, label_layout()):
+        if render_mode == 'vector':
+            operators += vector_barcode_operators(barcode_number, x_position, y_position, LABEL_WIDTH, LABEL_HEIGHT)
+        else:
+            name, data = pdf.image(base64.b64decode(barcode_img_base64))
+            if data:
+                yield data
+            image_names.add(name)
+            operators.append(f'q {LABEL_WIDTH} 0 0 {LABEL_HEIGHT} {x_position} {y_position} cm /{name} Do Q')
+
+        if end_of_page:
+            yield pdf.page(operators, image_names)
+            operators = []
+            image_names = set()
+
+    if operators or not pdf.page_objects:
+        yield pdf.page(operators, image_names)
+
+    yield pdf.trailer()
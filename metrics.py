@@ -0,0 +1,193 @@
+# Request and database instrumentation
+#
+# Every request is timed from the start of its handling to the end of its
+# response body (streamed responses included), and every MongoDB command is
+# seen by a PyMongo command listener. Commands are attributed to the request
+# that issued them through a context variable, which gives per-route query
+# counts and flags requests that issue more than n_plus_one_threshold
+# queries, the signature of a per-item query loop.
+#
+# Everything is exposed in the Prometheus text format by render(), per
+# process: with several worker processes, each one is scraped on its own.
+
+import contextvars
+import threading
+import time
+
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COMMAND_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+# Stats of the request being handled by the current thread, None outside requests
+_current_request = contextvars.ContextVar('current_request', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.commands = {}
+        self.status = None
+        self.bytes_out = 0
+        # Streamed responses are finished by stream_body, once the body is sent
+        self.streamed = False
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in labels)
+
+
+class Metrics:
+    def __init__(self, n_plus_one_threshold=20, logger=None):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.logger = logger
+        self._lock = threading.Lock()
+        # (route, method, status) -> count
+        self.requests = {}
+        # route -> Histogram
+        self.latency = {}
+        self.queries = {}
+        self.response_bytes = {}
+        self.n_plus_one = {}
+        # command name -> Histogram / failure count
+        self.commands = {}
+        self.command_failures = {}
+        # Callables returning [(metric name, type, help, labels, value)], read at render time
+        # type is 'counter' for monotonic counts (named *_total) or 'gauge'
+        self.collectors = []
+
+    def start_request(self):
+        stats = RequestStats()
+        return stats, _current_request.set(stats)
+
+    def finish_request(self, stats, token, route, method):
+        try:
+            _current_request.reset(token)
+        except ValueError:
+            # Finished in another context than it started in
+            _current_request.set(None)
+        elapsed = time.perf_counter() - stats.started
+        with self._lock:
+            key = (route, method, stats.status or 500)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.setdefault(route, Histogram(LATENCY_BUCKETS)).observe(elapsed)
+            self.queries.setdefault(route, Histogram(QUERY_BUCKETS)).observe(stats.queries)
+            self.response_bytes.setdefault(route, Histogram(BYTES_BUCKETS)).observe(stats.bytes_out)
+            if stats.queries > self.n_plus_one_threshold:
+                self.n_plus_one[route] = self.n_plus_one.get(route, 0) + 1
+
+        if stats.queries > self.n_plus_one_threshold and self.logger:
+            commands = ', '.join(f'{name}={count}' for name, count in sorted(stats.commands.items()))
+            self.logger.warning(f'{method} {route} issued {stats.queries} database commands ({commands}), '
+                                f'more than {self.n_plus_one_threshold}: N+1 query pattern?')
+
+    # Pass a streamed response body through, counting its bytes, and finish the request after its last chunk
+    def stream_body(self, stats, token, route, method, body):
+        try:
+            for chunk in body:
+                stats.bytes_out += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self.finish_request(stats, token, route, method)
+
+    def record_command(self, name, duration, failed):
+        stats = _current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.commands[name] = stats.commands.get(name, 0) + 1
+        with self._lock:
+            self.commands.setdefault(name, Histogram(COMMAND_BUCKETS)).observe(duration)
+            if failed:
+                self.command_failures[name] = self.command_failures.get(name, 0) + 1
+
+    def _histogram(self, lines, name, label, histograms):
+        for value, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{_labels([(label, value), ("le", bound)])}}} {cumulative}')
+            lines.append(f'{name}_sum{{{_labels([(label, value)])}}} {histogram.sum}')
+            lines.append(f'{name}_count{{{_labels([(label, value)])}}} {histogram.count}')
+
+    # The metrics in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self._lock:
+            lines += ['# HELP florence_requests_total Requests handled, by route, method and status',
+                      '# TYPE florence_requests_total counter']
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(f'florence_requests_total{{{_labels([("route", route), ("method", method), ("status", status)])}}} {count}')
+
+            lines += ['# HELP florence_request_duration_seconds Time from request start to the end of the response body',
+                      '# TYPE florence_request_duration_seconds histogram']
+            self._histogram(lines, 'florence_request_duration_seconds', 'route', self.latency)
+
+            lines += ['# HELP florence_request_queries Database commands issued per request',
+                      '# TYPE florence_request_queries histogram']
+            self._histogram(lines, 'florence_request_queries', 'route', self.queries)
+
+            lines += ['# HELP florence_response_bytes Response body size',
+                      '# TYPE florence_response_bytes histogram']
+            self._histogram(lines, 'florence_response_bytes', 'route', self.response_bytes)
+
+            lines += ['# HELP florence_n_plus_one_requests_total Requests issuing more database commands than the N+1 threshold',
+                      '# TYPE florence_n_plus_one_requests_total counter']
+            for route, count in sorted(self.n_plus_one.items()):
+                lines.append(f'florence_n_plus_one_requests_total{{{_labels([("route", route)])}}} {count}')
+
+            lines += ['# HELP florence_mongo_command_duration_seconds MongoDB command round trip, by command',
+                      '# TYPE florence_mongo_command_duration_seconds histogram']
+            self._histogram(lines, 'florence_mongo_command_duration_seconds', 'command', self.commands)
+
+            lines += ['# HELP florence_mongo_command_failures_total Failed MongoDB commands, by command',
+                      '# TYPE florence_mongo_command_failures_total counter']
+            for name, count in sorted(self.command_failures.items()):
+                lines.append(f'florence_mongo_command_failures_total{{{_labels([("command", name)])}}} {count}')
+
+        declared = set()
+        for collector in self.collectors:
+            for name, metric_type, help_text, labels, value in collector():
+                if name not in declared:
+                    lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+                    declared.add(name)
+                lines.append(f'{name}{{{_labels(labels)}}} {value}' if labels else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.record_command(event.command_name, event.duration_micros / 1e6, False)
+
+    def failed(self, event):
+        self.metrics.record_command(event.command_name, event.duration_micros / 1e6, True)
@@ -0,0 +1,204 @@
+# Bulk order import
+#
+# Orders exported by the ERP (a JSON array like test.json, NDJSON or CSV) are
+# read one record at a time from the file, validated with the same rules as
+# /submit_order and upserted by order number in batches with one bulk_write
+# each. A record that fails validation or its write is reported with its
+# position in the file and does not stop the import.
+#
+# CSV files have one order per row with the submit_order field names as
+# columns; sizes_quantities is either a JSON list or "size:quantity" pairs
+# separated by ';', e.g. "8:30;9:40;10:30".
+
+import csv
+import json
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+ORDER_FIELDS = ['order_number', 'article_number', 'color', 'gender', 'shoe_type', 'order_pairs', 'oef_number',
+                'customer', 'size_type', 'style', 'fit', 'season', 'delivery_date', 'sizes_quantities']
+IMPORT_FORMATS = ('json', 'ndjson', 'csv')
+
+
+# Validate an order as submitted, returns (order fields, None) or (None, error message)
+def validate_order(data):
+    if not isinstance(data, dict):
+        return None, 'Order must be an object!'
+
+    # Check if all fields are provided
+    if not all(data.get(field) for field in ORDER_FIELDS):
+        return None, 'All fields are mandatory!'
+
+    # Ensure that sizes_quantities is a list and validate the quantity sum
+    sizes_quantities = data['sizes_quantities']
+    if not isinstance(sizes_quantities, list) or len(sizes_quantities) == 0:
+        return None, 'Sizes and quantities must be provided!'
+
+    try:
+        total_quantity = sum([item.get('quantity', 0) for item in sizes_quantities])
+        order_pairs = int(data['order_pairs'])
+    except (AttributeError, TypeError, ValueError):
+        return None, 'Sizes, quantities and order pairs must be numbers!'
+
+    # Validate that the sum of quantities for all sizes matches the total order pairs
+    if total_quantity != order_pairs:
+        return None, f"Total quantity for all sizes ({total_quantity}) does not match order pairs ({data['order_pairs']})!"
+
+    order = {field: data[field] for field in ORDER_FIELDS}
+    # CSV columns are text, order_pairs is stored as a number whatever the format
+    order['order_pairs'] = order_pairs
+    # Ensure the order_number is 10 digits by padding with zeros if necessary
+    order['order_number'] = str(order['order_number']).zfill(10)
+    return order, None
+
+
+# Iterate the values of a JSON array without loading the whole file
+def _json_array(text_stream, read_size=64 * 1024):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    started = False
+    eof = False
+    while True:
+        # Skip whitespace and separators
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array of orders')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The value is cut at the end of the buffer, or malformed
+                if eof:
+                    raise ValueError('Malformed JSON array of orders')
+            else:
+                position = end
+                yield value
+                continue
+        elif eof:
+            raise ValueError('Truncated JSON array of orders')
+
+        chunk = text_stream.read(read_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def _ndjson(text_stream):
+    for line in text_stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield e
+
+
+def _sizes_quantities(value):
+    value = (value or '').strip()
+    if value.startswith('['):
+        return json.loads(value)
+    sizes_quantities = []
+    for pair in filter(None, (pair.strip() for pair in value.split(';'))):
+        size, quantity = pair.rsplit(':', 1)
+        sizes_quantities.append({'size': size.strip(), 'quantity': int(quantity)})
+    return sizes_quantities
+
+
+def _csv(text_stream):
+    for row in csv.DictReader(text_stream):
+        try:
+            row['sizes_quantities'] = _sizes_quantities(row.get('sizes_quantities'))
+        except ValueError as e:
+            yield e
+            continue
+        yield row
+
+
+# Records of an import file; records that cannot be parsed are yielded as the ValueError raised
+def read_orders(text_stream, import_format):
+    if import_format == 'json':
+        return _json_array(text_stream)
+    if import_format == 'ndjson':
+        return _ndjson(text_stream)
+    if import_format == 'csv':
+        return _csv(text_stream)
+    raise ValueError(f'Unknown import format {import_format!r}, expected one of {IMPORT_FORMATS}')
+
+
+# Import format from a file name, None if the extension is unknown
+def format_from_filename(filename):
+    extension = filename.rsplit('.', 1)[-1].lower()
+    return {'json': 'json', 'ndjson': 'ndjson', 'jsonl': 'ndjson', 'csv': 'csv'}.get(extension)
+
+
+# Upsert the orders of an import file by order number, batch_size orders per bulk_write
+#   next_sl_no() gives the Sl.No. of orders that do not exist yet
+# Returns {'inserted', 'updated', 'failed', 'errors': [{'record', 'order_number', 'message'}]}
+def import_orders(collection, records, next_sl_no, batch_size=1000):
+    summary = {'inserted': 0, 'updated': 0, 'failed': 0, 'errors': []}
+
+    def error(record, order_number, message):
+        summary['failed'] += 1
+        summary['errors'].append({'record': record, 'order_number': order_number, 'message': message})
+
+    def write(batch):
+        operations = [
+            UpdateOne(
+                {'order_number': order['order_number']},
+                {'$set': order, '$setOnInsert': {'sl_no': next_sl_no(), 'created_at': datetime.utcnow()}},
+                upsert=True
+            )
+            for _, order in batch
+        ]
+        try:
+            result = collection.bulk_write(operations, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            for write_error in details['writeErrors']:
+                record, order = batch[write_error['index']]
+                error(record, order['order_number'], write_error['errmsg'])
+        summary['inserted'] += details['nUpserted']
+        summary['updated'] += details['nMatched']
+
+    batch = []
+    # Order numbers in the batch: the writes of a batch are unordered, so a repeated order waits for the next one
+    batch_orders = set()
+    try:
+        for record, data in enumerate(records):
+            if isinstance(data, ValueError):
+                error(record, None, f'Unreadable record: {data}')
+                continue
+            order, message = validate_order(data)
+            if message:
+                order_number = data.get('order_number') if isinstance(data, dict) else None
+                error(record, order_number, message)
+                continue
+
+            if order['order_number'] in batch_orders:
+                write(batch)
+                batch = []
+                batch_orders = set()
+            batch.append((record, order))
+            batch_orders.add(order['order_number'])
+            if len(batch) >= batch_size:
+                write(batch)
+                batch = []
+                batch_orders = set()
+    except ValueError as e:
+        # The rest of the file cannot be read
+        error(None, None, str(e))
+
+    if batch:
+        write(batch)
+    return summary
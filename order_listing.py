@@ -0,0 +1,103 @@
+# Order listing
+#
+# GET /orders used to serialise the whole orders collection into one string.
+# Orders are now read in (created_at, _id) order and streamed out one by one
+# as a JSON array, optionally filtered, projected and cut into pages. Pages
+# use keyset pagination: the cursor of the next page is the (created_at, _id)
+# of the last order returned, so every page is one index range scan however
+# deep the client pages.
+
+import base64
+
+from bson import json_util
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
+SORT = [('created_at', 1), ('_id', 1)]
+# Filters accepted on the query string: parameter -> (field, operator)
+FILTERS = {
+    'customer': ('customer', '$eq'),
+    'season': ('season', '$eq'),
+    'delivery_from': ('delivery_date', '$gte'),
+    'delivery_to': ('delivery_date', '$lte'),
+}
+
+
+# Opaque cursor pointing after an order
+def encode_cursor(order):
+    value = json_util.dumps([order['created_at'], order['_id']])
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, order_id = json_util.loads(value)
+        return created_at, ObjectId(order_id)
+    except (ValueError, TypeError, InvalidId):
+        raise ValueError('Invalid cursor!')
+
+
+# Build (filter, projection, limit) from the query string arguments, raises ValueError on bad input
+#   customer, season: exact match; delivery_from / delivery_to: delivery_date range (YYYY-MM-DD)
+#   fields: comma separated fields to return; limit: page size; cursor: next page of a previous response
+def listing_query(args, max_limit):
+    query = {}
+    for parameter, (field, operator) in FILTERS.items():
+        value = args.get(parameter)
+        if value:
+            query.setdefault(field, {})[operator] = value
+
+    cursor = args.get('cursor')
+    if cursor:
+        created_at, order_id = decode_cursor(cursor)
+        query['$or'] = [
+            {'created_at': {'$gt': created_at}},
+            {'created_at': created_at, '_id': {'$gt': order_id}}
+        ]
+
+    projection = None
+    fields = args.get('fields')
+    if fields:
+        # created_at and _id are always returned, they make up the cursor
+        projection = {field.strip(): 1 for field in fields.split(',') if field.strip()}
+        projection['created_at'] = 1
+
+    limit = args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError('Invalid limit!')
+        if not 0 < limit <= max_limit:
+            raise ValueError(f'Limit must be between 1 and {max_limit}!')
+    elif cursor:
+        limit = max_limit
+
+    return query, projection, limit
+
+
+# Read the orders matching a listing query
+# Without a limit, returns (cursor over every order, None)
+# With a limit, returns (the page's orders, cursor of the next page or None if it is the last one)
+def find_orders(collection, query, projection, limit, batch_size=500):
+    cursor = collection.find(query, projection).sort(SORT).batch_size(batch_size)
+    if not limit:
+        return cursor, None
+
+    # One more than the page tells whether there is a next page
+    orders = list(cursor.limit(limit + 1))
+    if len(orders) > limit:
+        orders = orders[:limit]
+        return orders, encode_cursor(orders[-1])
+    return orders, None
+
+
+# Yield orders as a JSON array (MongoDB extended JSON, like bson.json_util.dumps of a list)
+def stream_orders(orders):
+    yield '['
+    for index, order in enumerate(orders):
+        if index:
+            yield ', '
+        yield json_util.dumps(order)
+    yield ']'
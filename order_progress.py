@@ -0,0 +1,133 @@
+# Materialised order progress counters
+#
+# The /report counts only depend on how many charged pairs of each size have
+# reached each stage. Those numbers are kept in one order_progress document
+# per order, incremented with $inc right after every stage record is written,
+# so the report is a single document read whatever the size of the order:
+#
+#   {
+#       '_id': '0000012345',                  # order number
+#       'counts': {                           # canonical size ('.' written '_') -> pairs that reached each stage
+#           '8': {'charge': 120, 'stage1': 118, 'stage2': 90, ...},
+#           '9_5': {'charge': 40, ...}
+#       },
+#       'updated_at': ...
+#   }
+#
+# The counter update follows the stage write without a transaction, so a
+# process dying in between leaves the counters one short. rebuild_order
+# recomputes them from the stage records, and verify_order tells whether
+# they drifted.
+
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from barcode_codec import canonical_shoe_size
+from report_engine import STAGE_COUNT, empty_report
+from stages import STAGES
+
+
+# Field name of a shoe size in the counts, field names cannot contain '.'
+def size_key(shoe_size):
+    return str(canonical_shoe_size(shoe_size)).replace('.', '_')
+
+
+def _inc_field(shoe_size, stage):
+    return f'counts.{size_key(shoe_size)}.{STAGES[stage].name}'
+
+
+# Update counting a pair that reached a stage, applied with upsert to the order's document
+def increment_update(shoe_size, stage):
+    return {'$inc': {_inc_field(shoe_size, stage): 1}, '$set': {'updated_at': datetime.utcnow()}}
+
+
+# Count a pair of an order that reached a stage
+def increment(collection, order_number, shoe_size, stage):
+    collection.update_one({'_id': order_number}, increment_update(shoe_size, stage), upsert=True)
+
+
+# Count many transitions [(order_number, shoe_size, stage)] with one update per order
+def increment_many(collection, transitions):
+    increments = {}
+    for order_number, shoe_size, stage in transitions:
+        fields = increments.setdefault(order_number, {})
+        field = _inc_field(shoe_size, stage)
+        fields[field] = fields.get(field, 0) + 1
+    if not increments:
+        return
+    now = datetime.utcnow()
+    collection.bulk_write([
+        UpdateOne({'_id': order_number}, {'$inc': fields, '$set': {'updated_at': now}}, upsert=True)
+        for order_number, fields in increments.items()
+    ], ordered=False)
+
+
+# Counts from the report inputs (see report_engine.build_report)
+def compute_counts(charge_entries, stage_sets):
+    counts = {}
+    for barcode_number, shoe_size in charge_entries:
+        size_counts = counts.setdefault(size_key(shoe_size), {stage.name: 0 for stage in STAGES})
+        size_counts['charge'] += 1
+        for stage_num, stage_set in enumerate(stage_sets, start=1):
+            if barcode_number in stage_set:
+                size_counts[f'stage{stage_num}'] += 1
+    return counts
+
+
+# Build the report of an order from its counts, in the shape of report_engine.build_report
+def report_from_counts(sizes_quantities, counts):
+    report_data, total_data = empty_report(sizes_quantities)
+    for size, size_report in report_data.items():
+        reached = (counts or {}).get(size_key(size), {})
+        charged = reached.get('charge', 0)
+
+        # Charge is completed once the pair reached stage1
+        completed = reached.get('stage1', 0)
+        size_report['completed_charge_count'] = completed
+        size_report['pending_charge_count'] = charged - completed
+        total_data['total_completed_charge'] += completed
+        total_data['total_pending_charge'] += charged - completed
+
+        # A stage is completed once the pair reached the next stage
+        for stage_num in range(1, STAGE_COUNT):
+            in_stage = reached.get(f'stage{stage_num}', 0)
+            completed = reached.get(f'stage{stage_num + 1}', 0)
+            size_report['stage_completion_counts'][f'stage{stage_num}'] = {
+                'completed': completed, 'pending': in_stage - completed
+            }
+            total_data[f'total_stage{stage_num}_completed'] += completed
+            total_data[f'total_stage{stage_num}_pending'] += in_stage - completed
+
+    return report_data, total_data
+
+
+def load_counts(collection, order_number):
+    progress = collection.find_one({'_id': order_number}, {'counts': 1})
+    return progress['counts'] if progress else {}
+
+
+# Replace the counters of an order with the counts recomputed from its records
+def rebuild_order(collection, order_number, charge_entries, stage_sets):
+    counts = compute_counts(charge_entries, stage_sets)
+    collection.replace_one(
+        {'_id': order_number},
+        {'counts': counts, 'updated_at': datetime.utcnow()},
+        upsert=True
+    )
+    return counts
+
+
+# Compare the stored counters of an order with its records, returns the differing
+# [(size, stage name, stored, recomputed)]
+def verify_order(collection, order_number, charge_entries, stage_sets):
+    stored = load_counts(collection, order_number)
+    recomputed = compute_counts(charge_entries, stage_sets)
+    differences = []
+    for size in sorted(set(stored) | set(recomputed)):
+        for stage in STAGES:
+            stored_count = stored.get(size, {}).get(stage.name, 0)
+            recomputed_count = recomputed.get(size, {}).get(stage.name, 0)
+            if stored_count != recomputed_count:
+                differences.append((size, stage.name, stored_count, recomputed_count))
+    return differences
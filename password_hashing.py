@@ -0,0 +1,76 @@
+# Password hashing off the request thread
+#
+# A password hash is deliberately expensive (scrypt takes ~150 ms of CPU with
+# werkzeug's defaults). Run on the request threads, a burst of logins at the
+# start of a shift competes for the CPU with the scan routes served by the
+# same workers. Hashes are computed here instead, by a small pool of threads
+# (hashlib releases the GIL while hashing), so at most `workers` hashes run at
+# once. At most `max_pending` can wait for the pool: past that (or after waiting
+# `timeout` seconds), PasswordHasherBusy is raised and the request is refused
+# instead of queueing forever.
+#
+# The hash parameters are a werkzeug method string ('scrypt', 'scrypt:16384:8:1',
+# 'pbkdf2:sha256:600000'...). A password stored with other parameters still
+# verifies, and needs_rehash tells when it should be hashed again.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, method='scrypt', salt_length=16, workers=2, max_pending=64, timeout=30):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.timeout = timeout
+        # Hashes running or waiting for the pool
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        # Full method string of new hashes, e.g. 'scrypt' -> 'scrypt:32768:8:1'
+        self.hash_method = generate_password_hash('', method=method, salt_length=salt_length).split('$', 1)[0]
+
+    def _submit(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+        try:
+            future = self._executor.submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    # Hash with the configured parameters, returns a future
+    def submit_hash(self, password):
+        return self._submit(generate_password_hash, password, self.method, self.salt_length)
+
+    def _result(self, future):
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        return self._result(self.submit_hash(password))
+
+    def verify(self, password_hash, password):
+        return self._result(self._submit(check_password_hash, password_hash, password))
+
+    # Whether a stored hash was made with other parameters than the configured ones: its whole
+    # method string ('scrypt:16384:8:1' is not 'scrypt:32768:8:1') and its salt length
+    def needs_rehash(self, password_hash):
+        parts = password_hash.split('$', 2)
+        if len(parts) != 3:
+            return True
+        method, salt, _ = parts
+        return method != self.hash_method or len(salt) != self.salt_length
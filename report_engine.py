@@ -0,0 +1,102 @@
+# Set-based report engine for /report/<orderNumber>
+#
+# Instead of probing the stage collections once per charged barcode, every
+# collection is read exactly once for the order (projected down to the
+# barcode number) and the stage membership is resolved in memory with sets.
+# The number of queries is constant regardless of the order size.
+
+from barcode_codec import canonical_shoe_size
+from stages import STAGES
+
+STAGE_COUNT = len(STAGES) - 1
+
+
+# Fetch the set of barcode numbers recorded in a collection for one order
+def fetch_barcode_set(collection, order_number):
+    cursor = collection.find(
+        {'order_number': order_number},
+        {'_id': 0, 'barcode_number': 1}
+    )
+    return {doc['barcode_number'] for doc in cursor}
+
+
+# Build the empty per-size report and the totals from the order's sizes_quantities
+def empty_report(sizes_quantities):
+    report_data = {}
+    total_data = {'total_quantity': 0,
+                  'total_completed_charge': 0,
+                  'total_pending_charge': 0}
+    for stage_num in range(1, STAGE_COUNT + 1):
+        total_data[f'total_stage{stage_num}_completed'] = 0
+        total_data[f'total_stage{stage_num}_pending'] = 0
+
+    for item in sizes_quantities:
+        size = item['size']
+        quantity = item['quantity']
+        report_data[size] = {
+            'quantity': quantity,
+            'completed_charge_count': 0,
+            'pending_charge_count': 0,
+            'stage_completion_counts': {
+                f'stage{stage_num}': {'completed': 0, 'pending': 0}
+                for stage_num in range(1, STAGE_COUNT + 1)
+            }
+        }
+        total_data['total_quantity'] += quantity
+
+    return report_data, total_data
+
+
+# Count charged barcodes into the report
+#   charge_entries: iterable of (barcode_number, shoe_size) pairs, one per charge document
+#   stage_sets: list of barcode sets for stage1..stage6 (index 0 is stage1)
+def build_report(sizes_quantities, charge_entries, stage_sets):
+    report_data, total_data = empty_report(sizes_quantities)
+    # Charges resolved from the barcode itself carry the canonical size ('8' for an order's '8.0')
+    size_keys = {canonical_shoe_size(size): size for size in report_data}
+
+    for barcode_number, shoe_size in charge_entries:
+        size_key = shoe_size if shoe_size in report_data else size_keys.get(canonical_shoe_size(shoe_size))
+        if size_key is None:
+            continue
+        size_report = report_data[size_key]
+
+        # Charge is completed once the pair reached stage1
+        if barcode_number in stage_sets[0]:
+            size_report['completed_charge_count'] += 1
+            total_data['total_completed_charge'] += 1
+        else:
+            size_report['pending_charge_count'] += 1
+            total_data['total_pending_charge'] += 1
+
+        # A stage is completed once the pair reached the next stage
+        for stage_num in range(1, STAGE_COUNT):
+            if barcode_number not in stage_sets[stage_num - 1]:
+                continue
+            if barcode_number in stage_sets[stage_num]:
+                size_report['stage_completion_counts'][f'stage{stage_num}']['completed'] += 1
+                total_data[f'total_stage{stage_num}_completed'] += 1
+            else:
+                size_report['stage_completion_counts'][f'stage{stage_num}']['pending'] += 1
+                total_data[f'total_stage{stage_num}_pending'] += 1
+
+    return report_data, total_data
+
+
+# Charge entries and stage sets of an order with one query per collection, the inputs of build_report
+def report_inputs(order_number, charges_collection, stage_collections):
+    charge_entries = [
+        (doc['barcode_number'], doc['shoe_size'])
+        for doc in charges_collection.find(
+            {'order_number': order_number},
+            {'_id': 0, 'barcode_number': 1, 'shoe_size': 1}
+        )
+    ]
+    stage_sets = [fetch_barcode_set(collection, order_number) for collection in stage_collections]
+    return charge_entries, stage_sets
+
+
+# Compute the report for an order with one query per collection
+def order_report(order_data, charges_collection, stage_collections):
+    charge_entries, stage_sets = report_inputs(order_data['order_number'], charges_collection, stage_collections)
+    return build_report(order_data['sizes_quantities'], charge_entries, stage_sets)
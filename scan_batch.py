@@ -0,0 +1,120 @@
+# Batch scan processing
+#
+# Applies a list of {barcode_number, stage, scanned_at} scans (e.g. queued by
+# offline handhelds) with set-based reads: everything recorded for the batch's
+# barcodes is loaded up front, every scan is planned in memory with
+# stages.plan_transition (in scan order, so a charge and its stage1 can be in
+# the same batch), and the new records are written in bulk. Each scan gets the
+# status and body the single-scan route would have returned.
+#
+# A record of the batch can be refused on write when another scanner recorded
+# the same stage meanwhile. The scans planned after it are then not written
+# either, and are planned again against the records actually stored.
+
+from datetime import datetime, timezone
+
+from stages import STAGES, get_stage, plan_transition
+
+
+# Scan time of an event: ISO 8601 scanned_at (naive UTC), or now if absent
+def parse_scanned_at(value, now):
+    if value is None:
+        return now
+    scanned_at = datetime.fromisoformat(value)
+    if scanned_at.tzinfo is not None:
+        scanned_at = scanned_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return scanned_at
+
+
+# Plan scans [(scanned_at, index, barcode_number, stage)] in scan order against records, updating results
+# Returns [(index, stage_number, document, depends_on)], depends_on being the index of the scan
+# of this batch whose document is the prerequisite of this one (None if it is already recorded)
+def plan_scans(scans, username, records, labels, results):
+    planned = []
+    # (barcode_number, stage_number) -> index of the scan that planned that record in this batch
+    planned_by = {}
+    records = dict(records)
+    for scanned_at, index, barcode_number, stage in sorted(scans, key=lambda scan: scan[:2]):
+        existing = records.get((barcode_number, stage.number))
+        previous = labels.get(barcode_number) if stage.number == 0 else records.get((barcode_number, stage.number - 1))
+        body, status, document = plan_transition(stage, barcode_number, username, scanned_at, existing, previous)
+        results[index].update(status=status, response=body)
+        if document:
+            depends_on = planned_by.get((barcode_number, stage.number - 1)) if stage.number else None
+            records[(barcode_number, stage.number)] = document
+            planned_by[(barcode_number, stage.number)] = index
+            planned.append((index, stage.number, document, depends_on))
+    return planned
+
+
+# Process a batch of scans made by username
+#   load_records(barcode_numbers, stage_numbers) -> {(barcode_number, stage_number): record}
+#   resolve_labels(barcode_numbers) -> {barcode_number: {'order_number', 'shoe_size'}}
+#   save_documents([(index, stage_number, document, depends_on)]) -> set of indexes that were not written,
+#       because the barcode already had the record or because the document they depend on was not written
+# Returns one {'barcode_number', 'stage', 'status', 'response'} per event, in input order
+def process_scan_batch(events, username, now, load_records, resolve_labels, save_documents, max_rounds=len(STAGES) + 1):
+    results = [None] * len(events)
+    scans = []
+    for index, event in enumerate(events):
+        barcode_number = event.get('barcode_number') if isinstance(event, dict) else None
+        stage = get_stage(event.get('stage')) if isinstance(event, dict) else None
+        result = {'barcode_number': barcode_number, 'stage': stage.name if stage else None}
+        results[index] = result
+
+        if not barcode_number:
+            result.update(status=400, response={'message': 'Barcode number is required!'})
+            continue
+        if not isinstance(barcode_number, str):
+            result.update(status=400, response={'message': 'Barcode number must be a string!'})
+            continue
+        if not stage:
+            result.update(status=400, response={'message': 'Unknown stage!'})
+            continue
+        try:
+            scanned_at = parse_scanned_at(event.get('scanned_at'), now)
+        except (TypeError, ValueError):
+            result.update(status=400, response={'message': 'Invalid scanned_at!'})
+            continue
+        scans.append((scanned_at, index, barcode_number, stage))
+
+    # Everything already recorded for the batch's barcodes, in one read per collection
+    barcode_numbers = list({barcode_number for _, _, barcode_number, _ in scans})
+    stage_numbers = set()
+    for _, _, _, stage in scans:
+        stage_numbers.add(stage.number)
+        if stage.number:
+            stage_numbers.add(stage.number - 1)
+    stage_numbers = sorted(stage_numbers)
+    records = load_records(barcode_numbers, stage_numbers) if scans else {}
+
+    # Labels of the barcodes charged in this batch
+    charged = list({barcode_number for _, _, barcode_number, stage in scans
+                    if stage.number == 0 and (barcode_number, 0) not in records})
+    labels = resolve_labels(charged) if charged else {}
+
+    # Plan in scan order so a pair's stages follow each other within the batch, and write
+    failed = set()
+    for _ in range(max_rounds):
+        planned = plan_scans(scans, username, records, labels, results)
+        failed = save_documents(planned) if planned else set()
+        if not failed:
+            break
+        for index, stage_number, document, _ in planned:
+            if index not in failed:
+                records[(document['barcode_number'], stage_number)] = document
+
+        # Another scanner recorded some of these barcodes first: plan their scans again against
+        # what is recorded now, so no scan follows a record of this batch that was not written
+        retry_barcodes = {barcode_number for _, index, barcode_number, _ in scans if index in failed}
+        records = {key: record for key, record in records.items() if key[0] not in retry_barcodes}
+        records.update(load_records(list(retry_barcodes), stage_numbers))
+        scans = [scan for scan in scans if scan[1] in failed]
+
+    # Scans still refused after the last round
+    for index in failed:
+        results[index].update(status=400, response={
+            'message': f"Barcode is already in use for an active {results[index]['stage']}!"
+        })
+
+    return results
@@ -0,0 +1,73 @@
+# Sequence numbers allocated in blocks (hi/lo)
+#
+# A counter document per sequence holds the next unreserved number:
+#
+#   {'_id': 'sl_no', 'next': 104200}
+#
+# Each process reserves a block of block_size numbers with one atomic $inc and
+# hands them out from memory, so a number costs a database call only once per
+# block. Numbers are unique across processes and increase within a process;
+# a process that exits leaves the rest of its block unused, so the sequence
+# can have gaps.
+#
+# Numbers given out before the sequence existed are skipped: taken(first, limit)
+# returns those of a block when it is reserved. The sequence never goes past
+# max_value, SequenceExhausted is raised instead of handing out a wider number.
+
+import threading
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class SequenceExhausted(Exception):
+    pass
+
+
+class BlockSequence:
+    # initial_value() gives the first number when the counter does not exist yet
+    def __init__(self, counters_collection, name, block_size=100, initial_value=lambda: 1,
+                 max_value=None, taken=lambda first, limit: ()):
+        self.counters_collection = counters_collection
+        self.name = name
+        self.block_size = block_size
+        self.initial_value = initial_value
+        self.max_value = max_value
+        self.taken = taken
+        self._next = 0
+        self._limit = 0
+        self._taken = frozenset()
+        self._lock = threading.Lock()
+
+    # Reserve the next block, returns its first number
+    def _reserve(self):
+        while True:
+            counter = self.counters_collection.find_one_and_update(
+                {'_id': self.name},
+                {'$inc': {'next': self.block_size}},
+                return_document=ReturnDocument.AFTER
+            )
+            if counter:
+                return counter['next'] - self.block_size
+            try:
+                self.counters_collection.insert_one({'_id': self.name, 'next': self.initial_value()})
+            except DuplicateKeyError:
+                # Another process created the counter first
+                pass
+
+    def next(self):
+        with self._lock:
+            while True:
+                if self._next >= self._limit:
+                    first = self._reserve()
+                    if self.max_value is not None and first > self.max_value:
+                        raise SequenceExhausted(f'Sequence {self.name} is past {self.max_value}')
+                    self._next = first
+                    self._limit = first + self.block_size
+                    if self.max_value is not None:
+                        self._limit = min(self._limit, self.max_value + 1)
+                    self._taken = frozenset(self.taken(first, self._limit))
+                number = self._next
+                self._next += 1
+                if number not in self._taken:
+                    return number
@@ -0,0 +1,84 @@
+# Production server
+#
+# index.py's app.run() is Flask's development server. This starts the app
+# under a production WSGI server instead:
+#
+#   - gunicorn (Linux), with WEB_WORKERS processes of WEB_THREADS threads each,
+#     so scans are served on every core. The app is not preloaded: each worker
+#     imports index after the fork, so it opens its own MongoDB client and
+#     pool and starts its own background threads.
+#   - waitress (Windows, or when gunicorn is not installed), one process with
+#     WEB_THREADS threads. Start several on different ports behind the load
+#     balancer to use more cores.
+#
+# Each process holds up to MONGO_MAX_POOL_SIZE connections (see index.py), so
+# keep WEB_WORKERS * MONGO_MAX_POOL_SIZE within what mongod accepts; a pool of
+# a little more than WEB_THREADS is enough for the request threads.
+#
+#   WEB_WORKERS=8 WEB_THREADS=16 MONGO_MAX_POOL_SIZE=24 python serve.py
+#
+# Point the load balancer's health check at /readyz, and the liveness probe
+# at /healthz.
+
+import importlib.util
+import os
+import sys
+
+HOST = os.environ.get('HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', 5000))
+WEB_SERVER = os.environ.get('WEB_SERVER', 'waitress' if os.name == 'nt' else 'gunicorn')
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))
+# Label generation can take minutes for a big order
+WEB_TIMEOUT = int(os.environ.get('WEB_TIMEOUT', 300))
+# Idle keep-alive of the scanners' connections
+WEB_KEEPALIVE = int(os.environ.get('WEB_KEEPALIVE', 5))
+# Restart a worker after this many requests (plus up to 10% jitter), 0 never restarts them
+WEB_MAX_REQUESTS = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+
+
+def serve_gunicorn():
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f'{HOST}:{PORT}',
+                'workers': WEB_WORKERS,
+                'threads': WEB_THREADS,
+                'worker_class': 'gthread',
+                'timeout': WEB_TIMEOUT,
+                'graceful_timeout': 30,
+                'keepalive': WEB_KEEPALIVE,
+                'max_requests': WEB_MAX_REQUESTS,
+                'max_requests_jitter': WEB_MAX_REQUESTS // 10,
+                # Import the app in each worker, after the fork
+                'preload_app': False,
+                'accesslog': os.environ.get('WEB_ACCESS_LOG') or None,
+            }
+            for name, value in options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            from index import app
+            return app
+
+    Application().run()
+
+
+def serve_waitress():
+    import waitress
+    from index import app
+
+    if WEB_WORKERS > 1:
+        print(f'waitress runs a single process: WEB_WORKERS={WEB_WORKERS} ignored', file=sys.stderr)
+    waitress.serve(app, host=HOST, port=PORT, threads=WEB_THREADS, channel_timeout=WEB_TIMEOUT)
+
+
+if __name__ == '__main__':
+    servers = {'gunicorn': serve_gunicorn, 'waitress': serve_waitress}
+    if WEB_SERVER not in servers:
+        sys.exit(f"WEB_SERVER must be one of {', '.join(servers)}")
+    if importlib.util.find_spec(WEB_SERVER) is None:
+        sys.exit(f'{WEB_SERVER} is not installed: pip install {WEB_SERVER}')
+    servers[WEB_SERVER]()
@@ -0,0 +1,180 @@
+# Stage table and transition rules
+#
+# The charge (stage 0) and stage1..stage6 differ only in their messages, their
+# allowed duration, how the delay against the previous stage is measured and
+# which fields they record. Those differences are declared in STAGES, and
+# plan_transition applies them to a barcode given what is already recorded for
+# it, without touching the database: callers load the records, plan, and write
+# the returned document. Each row is served as POST /<name>, so adding a stage
+# is a new row here.
+
+from collections import namedtuple
+from datetime import timedelta
+
+Stage = namedtuple('Stage', [
+    'number',             # 0 for the charge, 1..6 for the stages
+    'name',               # route name
+    'collection',         # collection the stage's records are kept in
+    'duration',           # allowed minutes in this stage, end_time = start_time + duration
+    'gap',                # minutes after the previous stage's end_time this stage starts, None to start at scan time
+    'delay',              # 'elapsed': previous start + its allowed time, 'overrun': previous end_time, None: always on time
+    'delay_field',        # field holding the delay message, None if not recorded
+    'size_field',         # field the shoe size is recorded under, None if not recorded
+    'missing_message',    # response when the prerequisite is missing
+    'missing_status',
+    'success_message',
+    'response',           # 'charge', 'stage1' or 'stage' response layout
+])
+
+STAGES = [
+    Stage(0, 'charge', 'charges', 45, None, None, None, 'shoe_size',
+          'Order not found for the given barcode number!', 404,
+          'Charge started successfully!', 'charge'),
+    Stage(1, 'stage1', 'stage1', 45, None, 'elapsed', 'delay_status', 'shoe_size',
+          'Charge process for this barcode is not completed. Cannot proceed to Stage 1.', 400,
+          'Stage 1 recorded successfully!', 'stage1'),
+    Stage(2, 'stage2', 'stage2', 45, None, 'overrun', 'delay_message', 'shoe_size',
+          'Charge process for this barcode is not completed. Cannot proceed to Stage 1.', 400,
+          'Stage2 submitted successfully!', 'stage'),
+    Stage(3, 'stage3', 'stage3', 5, None, 'overrun', 'delay_message', 'shoe_Size',
+          'Stage2 data not found for this barcode!', 404,
+          'Stage3 submitted successfully!', 'stage'),
+    Stage(4, 'stage4', 'stage4', 45, None, 'overrun', 'delay_message', None,
+          'Stage3 data not found for this barcode!', 404,
+          'Stage4 submitted successfully!', 'stage'),
+    Stage(5, 'stage5', 'stage5', 45, None, 'overrun', 'delay_message', None,
+          'Stage4 data not found for this barcode!', 404,
+          'Stage5 submitted successfully!', 'stage'),
+    # Stage6 starts 15 minutes after stage5 ends, no delay is measured
+    Stage(6, 'stage6', 'stage6', 45, 15, None, 'delay_message', None,
+          'Stage5 data not found for this barcode!', 404,
+          'Stage6 submitted successfully!', 'stage'),
+]
+
+STAGES_BY_NAME = {stage.name: stage for stage in STAGES}
+
+
+# Look a stage up by name ('charge', 'stage1'...) or number, None for anything else
+def get_stage(stage):
+    if isinstance(stage, int) and not isinstance(stage, bool) and 0 <= stage < len(STAGES):
+        return STAGES[stage]
+    return STAGES_BY_NAME.get(stage) if isinstance(stage, str) else None
+
+
+# Delay message of a scan at current_time against the previous stage's record
+def delay_message(stage, previous, current_time):
+    if stage.delay == 'elapsed':
+        allowed = STAGES[stage.number - 1].duration
+        elapsed_time = current_time - previous['start_time']
+        delay_minutes = (elapsed_time.total_seconds() / 60) - allowed  # subtract the allowed time
+        if elapsed_time > timedelta(minutes=allowed):
+            return f"Delayed by {int(delay_minutes)} minutes"
+        return "On time"
+
+    if stage.delay == 'overrun':
+        if current_time > previous['end_time']:
+            delay_time = current_time - previous['end_time']
+            return f'Delayed by {delay_time.total_seconds() / 60:.2f} minutes'
+        return 'On time'
+
+    return 'On time'
+
+
+# Plan the transition of a barcode into a stage
+#   existing: the barcode's record for this stage, if any
+#   previous: its record for the previous stage; for the charge, the label's order_number/shoe_size
+# Returns (response body, status code, document to record or None)
+def plan_transition(stage, barcode_number, username, current_time, existing, previous):
+    if existing:
+        return {'message': f'Barcode is already in use for an active {stage.name}!'}, 400, None
+
+    if not previous:
+        return {'message': stage.missing_message}, stage.missing_status, None
+
+    if stage.gap is None:
+        start_time = current_time
+    else:
+        start_time = previous['end_time'] + timedelta(minutes=stage.gap)
+    end_time = start_time + timedelta(minutes=stage.duration)
+    order_number = previous['order_number']
+
+    document = {
+        'username': username,
+        'barcode_number': barcode_number,
+        'order_number': order_number,
+    }
+    if stage.size_field:
+        document[stage.size_field] = previous['shoe_size']
+    if stage.number:
+        document['stage'] = stage.number
+    document['start_time'] = start_time
+    document['end_time'] = end_time
+    document['created_at'] = current_time
+    if stage.delay_field:
+        document[stage.delay_field] = delay_message(stage, previous, current_time)
+
+    if stage.response == 'charge':
+        body = {
+            'message': stage.success_message,
+            'barcode_number': barcode_number,
+            'order_number': order_number,
+            'username': username,
+            'start_time': start_time.isoformat(),
+            'end_time': end_time.isoformat()
+        }
+    elif stage.response == 'stage1':
+        body = {
+            'message': stage.success_message,
+            'barcode_number': barcode_number,
+            'order_number': order_number,
+            'username': username,
+            'stage': stage.number,
+            'start_time': start_time.isoformat(),
+            'end_time': end_time.isoformat(),
+            'delay_status': document['delay_status']
+        }
+    else:
+        body = {
+            'message': stage.success_message,
+            'barcode_number': barcode_number,
+            'order_number': order_number,
+        }
+        if stage.delay is not None:
+            body['delay_message'] = document['delay_message']
+        body[f'{stage.name}_start_time'] = start_time.isoformat()
+        body[f'{stage.name}_end_time'] = end_time.isoformat()
+
+    return body, 201, document
+
+
+# Steps of a single scan, shared by the Flask routes and the asyncio app (async_scans.py)
+# The generator yields the storage operations it needs; the caller performs them and sends
+# back their result:
+#   ('load', stage_number)  -> the barcode's latest record for that stage, or None
+#   ('resolve',)            -> the barcode's label {'order_number', 'shoe_size'}, or None
+#   ('save', document)      -> False if the barcode already has the record
+#   ('recorded', document)  -> nothing, once the record is written (counters, WIP board)
+# and returns (response body, status code).
+#   unique_records: a second record of a stage is refused on write (unique index or progress
+#   document), so only the prerequisite has to be read
+def scan_steps(stage, barcode_number, username, current_time, unique_records):
+    if not barcode_number:
+        return {'message': 'Barcode number is required!'}, 400
+    if not isinstance(barcode_number, str):
+        return {'message': 'Barcode number must be a string!'}, 400
+
+    existing = None if unique_records else (yield ('load', stage.number))
+    if existing:
+        previous = None
+    elif stage.number == 0:
+        # The charge's prerequisite is the label itself
+        previous = yield ('resolve',)
+    else:
+        previous = yield ('load', stage.number - 1)
+
+    body, status, document = plan_transition(stage, barcode_number, username, current_time, existing, previous)
+    if document:
+        if not (yield ('save', document)):
+            return {'message': f'Barcode is already in use for an active {stage.name}!'}, 400
+        yield ('recorded', document)
+    return body, status
@@ -0,0 +1,133 @@
+# Test fixtures
+#
+# index.py is imported once, with flask_pymongo.PyMongo replaced by a
+# mongomock client (and mongomock's GridFS support enabled for the label job
+# PDFs), so the suite runs without a MongoDB server:
+#
+#   pip install pytest mongomock
+#   python -m pytest -q
+#
+# Every test starts from an empty database with the required indexes and an
+# empty label cache. Settings read per request (storage, render mode...) are
+# changed with monkeypatch.setitem(index.app.config, ...).
+
+import json
+import os
+import sys
+import types
+
+import flask_pymongo
+import mongomock
+import mongomock.collection
+import pytest
+from mongomock.gridfs import enable_gridfs_integration
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+# Cheap password hashes and labels drawn without bitmaps, in the test process only
+os.environ.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')
+os.environ.setdefault('LABEL_RENDER_MODE', 'vector')
+os.environ.setdefault('STORE_BARCODE_IMAGES', '0')
+os.environ.setdefault('LABEL_RENDER_WORKERS', '1')
+
+
+class MockPyMongo:
+    def __init__(self, app=None, **kwargs):
+        self.cx = mongomock.MongoClient()
+        self.db = self.cx.florence
+
+
+flask_pymongo.PyMongo = MockPyMongo
+enable_gridfs_integration()
+# GridFSBucket reads client.options.timeout, which mongomock clients do not have
+mongomock.MongoClient.options = types.SimpleNamespace(timeout=None)
+
+
+# pymongo 4.9+ passes sort to the bulk operation builder, which mongomock does not accept
+def _without_sort(add):
+    def wrapper(self, *args, **kwargs):
+        kwargs.pop('sort', None)
+        return add(self, *args, **kwargs)
+    return wrapper
+
+
+for _name in ('add_update', 'add_replace'):
+    setattr(mongomock.collection.BulkOperationBuilder, _name,
+            _without_sort(getattr(mongomock.collection.BulkOperationBuilder, _name)))
+
+import index  # noqa: E402
+from indexes import ensure_indexes  # noqa: E402
+from label_cache import LabelCache  # noqa: E402
+
+ORDER_NUMBER = '0000054321'
+
+
+# Empty the database, keeping the required indexes
+def reset_database():
+    index.mongo.cx.drop_database('florence')
+    ensure_indexes(index.mongo.db)
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    reset_database()
+    monkeypatch.setattr(index, 'label_cache', LabelCache(max_size=index.app.config['LABEL_CACHE_SIZE']))
+    # The Sl.No. block reserved in a dropped database is not handed out any more
+    monkeypatch.setattr(index.sl_no_sequence, '_limit', 0)
+    return index
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def token(client):
+    client.post('/register', json={'username': 'tester', 'password': 'secret'})
+    return client.post('/login', json={'username': 'tester', 'password': 'secret'}).get_json()['token']
+
+
+# Run a test in the charges/stage collections and in barcode_progress documents,
+# with and without relying on the unique indexes to refuse a second record
+@pytest.fixture(params=[
+    ('collections', True), ('collections', False), ('progress', True),
+], ids=['collections', 'collections-read-check', 'progress'])
+def storage(request, app_module, monkeypatch):
+    kind, unique_records = request.param
+    monkeypatch.setitem(app_module.app.config, 'BARCODE_PROGRESS_STORAGE', kind == 'progress')
+    monkeypatch.setitem(app_module.app.config, 'UNIQUE_STAGE_RECORDS', unique_records)
+    return kind
+
+
+def scan(client, token, stage_name, barcode_number):
+    return client.post(f'/{stage_name}', json={'barcode_number': barcode_number}, headers={'Authorization': token})
+
+
+# Response without the fields that depend on the time of the scan
+def stable(body):
+    return {key: value for key, value in body.items() if 'time' not in key and key not in ('delay_message', 'delay_status')}
+
+
+# An order of test.json under another number: sizes 8 (30 pairs), 9 (40) and 10 (30) unless given
+def make_order(order_number=ORDER_NUMBER, sizes_quantities=None, **fields):
+    with open(os.path.join(ROOT, 'test.json')) as file:
+        order = json.load(file)[0]
+    order['order_number'] = order_number
+    if sizes_quantities is not None:
+        order['sizes_quantities'] = sizes_quantities
+        order['order_pairs'] = sum(size_info['quantity'] for size_info in sizes_quantities)
+    order.update(fields)
+    return order
+
+
+# Submit an order and generate its labels, returns the barcode numbers in print order
+@pytest.fixture
+def labelled_order(client):
+    def create(order_number=ORDER_NUMBER, sizes_quantities=None):
+        assert client.post('/submit_order', json=make_order(order_number, sizes_quantities)).status_code == 201
+        assert client.post('/generate_barcode', json={'order_number': order_number}).status_code == 201
+        response = client.get(f'/view/{order_number}?format=ndjson')
+        return [json.loads(line)['barcode_number'] for line in response.data.splitlines()]
+    return create
@@ -0,0 +1,173 @@
+# Asyncio scan API: routing, tokens, the scan answers and parity with the Flask routes
+
+import asyncio
+import json
+
+import pytest
+
+from async_scans import MAX_BODY_SIZE, AsyncScanApp
+from conftest import scan, stable
+from stages import STAGES
+from wip_board import WipBoard
+
+
+# The calls AsyncScanApp makes on a pymongo.AsyncMongoClient collection, served by a mongomock one
+class AsyncCollection:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def find_one(self, *args, **kwargs):
+        return self.collection.find_one(*args, **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        return self.collection.insert_one(*args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return self.collection.update_one(*args, **kwargs)
+
+
+class AsyncDatabase:
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, name):
+        return AsyncCollection(self.db[name])
+
+    def __getattr__(self, name):
+        return AsyncCollection(self.db[name])
+
+
+@pytest.fixture
+def async_app(app_module):
+    return AsyncScanApp(AsyncDatabase(app_module.mongo.db), app_module.app.config,
+                        app_module.token_cache, app_module.label_cache)
+
+
+# (status, headers, body) of an ASGI request, body is the raw request body or a JSON value
+def call(application, method, path, body=b'', token=None, headers=()):
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    request_headers = list(headers) + ([(b'authorization', token.encode())] if token else [])
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application({'type': 'http', 'method': method, 'path': path, 'headers': request_headers}, receive, send))
+    start, response = sent
+    response_body = json.loads(response['body']) if response['body'] else None
+    return start['status'], dict(start['headers']), response_body
+
+
+def post_scan(application, token, stage_name, barcode_number):
+    status, _, body = call(application, 'POST', f'/{stage_name}', {'barcode_number': barcode_number}, token)
+    return status, body
+
+
+def test_routing(async_app, labelled_order):
+    barcode_number = labelled_order()[0]
+
+    status, headers, body = call(async_app, 'GET', f'/order/{barcode_number}')
+    assert (status, body) == (200, {'order_number': '0000054321'})
+    assert headers[b'content-type'] == b'application/json'
+    assert headers[b'access-control-allow-origin'] == b'*'
+    assert call(async_app, 'GET', '/order/0000099999080001')[::2] == (404, {'message': 'Order not found for the given barcode number!'})
+    assert call(async_app, 'POST', f'/order/{barcode_number}')[::2] == (405, {'message': 'Method not allowed!'})
+    assert call(async_app, 'GET', '/charge')[::2] == (405, {'message': 'Method not allowed!'})
+    for path in ('/stage7', '/report/0000054321', '/', '/order'):
+        assert call(async_app, 'POST', path)[::2] == (404, {'message': 'Not found!'})
+
+    status, headers, body = call(async_app, 'OPTIONS', '/charge', headers=[(b'access-control-request-headers', b'authorization')])
+    assert (status, body) == (200, None)
+    assert headers[b'access-control-allow-headers'] == b'authorization'
+
+
+def test_scans_need_a_valid_token(app_module, async_app, token):
+    assert call(async_app, 'POST', '/charge', {'barcode_number': '0000054321080001'})[::2] == (401, {'message': 'User token is required!'})
+    assert call(async_app, 'POST', '/charge', {'barcode_number': '0000054321080001'}, 'not-a-token')[::2] == (401, {'message': 'Invalid token!'})
+
+
+@pytest.mark.parametrize('body, status, message', [
+    (b'{"barcode_number": ', 400, 'Request body must be JSON!'),
+    ([{'barcode_number': '0000054321080001'}], 400, 'Request body must be a JSON object!'),
+    ({}, 400, 'Barcode number is required!'),
+    ({'barcode_number': 5432108000100001}, 400, 'Barcode number must be a string!'),
+    (b'{"barcode_number": "' + b'0' * MAX_BODY_SIZE + b'"}', 413, 'Request body is too large!'),
+], ids=['not-json', 'array', 'no-barcode', 'number-barcode', 'too-large'])
+def test_bad_bodies_are_refused(async_app, token, body, status, message):
+    assert call(async_app, 'POST', '/charge', body, token)[::2] == (status, {'message': message})
+
+
+def test_duplicate_scan_and_missing_previous_stage(storage, async_app, token, labelled_order):
+    barcode_number = labelled_order()[0]
+
+    assert post_scan(async_app, token, 'charge', barcode_number)[0] == 201
+    assert post_scan(async_app, token, 'charge', barcode_number) == (400, {'message': 'Barcode is already in use for an active charge!'})
+    assert post_scan(async_app, token, 'stage3', barcode_number) == (404, {'message': 'Stage2 data not found for this barcode!'})
+    assert post_scan(async_app, token, 'charge', '0000099999080001') == (404, {'message': 'Order not found for the given barcode number!'})
+
+
+# The same scans, of two barcodes of the same order, get the same answers from both apps
+def test_answers_like_the_flask_routes(storage, app_module, async_app, client, token, labelled_order, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'ORDER_PROGRESS_COUNTERS', True)
+    flask_barcode, async_barcode = labelled_order(sizes_quantities=[{'size': '8', 'quantity': 2}])
+    stage_names = [stage.name for stage in STAGES]
+
+    for stage_name in ['stage2', 'charge', 'charge'] + stage_names[1:] + ['stage6']:
+        response = scan(client, token, stage_name, flask_barcode)
+        flask_answer = (response.status_code, stable(response.get_json()))
+        status, body = post_scan(async_app, token, stage_name, async_barcode)
+        body = {key: flask_barcode if value == async_barcode else value for key, value in stable(body).items()}
+        assert (status, body) == flask_answer, stage_name
+
+    report = client.get('/report/0000054321').get_json()
+    # Both pairs counted, whichever app scanned them
+    assert report['total_summary']['total_completed_charge'] == 2
+    assert report['sizes']['8']['stage_completion_counts']['stage5'] == {'completed': 2, 'pending': 0}
+
+
+# A scan of either app moves the barcode on for the other
+def test_scans_of_both_apps_follow_each_other(storage, async_app, client, token, labelled_order):
+    barcode_number = labelled_order()[0]
+    assert post_scan(async_app, token, 'charge', barcode_number)[0] == 201
+    assert scan(client, token, 'stage1', barcode_number).status_code == 201
+    assert post_scan(async_app, token, 'stage2', barcode_number)[0] == 201
+    assert scan(client, token, 'stage2', barcode_number).status_code == 400
+
+
+def test_transitions_are_reported_to_the_wip_board(app_module, token, labelled_order):
+    barcode_number = labelled_order()[0]
+    board = WipBoard(app_module.load_wip_stages)
+    application = AsyncScanApp(AsyncDatabase(app_module.mongo.db), app_module.app.config,
+                               app_module.token_cache, app_module.label_cache, wip_board=board)
+    subscriber = board.subscribe('0000054321')
+
+    assert post_scan(application, token, 'charge', barcode_number)[0] == 201
+    event = subscriber.events.get_nowait()
+    assert (event['barcode_number'], event['stage'], event['counts']['charge']) == (barcode_number, 'charge', 1)
+
+
+def test_lifespan_runs_on_shutdown(app_module):
+    closed = []
+
+    async def on_shutdown():
+        closed.append(True)
+
+    application = AsyncScanApp(AsyncDatabase(app_module.mongo.db), app_module.app.config,
+                               app_module.token_cache, app_module.label_cache, on_shutdown=on_shutdown)
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(application({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert closed == [True]
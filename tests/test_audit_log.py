@@ -0,0 +1,126 @@
+# Buffered audit writes: batching, retries, the bound on pending events and writes after close
+
+import time
+
+import mongomock
+from pymongo.errors import AutoReconnect
+
+from audit_log import AuditBuffer
+
+
+# A collection whose next `failures` writes raise AutoReconnect
+class FlakyCollection:
+    def __init__(self, failures=0):
+        self.collection = mongomock.MongoClient().florence.logins
+        self.failures = failures
+        self.batches = []
+
+    def _fail(self):
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect('database unreachable')
+
+    def insert_many(self, documents, ordered=True):
+        self._fail()
+        self.batches.append(len(documents))
+        return self.collection.insert_many(documents, ordered=ordered)
+
+    def insert_one(self, document):
+        self._fail()
+        return self.collection.insert_one(document)
+
+    def usernames(self):
+        return [document['username'] for document in self.collection.find({}, sort=[('_id', 1)])]
+
+
+# Without starting the flush thread, so the tests decide when the buffer is flushed
+def add(buffer, *usernames):
+    for username in usernames:
+        with buffer._lock:
+            buffer._pending.append({'username': username})
+
+
+def test_flush_writes_in_batches_of_max_batch():
+    collection = FlakyCollection()
+    buffer = AuditBuffer(collection, max_batch=2)
+    add(buffer, 'a', 'b', 'c', 'd', 'e')
+
+    buffer.flush()
+    assert collection.batches == [2, 2, 1]
+    assert collection.usernames() == ['a', 'b', 'c', 'd', 'e']
+    assert buffer.stats() == {'pending': 0, 'written': 5, 'dropped': 0, 'failed_flushes': 0}
+
+
+def test_failed_batch_is_kept_ahead_of_newer_events():
+    collection = FlakyCollection(failures=1)
+    buffer = AuditBuffer(collection, max_batch=10)
+    add(buffer, 'a', 'b')
+
+    buffer.flush()
+    assert buffer.stats()['pending'] == 2
+    assert buffer.stats()['failed_flushes'] == 1
+    add(buffer, 'c')
+    buffer.flush()
+    assert collection.usernames() == ['a', 'b', 'c']
+
+
+def test_oldest_events_are_dropped_when_the_buffer_is_full():
+    collection = FlakyCollection(failures=1)
+    buffer = AuditBuffer(collection, max_batch=10, max_pending=3)
+    add(buffer, 'a', 'b', 'c')
+    buffer.flush()
+    buffer.add({'username': 'd'})
+    buffer.close()
+
+    assert collection.usernames() == ['b', 'c', 'd']
+    assert buffer.stats()['dropped'] == 1
+
+
+def test_background_thread_flushes_full_batches():
+    collection = FlakyCollection()
+    buffer = AuditBuffer(collection, max_batch=3, flush_interval=60)
+    for username in 'abc':
+        buffer.add({'username': username})
+    deadline = time.monotonic() + 5
+    while len(collection.usernames()) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert collection.usernames() == ['a', 'b', 'c']
+    buffer.close()
+
+
+def test_close_retries_before_discarding():
+    collection = FlakyCollection(failures=2)
+    buffer = AuditBuffer(collection, close_retries=3, close_retry_delay=0)
+    add(buffer, 'a', 'b')
+
+    buffer.close()
+    assert collection.usernames() == ['a', 'b']
+    assert buffer.stats()['failed_flushes'] == 2
+
+
+def test_close_counts_what_could_not_be_written(capsys):
+    collection = FlakyCollection(failures=10)
+    buffer = AuditBuffer(collection, close_retries=2, close_retry_delay=0)
+    add(buffer, 'a', 'b')
+
+    buffer.close()
+    assert buffer.stats() == {'pending': 0, 'written': 0, 'dropped': 2, 'failed_flushes': 3}
+    assert '2 events could not be written and were discarded' in capsys.readouterr().err
+
+
+def test_events_added_after_close_are_written_directly():
+    collection = FlakyCollection()
+    buffer = AuditBuffer(collection, flush_interval=60)
+    buffer.close()
+
+    buffer.add({'username': 'late'})
+    assert collection.usernames() == ['late']
+    assert buffer.stats()['pending'] == 0
+    collection.failures = 1
+    buffer.add({'username': 'lost'})
+    assert buffer.stats()['dropped'] == 1
+
+
+def test_login_is_recorded(app_module, client, token):
+    app_module.login_audit.flush()
+    assert app_module.logins_collection.count_documents({'username': 'tester'}) >= 1
@@ -0,0 +1,96 @@
+# Barcode numbers: decoding, check digits and packed keys
+
+import pytest
+
+import barcode_codec
+from label_generation import generate_barcode, order_label_specs
+
+
+def test_check_digit_is_gs1_mod_10():
+    # GS1's worked example: 400638133393 -> 4006381333931
+    assert barcode_codec.check_digit('400638133393') == '1'
+    assert barcode_codec.add_check_digit('0000054321080001') == '0000054321080001' + barcode_codec.check_digit('0000054321080001')
+    with pytest.raises(ValueError):
+        barcode_codec.check_digit('00000543210800A1')
+
+
+def test_decode_generated_barcodes():
+    barcode_number = generate_barcode('54321', '10.5', 7)
+    assert barcode_number == '0000054321105007'
+    assert barcode_codec.decode(barcode_number) == ('0000054321', '10.5', 7, False)
+
+    checked = barcode_codec.add_check_digit(barcode_number)
+    assert barcode_codec.decode(checked) == ('0000054321', '10.5', 7, True)
+
+
+@pytest.mark.parametrize('barcode_number', [
+    '000005432108001',        # too short
+    '00000543210800011234',   # too long
+    '0000054321080A01',       # malformed size
+    '00000543210800019',      # wrong check digit
+])
+def test_decode_refuses_malformed_barcodes(barcode_number):
+    if len(barcode_number) == barcode_codec.CHECKED_LENGTH:
+        assert barcode_codec.check_digit(barcode_number[:-1]) != barcode_number[-1]
+    with pytest.raises(ValueError):
+        barcode_codec.decode(barcode_number)
+
+
+def test_shoe_sizes():
+    assert barcode_codec.format_shoe_size('080') == '8'
+    assert barcode_codec.format_shoe_size('105') == '10.5'
+    assert barcode_codec.canonical_shoe_size('8.0') == barcode_codec.canonical_shoe_size('08') == '8'
+    assert barcode_codec.canonical_shoe_size('XL') == 'XL'
+
+
+@pytest.mark.parametrize('barcode_number', ['0000054321080001', '9999999999999999', '00000543210800012'])
+def test_pack_round_trip(barcode_number):
+    if len(barcode_number) == barcode_codec.CHECKED_LENGTH:
+        barcode_number = barcode_codec.add_check_digit(barcode_number[:-1])
+    key = barcode_codec.pack(barcode_number)
+    assert 0 <= key < 2 ** 63
+    assert barcode_codec.unpack(key) == barcode_number
+
+
+# The 17 digit form is flagged, so it never packs to the key of a 16 digit barcode of the same value
+def test_pack_keeps_both_lengths_apart():
+    checked = barcode_codec.add_check_digit('0000005432108000')
+    legacy = checked[1:]
+    assert int(legacy) == int(checked)
+    assert barcode_codec.pack(legacy) != barcode_codec.pack(checked)
+    assert barcode_codec.pack('ORD1234567080001') is None
+
+
+def test_label_specs_with_check_digit():
+    specs = order_label_specs('0000054321', [{'size': '8', 'quantity': 2}, {'size': '9.5', 'quantity': 1}], check_digit=True)
+    assert [(shoe_size, serial_number) for shoe_size, serial_number, _ in specs] == [('8', 1), ('8', 2), ('9.5', 1)]
+    for shoe_size, serial_number, barcode_number in specs:
+        fields = barcode_codec.decode(barcode_number)
+        assert fields.checked
+        assert (fields.shoe_size, fields.serial_number) == (shoe_size, serial_number)
+
+
+# Barcodes with a check digit are charged without looking their label up
+def test_checked_barcode_resolves_without_label(app_module, client, token, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'BARCODE_CHECK_DIGIT', True)
+    barcode_number = barcode_codec.add_check_digit('0000054321080001')
+    response = client.post('/charge', json={'barcode_number': barcode_number}, headers={'Authorization': token})
+    assert response.status_code == 201
+    assert response.get_json()['order_number'] == '0000054321'
+    assert app_module.barcode_images_collection.count_documents({}) == 0
+
+
+@pytest.mark.parametrize('barcode_number', [12345, 5432108000100001, ['0000054321080001'], {'n': 1}, None])
+def test_non_string_barcodes_are_not_decoded(barcode_number):
+    with pytest.raises(ValueError):
+        barcode_codec.decode(barcode_number)
+    assert barcode_codec.pack(barcode_number) is None
+
+
+# JSON numbers, arrays and objects are refused before any lookup
+@pytest.mark.parametrize('stage_name', ['charge', 'stage1'])
+@pytest.mark.parametrize('barcode_number', [12345, 5432108000100001, ['x'], {'barcode': 'x'}, True])
+def test_scan_refuses_non_string_barcodes(client, token, stage_name, barcode_number):
+    response = client.post(f'/{stage_name}', json={'barcode_number': barcode_number}, headers={'Authorization': token})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Barcode number must be a string!'
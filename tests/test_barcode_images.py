@@ -0,0 +1,55 @@
+# /view_barcode: label images rendered on demand and revalidated with their ETag
+
+import base64
+
+import pytest
+
+
+@pytest.fixture
+def stored_images(app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'STORE_BARCODE_IMAGES', True)
+
+
+def image_of(response):
+    return base64.b64decode(response.get_json()['image'])
+
+
+def test_label_without_image_is_rendered_on_demand(app_module, client, labelled_order):
+    labelled_order(sizes_quantities=[{'size': '8', 'quantity': 2}])
+    assert app_module.barcode_images_collection.count_documents({'image': {'$exists': True}}) == 0
+
+    response = client.get('/view_barcode/0000054321')
+    assert response.status_code == 200
+    assert response.get_json()['barcode_number'] == '0000054321080001'
+    assert image_of(response).startswith(b'\x89PNG')
+
+
+def test_stored_and_rendered_images_are_the_same(app_module, client, labelled_order, stored_images):
+    labelled_order(sizes_quantities=[{'size': '8', 'quantity': 2}])
+    stored = client.get('/view_barcode/0000054321')
+
+    result = app_module.app.test_cli_runner().invoke(args=['strip-barcode-images'])
+    assert 'Stripped the image of 2 barcodes' in result.output
+    assert image_of(client.get('/view_barcode/0000054321')) == image_of(stored)
+
+
+def test_unchanged_label_is_revalidated_with_a_304(app_module, client, labelled_order):
+    labelled_order(sizes_quantities=[{'size': '8', 'quantity': 2}])
+    response = client.get('/view_barcode/0000054321')
+    etag = response.headers['ETag']
+    assert response.cache_control.public
+    assert response.cache_control.max_age == app_module.app.config['VIEW_BARCODE_MAX_AGE']
+
+    revalidated = client.get('/view_barcode/0000054321', headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b''
+
+    # Once the label changes, the old ETag no longer matches
+    app_module.barcode_images_collection.update_many({}, {'$set': {'shoe_size': '9'}})
+    changed = client.get('/view_barcode/0000054321', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_unknown_order(client):
+    assert client.get('/view_barcode/0000099999').status_code == 404
@@ -0,0 +1,29 @@
+# /healthz and /readyz: liveness without the database, readiness with it
+
+import pytest
+from pymongo.errors import AutoReconnect, ServerSelectionTimeoutError
+
+
+def test_ready_when_the_database_answers(client):
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'ready'
+
+
+@pytest.mark.parametrize('error', [
+    ServerSelectionTimeoutError('localhost:27017: [Errno 111] Connection refused'),
+    AutoReconnect('connection closed'),
+], ids=['unreachable', 'connection-lost'])
+def test_database_down(app_module, client, monkeypatch, error):
+    def command(*args, **kwargs):
+        raise error
+
+    monkeypatch.setattr(app_module.mongo.cx.admin, 'command', command)
+
+    response = client.get('/readyz')
+    assert response.status_code == 503
+    assert response.get_json() == {'status': 'unavailable', 'database': str(error)}
+    # The process itself is alive, it must not be restarted for the database being down
+    response = client.get('/healthz')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'ok'
@@ -0,0 +1,31 @@
+# Required indexes and the dedupe-stage-records command
+
+from datetime import datetime, timedelta
+
+from indexes import dedupe_event_records, ensure_indexes, unique_event_indexes
+
+
+def test_duplicates_block_the_unique_index_until_deduped(app_module):
+    db = app_module.mongo.db
+    db.charges.drop_indexes()
+    created_at = datetime(2024, 1, 1)
+    db.charges.insert_many([
+        {'barcode_number': 'a', 'order_number': '1', 'created_at': created_at},
+        {'barcode_number': 'a', 'order_number': '1', 'created_at': created_at + timedelta(minutes=5)},
+        {'barcode_number': 'b', 'order_number': '1', 'created_at': created_at},
+    ])
+
+    failures = ensure_indexes(db, strict=False)
+    assert [failure.split(':')[0] for failure in failures] == ['charges.barcode_number_unique']
+    assert not unique_event_indexes(db)
+
+    assert dedupe_event_records(db, dry_run=True)['charges'] == 1
+    assert db.charges.count_documents({}) == 3
+
+    result = app_module.app.test_cli_runner().invoke(args=['dedupe-stage-records'])
+    assert result.exit_code == 0, result.output
+    # The earliest record is kept, the later one is moved aside
+    assert db.charges.find_one({'barcode_number': 'a'})['created_at'] == created_at
+    moved = db.stage_duplicates.find_one()
+    assert (moved['collection'], moved['record']['created_at']) == ('charges', created_at + timedelta(minutes=5))
+    assert unique_event_indexes(db)
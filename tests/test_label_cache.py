@@ -0,0 +1,135 @@
+# Label cache: the process LRU, the SQLite tier shared by the processes of a host, and its failures
+
+import asyncio
+import sqlite3
+
+import pytest
+
+from label_cache import LabelCache, SharedLabelStore
+
+LABELS = {
+    '0000054321080001': {'order_number': '0000054321', 'shoe_size': '8'},
+    '0000054321090001': {'order_number': '0000054321', 'shoe_size': '9'},
+    '0000054321100001': {'order_number': '0000054321', 'shoe_size': '10'},
+}
+
+
+# A database read returning the labels of LABELS, recording the barcodes it was asked for
+class Loader:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, barcode_numbers):
+        self.calls.append(sorted(barcode_numbers))
+        return {barcode_number: dict(LABELS[barcode_number], _id='x')
+                for barcode_number in barcode_numbers if barcode_number in LABELS}
+
+
+def test_labels_are_read_once():
+    cache = LabelCache(max_size=10)
+    load = Loader()
+
+    assert cache.get('0000054321080001', load) == LABELS['0000054321080001']
+    assert cache.get_many(list(LABELS) + ['0000099999080001'], load) == LABELS
+    assert cache.get('0000099999080001', load) is None
+    # Unknown barcodes are asked for again, known ones never
+    assert load.calls == [['0000054321080001'], ['0000054321090001', '0000054321100001', '0000099999080001'], ['0000099999080001']]
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 5)
+
+
+def test_least_recently_used_labels_are_evicted():
+    cache = LabelCache(max_size=2)
+    load = Loader()
+    first, second, third = LABELS
+
+    cache.get_many([first, second], load)
+    cache.get(first, load)
+    cache.get(third, load)
+    load.calls.clear()
+    cache.get_many([first, third], load)
+    assert load.calls == []
+    cache.get(second, load)
+    assert load.calls == [[second]]
+
+
+def test_shared_tier_answers_other_processes(tmp_path):
+    path = str(tmp_path / 'labels.sqlite')
+    load = Loader()
+    LabelCache(shared=SharedLabelStore(path)).warm({'0000054321080001': LABELS['0000054321080001']})
+    LabelCache(shared=SharedLabelStore(path)).get('0000054321090001', load)
+
+    # A third process finds both in the file, without reading the database
+    cache = LabelCache(shared=SharedLabelStore(path))
+    assert cache.get_many(['0000054321080001', '0000054321090001'], load) == {
+        barcode_number: LABELS[barcode_number] for barcode_number in ('0000054321080001', '0000054321090001')}
+    assert load.calls == [['0000054321090001']]
+    stats = cache.stats()
+    assert (stats['shared_hits'], stats['misses'], stats['shared_errors']) == (2, 0, 0)
+
+
+def test_async_lookups_use_the_shared_tier(tmp_path):
+    path = str(tmp_path / 'labels.sqlite')
+    load = Loader()
+
+    async def load_async(barcode_numbers):
+        return load(barcode_numbers)
+
+    cache = LabelCache(shared=SharedLabelStore(path))
+    assert asyncio.run(cache.get_many_async(list(LABELS), load_async)) == LABELS
+    other = LabelCache(shared=SharedLabelStore(path))
+    assert asyncio.run(other.get_many_async(list(LABELS), load_async)) == LABELS
+    assert len(load.calls) == 1
+
+
+# A shared tier that cannot be opened counts its errors, and every lookup falls through to the database
+def test_unavailable_shared_tier_falls_back_to_the_database(tmp_path):
+    store = SharedLabelStore(str(tmp_path / 'missing' / 'labels.sqlite'))
+    assert store.errors == 1
+    cache = LabelCache(shared=store)
+    load = Loader()
+
+    assert cache.get('0000054321080001', load) == LABELS['0000054321080001']
+    assert cache.get('0000054321080001', load) == LABELS['0000054321080001']
+    assert load.calls == [['0000054321080001']]
+    stats = cache.stats()
+    assert stats['shared_errors'] == 3
+    assert 'unable to open database file' in stats['shared_last_error']
+
+
+def test_shared_tier_recovers_after_an_error(tmp_path, monkeypatch):
+    path = str(tmp_path / 'labels.sqlite')
+    store = SharedLabelStore(path)
+    store.put_many({'0000054321080001': LABELS['0000054321080001']})
+
+    # The file is locked by another process past the busy timeout
+    def locked(self):
+        raise sqlite3.OperationalError('database is locked')
+
+    with monkeypatch.context() as patched:
+        patched.setattr(SharedLabelStore, '_connection', locked)
+        assert store.get_many(['0000054321080001']) == {}
+        assert not store.put_many({'0000054321090001': LABELS['0000054321090001']})
+    assert store.errors == 2
+    assert store.get_many(['0000054321080001']) == {'0000054321080001': LABELS['0000054321080001']}
+
+
+def test_scans_use_the_shared_tier(app_module, client, token, labelled_order, monkeypatch, tmp_path):
+    barcode_numbers = labelled_order()[:2]
+    cache = LabelCache(shared=SharedLabelStore(str(tmp_path / 'labels.sqlite')))
+    monkeypatch.setattr(app_module, 'label_cache', cache)
+
+    for barcode_number in barcode_numbers:
+        assert client.get(f'/order/{barcode_number}').get_json() == {'order_number': '0000054321'}
+    # Another process of the host, with an empty process tier
+    monkeypatch.setattr(app_module, 'label_cache', LabelCache(shared=cache.shared))
+    response = client.post('/charge', json={'barcode_number': barcode_numbers[0]}, headers={'Authorization': token})
+    assert response.status_code == 201
+    stats = client.get('/label_cache_stats').get_json()
+    assert (stats['shared_hits'], stats['misses']) == (1, 0)
+
+
+@pytest.mark.parametrize('max_size', [0, 1])
+def test_tiny_process_tier_still_answers(max_size):
+    cache = LabelCache(max_size=max_size)
+    assert cache.get_many(list(LABELS), Loader()) == LABELS
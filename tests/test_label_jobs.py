@@ -0,0 +1,119 @@
+# Background label jobs: shared while in flight, leased to their worker, PDFs kept in GridFS
+
+import threading
+import time
+
+import mongomock
+import pytest
+
+from conftest import make_order
+from label_jobs import DONE, FAILED, RUNNING, LabelJobQueue
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().florence
+
+
+# A queue whose jobs write b'%PDF <order number>', each waiting for its gate when one is given
+def make_queue(db, gates=None, fail=False, during_job=None):
+    def run_job(order_number, output, report_progress):
+        gate = (gates or {}).get(order_number)
+        if gate:
+            assert gate.wait(10)
+        if during_job:
+            during_job(order_number)
+        if fail:
+            raise ValueError('no sizes')
+        output.write(f'%PDF {order_number}'.encode())
+        report_progress(1, 1)
+
+    return LabelJobQueue(db.label_jobs, run_job, db)
+
+
+def wait_for(queue, job_id, statuses=(DONE, FAILED), timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job['status'] in statuses:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f'Label job {job_id} is still {job["status"]}')
+
+
+def test_in_flight_job_is_shared_and_a_done_one_is_not(db):
+    gate = threading.Event()
+    queue = make_queue(db, gates={'0000000001': gate})
+
+    first = queue.submit('0000000001')
+    assert queue.submit('0000000001')['_id'] == first['_id']
+    gate.set()
+    first = wait_for(queue, first['_id'])
+    assert first['status'] == DONE
+    assert 'dedupe_key' not in first
+    assert queue.open_pdf(first).read() == b'%PDF 0000000001'
+
+    # Submitted again once done: a new PDF, and the previous one is deleted when it is ready
+    second = wait_for(queue, queue.submit('0000000001')['_id'])
+    assert second['_id'] != first['_id']
+    assert queue.open_pdf(second).read() == b'%PDF 0000000001'
+    assert queue.get(first['_id'])['file_id'] is None
+    assert queue.open_pdf(queue.get(first['_id'])) is None
+    assert db['label_pdfs.files'].count_documents({}) == 1
+
+
+def test_failed_job_frees_the_order(db):
+    queue = make_queue(db, fail=True)
+    job = wait_for(queue, queue.submit('0000000001')['_id'])
+
+    assert job['status'] == FAILED
+    assert job['error'] == 'no sizes'
+    assert db['label_pdfs.files'].count_documents({}) == 0
+    assert queue.submit('0000000001')['_id'] != job['_id']
+
+
+# A worker whose job was claimed by another one drops its PDF and leaves the job alone
+def test_worker_that_lost_its_lease_discards_its_pdf(db):
+    def take_over(order_number):
+        db.label_jobs.update_one({'order_number': order_number}, {'$set': {'owner': 'another-worker'}})
+
+    queue = make_queue(db, during_job=take_over)
+    job_id = queue.submit('0000000001')['_id']
+
+    deadline = time.monotonic() + 10
+    while db.label_jobs.find_one({'_id': job_id})['owner'] != 'another-worker' and time.monotonic() < deadline:
+        time.sleep(0.02)
+    time.sleep(0.2)
+
+    job = queue.get(job_id)
+    assert (job['status'], job['owner'], job['file_id']) == (RUNNING, 'another-worker', None)
+    assert db['label_pdfs.files'].count_documents({}) == 0
+
+
+def test_done_job_of_an_earlier_version_does_not_block_the_order(db):
+    queue = make_queue(db)
+    job = wait_for(queue, queue.submit('0000000001')['_id'])
+    db.label_jobs.update_one({'_id': job['_id']}, {'$set': {'dedupe_key': '0000000001'}})
+
+    assert queue.submit('0000000001')['_id'] != job['_id']
+
+
+def test_label_job_route(client):
+    client.post('/submit_order', json=make_order(sizes_quantities=[{'size': '8', 'quantity': 12}, {'size': '9', 'quantity': 8}]))
+
+    response = client.post('/generate_barcode', json={'order_number': '0000054321', 'async': True})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+
+    deadline = time.monotonic() + 10
+    while client.get(f'/label_jobs/{job_id}').get_json()['status'] not in (DONE, FAILED) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    job = client.get(f'/label_jobs/{job_id}').get_json()
+    assert job['status'] == DONE
+    assert job['progress'] == {'done': 20, 'total': 20}
+
+    response = client.get(f'/label_jobs/{job_id}/pdf')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
+    assert response.data.startswith(b'%PDF-')
+    assert client.get('/label_jobs/unknown').status_code == 404
@@ -0,0 +1,41 @@
+# Labels PDF of /generate_barcode: built in memory or streamed page by page, with bitmaps or vector bars
+
+import io
+
+import pytest
+
+from conftest import make_order
+
+SIZES_QUANTITIES = [{'size': '8', 'quantity': 12}, {'size': '9', 'quantity': 8}]
+
+
+def pdf_pages(data):
+    pypdf = pytest.importorskip('pypdf')
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    return [page.extract_text() for page in reader.pages]
+
+
+# 18 labels per page: the order's 20 labels take two pages in every mode
+@pytest.mark.parametrize('streaming', [False, True], ids=['buffered', 'streamed'])
+@pytest.mark.parametrize('render_mode', ['vector', 'image'])
+def test_label_pdf(app_module, client, monkeypatch, streaming, render_mode):
+    monkeypatch.setitem(app_module.app.config, 'LABEL_PDF_STREAMING', streaming)
+    monkeypatch.setitem(app_module.app.config, 'LABEL_RENDER_MODE', render_mode)
+    client.post('/submit_order', json=make_order(sizes_quantities=SIZES_QUANTITIES))
+
+    response = client.post('/generate_barcode', json={'order_number': '0000054321'})
+
+    assert response.status_code == 201
+    assert response.mimetype == 'application/pdf'
+    assert response.data.startswith(b'%PDF-')
+    pages = pdf_pages(response.data)
+    assert len(pages) == 2
+    if render_mode == 'vector':
+        # The number is printed under the bars
+        assert '0000054321080001' in pages[0]
+        assert '0000054321090008' in pages[1]
+    assert app_module.barcode_images_collection.count_documents({'order_number': '0000054321'}) == 20
+
+
+def test_unknown_order(client):
+    assert client.post('/generate_barcode', json={'order_number': '0000099999'}).status_code == 404
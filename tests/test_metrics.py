@@ -0,0 +1,103 @@
+# Request and database instrumentation: the command listener, N+1 detection and /metrics
+
+import logging
+import types
+
+from metrics import Metrics, MongoCommandListener
+
+
+def command_event(name, micros):
+    return types.SimpleNamespace(command_name=name, duration_micros=micros)
+
+
+# {sample name with labels: value} of the Prometheus text format, and the declared types
+def parse(text):
+    samples, types_ = {}, {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, metric_type = line.split(' ')
+            types_[name] = metric_type
+        elif line and not line.startswith('#'):
+            sample, value = line.rsplit(' ', 1)
+            samples[sample] = float(value)
+    return samples, types_
+
+
+def test_commands_are_counted_against_their_request():
+    metrics = Metrics()
+    listener = MongoCommandListener(metrics)
+
+    stats, token = metrics.start_request()
+    listener.succeeded(command_event('find', 1500))
+    listener.succeeded(command_event('find', 2500))
+    listener.failed(command_event('insert', 300000))
+    stats.status = 201
+    metrics.finish_request(stats, token, '/charge', 'POST')
+    # Outside a request: in the command histograms only
+    listener.succeeded(command_event('find', 100))
+
+    samples, types_ = parse(metrics.render())
+    assert samples['florence_requests_total{route="/charge",method="POST",status="201"}'] == 1
+    assert samples['florence_request_queries_count{route="/charge"}'] == 1
+    assert samples['florence_request_queries_sum{route="/charge"}'] == 3
+    assert samples['florence_request_queries_bucket{route="/charge",le="3"}'] == 1
+    assert samples['florence_request_queries_bucket{route="/charge",le="2"}'] == 0
+    assert samples['florence_mongo_command_duration_seconds_count{command="find"}'] == 3
+    assert samples['florence_mongo_command_duration_seconds_bucket{command="find",le="0.0025"}'] == 3
+    assert samples['florence_mongo_command_duration_seconds_bucket{command="find",le="0.001"}'] == 1
+    assert samples['florence_mongo_command_failures_total{command="insert"}'] == 1
+    assert types_['florence_requests_total'] == 'counter'
+    assert types_['florence_request_duration_seconds'] == 'histogram'
+
+
+def test_requests_past_the_threshold_are_flagged(caplog):
+    logger = logging.getLogger('test_metrics')
+    metrics = Metrics(n_plus_one_threshold=2, logger=logger)
+    listener = MongoCommandListener(metrics)
+
+    for queries in (2, 5):
+        stats, token = metrics.start_request()
+        for _ in range(queries):
+            listener.succeeded(command_event('find', 100))
+        stats.status = 200
+        with caplog.at_level(logging.WARNING, logger='test_metrics'):
+            metrics.finish_request(stats, token, '/report/<orderNumber>', 'GET')
+
+    samples, _ = parse(metrics.render())
+    assert samples['florence_n_plus_one_requests_total{route="/report/<orderNumber>"}'] == 1
+    assert [record.getMessage() for record in caplog.records] == [
+        'GET /report/<orderNumber> issued 5 database commands (find=5), more than 2: N+1 query pattern?']
+
+
+def test_collectors_declare_each_metric_once():
+    metrics = Metrics()
+    metrics.collectors.append(lambda: [
+        ('florence_cache_lookups_total', 'counter', 'Lookups', [('tier', 'process')], 3),
+        ('florence_cache_lookups_total', 'counter', 'Lookups', [('tier', 'shared')], 1),
+        ('florence_cache_size', 'gauge', 'Entries', [], 7),
+    ])
+    text = metrics.render()
+    assert text.count('# TYPE florence_cache_lookups_total counter') == 1
+    samples, types_ = parse(text)
+    assert samples['florence_cache_lookups_total{tier="shared"}'] == 1
+    assert (samples['florence_cache_size'], types_['florence_cache_size']) == (7, 'gauge')
+
+
+def test_metrics_endpoint(app_module, client, token, labelled_order):
+    barcode_number = labelled_order()[0]
+    for _ in range(2):
+        client.post('/charge', json={'barcode_number': barcode_number}, headers={'Authorization': token})
+    body = client.get('/view/0000054321?format=ndjson').data
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    samples, types_ = parse(response.get_data(as_text=True))
+    assert samples['florence_requests_total{route="/charge",method="POST",status="201"}'] >= 1
+    assert samples['florence_requests_total{route="/charge",method="POST",status="400"}'] >= 1
+    assert samples['florence_requests_total{route="/view/<orderNumber>",method="GET",status="200"}'] >= 1
+    # The streamed export is measured once its body has been sent
+    assert samples['florence_response_bytes_sum{route="/view/<orderNumber>"}'] >= len(body)
+    assert samples['florence_token_cache_hits_total'] >= 1
+    assert 'florence_login_audit_pending' in samples
+    assert all(name.endswith('_total') for name, metric_type in types_.items() if metric_type == 'counter')
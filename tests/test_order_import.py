@@ -0,0 +1,91 @@
+# /import_orders: orders upserted by order number from JSON, NDJSON and CSV files
+
+import csv
+import io
+import json
+
+from conftest import make_order
+
+
+def import_file(client, body, import_format):
+    return client.post(f'/import_orders?format={import_format}', data=body)
+
+
+def test_json_import_reports_invalid_records(app_module, client):
+    orders = [
+        make_order('0000000001'),
+        dict(make_order('0000000002'), order_pairs=99),
+        make_order('0000000003'),
+    ]
+    response = import_file(client, json.dumps(orders), 'json')
+
+    assert response.status_code == 207
+    summary = response.get_json()
+    assert (summary['inserted'], summary['updated'], summary['failed']) == (2, 0, 1)
+    assert summary['errors'][0]['record'] == 1
+    assert summary['errors'][0]['order_number'] == '0000000002'
+    assert app_module.orders_collection.count_documents({}) == 2
+
+
+def test_import_updates_existing_orders_in_place(app_module, client):
+    import_file(client, json.dumps([make_order('0000000001'), make_order('0000000002')]), 'json')
+    sl_no = app_module.orders_collection.find_one({'order_number': '0000000001'})['sl_no']
+
+    body = json.dumps(make_order('0000000001', color='Blue')) + '\n' + json.dumps(make_order('0000000004')) + '\n'
+    response = import_file(client, body, 'ndjson')
+
+    assert response.status_code == 200
+    summary = response.get_json()
+    assert (summary['inserted'], summary['updated'], summary['failed']) == (1, 1, 0)
+    order = app_module.orders_collection.find_one({'order_number': '0000000001'})
+    assert order['color'] == 'Blue'
+    # The Sl.No. and creation time of an order are kept
+    assert order['sl_no'] == sl_no
+    assert app_module.orders_collection.count_documents({}) == 3
+
+
+def test_repeated_order_in_one_file_keeps_the_last(app_module, client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'ORDER_IMPORT_BATCH_SIZE', 10)
+    body = '\n'.join(json.dumps(make_order('0000000001', color=color)) for color in ('Red', 'Green', 'Blue'))
+    summary = import_file(client, body, 'ndjson').get_json()
+
+    assert (summary['inserted'], summary['updated']) == (1, 2)
+    assert app_module.orders_collection.find_one({'order_number': '0000000001'})['color'] == 'Blue'
+
+
+def test_csv_import_with_size_pairs(app_module, client):
+    order = make_order('0000000001', sizes_quantities=[{'size': '8', 'quantity': 30}, {'size': '9.5', 'quantity': 20}])
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=list(order))
+    writer.writeheader()
+    writer.writerow(dict(order, sizes_quantities='8:30; 9.5:20'))
+
+    response = client.post('/import_orders', data=output.getvalue(), content_type='text/csv')
+
+    assert response.status_code == 200
+    assert response.get_json()['inserted'] == 1
+    stored = app_module.orders_collection.find_one({'order_number': '0000000001'})
+    assert stored['sizes_quantities'] == [{'size': '8', 'quantity': 30}, {'size': '9.5', 'quantity': 20}]
+    assert stored['order_pairs'] == 50
+
+
+def test_unknown_format_is_refused(client):
+    assert import_file(client, '', 'xml').status_code == 400
+
+
+def test_import_orders_command(app_module, tmp_path):
+    path = tmp_path / 'orders.ndjson'
+    path.write_text('\n'.join(json.dumps(make_order(f'000000000{number}')) for number in range(3)) + '\n{"order_number": ""}\n')
+
+    result = app_module.app.test_cli_runner().invoke(args=['import-orders', str(path)])
+    assert result.exit_code == 0, result.output
+    assert 'Imported orders: 3 inserted, 0 updated, 1 failed' in result.output
+    assert app_module.orders_collection.count_documents({}) == 3
+
+    result = app_module.app.test_cli_runner().invoke(args=['import-orders', str(tmp_path / 'orders.ndjson'), '--format', 'ndjson'])
+    assert 'Imported orders: 0 inserted, 3 updated, 1 failed' in result.output
+
+    (tmp_path / 'orders.txt').write_text('')
+    result = app_module.app.test_cli_runner().invoke(args=['import-orders', str(tmp_path / 'orders.txt')])
+    assert result.exit_code != 0
+    assert 'use --format' in result.output
@@ -0,0 +1,78 @@
+# /orders: filtered, projected listing paged with keyset cursors
+
+from datetime import datetime, timedelta
+
+from bson import json_util
+from bson.objectid import ObjectId
+
+from conftest import make_order
+
+
+# Orders whose created_at repeat, so pages have to break ties on _id
+def insert_orders(app_module, count=7):
+    created_at = datetime(2024, 1, 1)
+    orders = [
+        dict(make_order(f'{number:010d}', customer='Acme' if number % 2 else 'Globex'),
+             _id=ObjectId(), sl_no=number, created_at=created_at + timedelta(minutes=number // 3))
+        for number in range(count)
+    ]
+    app_module.orders_collection.insert_many(orders)
+    return orders
+
+
+def order_numbers(response):
+    return [order['order_number'] for order in json_util.loads(response.data)]
+
+
+# Follow X-Next-Cursor to the last page, returns the order numbers of each page
+def read_pages(client, query, cursor=None):
+    pages = []
+    response = client.get(f'/orders?{query}&cursor={cursor}' if cursor else f'/orders?{query}')
+    while True:
+        assert response.status_code == 200
+        pages.append(order_numbers(response))
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            return pages
+        response = client.get(f'/orders?{query}&cursor={cursor}')
+
+
+def test_without_limit_every_order_is_listed_oldest_first(app_module, client):
+    orders = insert_orders(app_module)
+    response = client.get('/orders')
+    assert 'X-Next-Cursor' not in response.headers
+    assert order_numbers(response) == [order['order_number'] for order in orders]
+
+
+def test_pages_cover_every_order_once(app_module, client):
+    orders = insert_orders(app_module)
+    pages = read_pages(client, 'limit=2')
+
+    assert [len(page) for page in pages] == [2, 2, 2, 1]
+    assert [number for page in pages for number in page] == [order['order_number'] for order in orders]
+
+
+def test_orders_added_behind_the_cursor_are_not_repeated(app_module, client):
+    insert_orders(app_module)
+    first = client.get('/orders?limit=3')
+    app_module.orders_collection.insert_one(dict(make_order('0000000099'), created_at=datetime(2023, 1, 1)))
+
+    rest = read_pages(client, 'limit=3', first.headers['X-Next-Cursor'])
+    seen = order_numbers(first) + [number for page in rest for number in page]
+    assert len(seen) == len(set(seen)) == 7
+    assert '0000000099' not in seen
+
+
+def test_filter_and_projection(app_module, client):
+    insert_orders(app_module)
+    pages = read_pages(client, 'customer=Acme&limit=2&fields=order_number,customer')
+    assert [number for page in pages for number in page] == ['0000000001', '0000000003', '0000000005']
+
+    order = json_util.loads(client.get('/orders?customer=Acme&limit=1&fields=customer').data)[0]
+    assert set(order) == {'_id', 'customer', 'created_at'}
+
+
+def test_bad_cursor_and_limit_are_refused(client):
+    assert client.get('/orders?cursor=not-a-cursor').status_code == 400
+    assert client.get('/orders?limit=0').status_code == 400
+    assert client.get('/orders?limit=many').status_code == 400
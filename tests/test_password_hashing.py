@@ -0,0 +1,75 @@
+# Password hashing: parameters of stored hashes, rehash on login and the bound on pending hashes
+
+import threading
+import time
+
+import pytest
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from password_hashing import PasswordHasher, PasswordHasherBusy
+
+
+def test_hash_and_verify():
+    hasher = PasswordHasher(method='pbkdf2:sha256:1000', workers=1)
+    password_hash = hasher.hash('secret')
+
+    assert password_hash.startswith('pbkdf2:sha256:1000$')
+    assert hasher.verify(password_hash, 'secret')
+    assert not hasher.verify(password_hash, 'wrong')
+    assert not hasher.needs_rehash(password_hash)
+
+
+@pytest.mark.parametrize('password_hash', [
+    generate_password_hash('secret', method='pbkdf2:sha256:500'),        # other iterations
+    generate_password_hash('secret', method='pbkdf2:sha512:1000'),       # other digest
+    generate_password_hash('secret', method='pbkdf2:sha256:1000', salt_length=8),
+    'secret',                                                             # not a werkzeug hash
+], ids=['iterations', 'digest', 'salt-length', 'plain'])
+def test_needs_rehash_when_parameters_differ(password_hash):
+    assert PasswordHasher(method='pbkdf2:sha256:1000', salt_length=16).needs_rehash(password_hash)
+
+
+# A method without parameters compares against werkzeug's full defaults for it
+def test_needs_rehash_expands_default_parameters():
+    hasher = PasswordHasher(method='pbkdf2', salt_length=16)
+    assert hasher.hash_method.startswith('pbkdf2:sha256:')
+    assert not hasher.needs_rehash(generate_password_hash('secret', method=hasher.hash_method, salt_length=16))
+
+
+def test_busy_past_max_pending():
+    hasher = PasswordHasher(method='pbkdf2:sha256:1000', workers=1, max_pending=1)
+    release = threading.Event()
+    running = hasher._submit(release.wait, 10)
+    waiting = hasher._submit(release.wait, 10)
+
+    with pytest.raises(PasswordHasherBusy):
+        hasher.hash('secret')
+    release.set()
+    running.result(10)
+    waiting.result(10)
+    assert hasher.verify(hasher.hash('secret'), 'secret')
+
+
+def test_login_rehashes_a_password_stored_with_older_parameters(app_module, client):
+    old_hash = generate_password_hash('secret', method='pbkdf2:sha256:500', salt_length=8)
+    app_module.users_collection.insert_one({'username': 'legacy', 'password': old_hash})
+
+    assert client.post('/login', json={'username': 'legacy', 'password': 'secret'}).status_code == 200
+    deadline = time.monotonic() + 10
+    while app_module.users_collection.find_one({'username': 'legacy'})['password'] == old_hash and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    new_hash = app_module.users_collection.find_one({'username': 'legacy'})['password']
+    assert not app_module.password_hasher.needs_rehash(new_hash)
+    assert check_password_hash(new_hash, 'secret')
+    assert client.post('/login', json={'username': 'legacy', 'password': 'secret'}).status_code == 200
+
+
+def test_login_is_refused_while_the_hasher_is_busy(app_module, client, token, monkeypatch):
+    def busy(password_hash, password):
+        raise PasswordHasherBusy()
+
+    monkeypatch.setattr(app_module.password_hasher, 'verify', busy)
+    response = client.post('/login', json={'username': 'tester', 'password': 'secret'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
@@ -0,0 +1,87 @@
+# /report/<orderNumber>: counts from the stage records and from the order progress counters
+
+import pytest
+
+from report_engine import build_report
+
+SIZES_QUANTITIES = [{'size': '8', 'quantity': 3}, {'size': '9', 'quantity': 2}]
+
+
+@pytest.fixture(params=[
+    (False, False), (True, False), (False, True), (True, True),
+], ids=['records', 'progress-records', 'counters', 'progress-counters'])
+def report_mode(request, app_module, monkeypatch):
+    progress, counters = request.param
+    monkeypatch.setitem(app_module.app.config, 'BARCODE_PROGRESS_STORAGE', progress)
+    monkeypatch.setitem(app_module.app.config, 'ORDER_PROGRESS_COUNTERS', counters)
+
+
+def scan(client, token, stage_name, barcode_number):
+    response = client.post(f'/{stage_name}', json={'barcode_number': barcode_number}, headers={'Authorization': token})
+    assert response.status_code == 201, response.get_json()
+
+
+def test_report_counts_each_stage(report_mode, client, token, labelled_order):
+    barcode_numbers = labelled_order(sizes_quantities=SIZES_QUANTITIES)
+    size_8, size_9 = barcode_numbers[:3], barcode_numbers[3:]
+    for barcode_number in size_8 + size_9[:1]:
+        scan(client, token, 'charge', barcode_number)
+    for barcode_number in size_8[:2]:
+        scan(client, token, 'stage1', barcode_number)
+    scan(client, token, 'stage2', size_8[0])
+
+    response = client.get('/report/0000054321')
+    assert response.status_code == 200
+    report = response.get_json()
+
+    # A stage is completed once the pair reached the next one
+    size_report = report['sizes']['8']
+    assert (size_report['completed_charge_count'], size_report['pending_charge_count']) == (2, 1)
+    assert size_report['stage_completion_counts']['stage1'] == {'completed': 1, 'pending': 1}
+    assert size_report['stage_completion_counts']['stage2'] == {'completed': 0, 'pending': 1}
+    assert size_report['stage_completion_counts']['stage3'] == {'completed': 0, 'pending': 0}
+    assert (report['sizes']['9']['completed_charge_count'], report['sizes']['9']['pending_charge_count']) == (0, 1)
+
+    totals = report['total_summary']
+    assert totals['total_quantity'] == 5
+    assert (totals['total_completed_charge'], totals['total_pending_charge']) == (2, 2)
+    assert (totals['total_stage1_completed'], totals['total_stage1_pending']) == (1, 1)
+    assert (totals['total_stage2_completed'], totals['total_stage2_pending']) == (0, 1)
+    assert all(totals[f'total_stage{stage}_{state}'] == 0 for stage in range(3, 7) for state in ('completed', 'pending'))
+
+
+def test_report_of_unknown_order(client):
+    assert client.get('/report/0000099999').status_code == 404
+
+
+def test_build_report_matches_sizes_written_differently():
+    sizes_quantities = [{'size': '8.0', 'quantity': 2}, {'size': '10.5', 'quantity': 1}]
+    charge_entries = [('a', '8'), ('b', '8.0'), ('c', '10.5'), ('d', '12')]
+    stage_sets = [{'a', 'c'}, {'a'}, set(), set(), set(), set()]
+
+    report_data, total_data = build_report(sizes_quantities, charge_entries, stage_sets)
+
+    assert report_data['8.0']['completed_charge_count'] == 1
+    assert report_data['8.0']['pending_charge_count'] == 1
+    assert report_data['10.5']['stage_completion_counts']['stage1'] == {'completed': 0, 'pending': 1}
+    # A charge of a size the order does not have is left out
+    assert total_data['total_completed_charge'] + total_data['total_pending_charge'] == 3
+
+
+# A counter left one short (the process died between the stage write and the $inc) is found and rebuilt
+def test_rebuild_order_progress_command(app_module, client, token, labelled_order, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'ORDER_PROGRESS_COUNTERS', True)
+    for barcode_number in labelled_order(sizes_quantities=SIZES_QUANTITIES)[:2]:
+        scan(client, token, 'charge', barcode_number)
+    report = client.get('/report/0000054321').get_json()
+    app_module.order_progress_collection.update_one({'_id': '0000054321'}, {'$inc': {'counts.8.charge': -1}})
+    runner = app_module.app.test_cli_runner()
+
+    result = runner.invoke(args=['rebuild-order-progress', '--verify'])
+    assert '0000054321 size 8 charge: counter 1, records 2' in result.output
+    assert '1 of 1 orders have drifted counters' in result.output
+
+    result = runner.invoke(args=['rebuild-order-progress', '--order', '0000054321'])
+    assert 'Rebuilt the progress counters of 1 orders' in result.output
+    assert '0 of 1 orders' in runner.invoke(args=['rebuild-order-progress', '--verify']).output
+    assert client.get('/report/0000054321').get_json() == report
@@ -0,0 +1,103 @@
+# /scan_batch: the same answers as single scans, per-event errors and concurrent scans
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import reset_database, scan, stable
+
+
+def post_batch(client, token, events):
+    return client.post('/scan_batch', headers={'Authorization': token}, json={'events': events})
+
+
+def test_batch_answers_like_single_scans(storage, app_module, client, token, labelled_order):
+    barcode_numbers = labelled_order()[:4]
+    scans = [
+        (barcode_numbers[0], 'charge'), (barcode_numbers[0], 'stage1'), (barcode_numbers[0], 'stage2'),
+        (barcode_numbers[1], 'stage1'), (barcode_numbers[1], 'charge'), (barcode_numbers[1], 'charge'),
+        (barcode_numbers[2], 'charge'), (barcode_numbers[2], 'stage2'),
+        ('0000099999080001', 'charge'),
+    ]
+    single = [(response.status_code, stable(response.get_json()))
+              for response in (scan(client, token, stage_name, barcode_number) for barcode_number, stage_name in scans)]
+    report = client.get('/report/0000054321').get_json()
+
+    # Same scans as one batch, from the same starting point
+    reset_database()
+    labelled_order()
+    response = post_batch(client, token, [
+        {'barcode_number': barcode_number, 'stage': stage_name} for barcode_number, stage_name in scans
+    ])
+    assert response.status_code == 200
+    batch = [(result['status'], stable(result['response'])) for result in response.get_json()['results']]
+    assert batch == single
+    assert client.get('/report/0000054321').get_json() == report
+
+
+def test_batch_rejects_unknown_stage_and_bad_time(client, token):
+    response = post_batch(client, token, [
+        {'barcode_number': '0000054321080001', 'stage': 'stage9'},
+        {'barcode_number': '0000054321080001', 'stage': 'charge', 'scanned_at': 'yesterday'},
+    ])
+    assert [(result['status'], result['response']['message']) for result in response.get_json()['results']] == [
+        (400, 'Unknown stage!'), (400, 'Invalid scanned_at!')
+    ]
+
+
+# Events of the wrong JSON type are refused one by one, the rest of the batch is applied
+def test_batch_refuses_events_of_the_wrong_type(client, token, labelled_order):
+    barcode_number = labelled_order()[0]
+    response = post_batch(client, token, [
+        {'barcode_number': 5432108000100001, 'stage': 'charge'},
+        {'barcode_number': [barcode_number], 'stage': 'charge'},
+        {'barcode_number': barcode_number, 'stage': ['charge']},
+        {'barcode_number': barcode_number, 'stage': {'name': 'charge'}},
+        'charge',
+        {'barcode_number': barcode_number, 'stage': 'charge'},
+    ])
+    assert response.status_code == 200
+    assert [(result['status'], result['response']['message']) for result in response.get_json()['results']] == [
+        (400, 'Barcode number must be a string!'),
+        (400, 'Barcode number must be a string!'),
+        (400, 'Unknown stage!'),
+        (400, 'Unknown stage!'),
+        (400, 'Barcode number is required!'),
+        (201, 'Charge started successfully!'),
+    ]
+
+
+# A live scan of a barcode lands between the batch reading its records and writing its own:
+# the batch's charge is refused, and its stage1 is planned again on the live charge
+@pytest.mark.parametrize('progress', [False, True], ids=['collections', 'progress'])
+def test_batch_replans_after_concurrent_scan(progress, app_module, client, token, labelled_order, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'BARCODE_PROGRESS_STORAGE', progress)
+    monkeypatch.setitem(app_module.app.config, 'UNIQUE_STAGE_RECORDS', True)
+    barcode_number = labelled_order()[0]
+
+    load_records = app_module.load_stage_events_bulk
+    live_scans = []
+
+    def racing_load(barcode_numbers, stages):
+        records = load_records(barcode_numbers, stages)
+        if not live_scans:
+            live_scans.append(scan(client, token, 'charge', barcode_number).status_code)
+        return records
+
+    monkeypatch.setattr(app_module, 'load_stage_events_bulk', racing_load)
+    now = datetime.utcnow()
+    response = post_batch(client, token, [
+        {'barcode_number': barcode_number, 'stage': 'charge', 'scanned_at': now.isoformat()},
+        {'barcode_number': barcode_number, 'stage': 'stage1', 'scanned_at': (now + timedelta(seconds=1)).isoformat()},
+        {'barcode_number': barcode_number, 'stage': 'stage2', 'scanned_at': (now + timedelta(seconds=2)).isoformat()},
+    ])
+
+    assert live_scans == [201]
+    results = response.get_json()['results']
+    assert [result['status'] for result in results] == [400, 201, 201]
+    assert results[0]['response']['message'] == 'Barcode is already in use for an active charge!'
+
+    charge, stage1 = app_module.load_stage_events(barcode_number, 0, 1)
+    assert stage1['start_time'] >= charge['start_time']
+    if not progress:
+        assert app_module.charges_collection.count_documents({'barcode_number': barcode_number}) == 1
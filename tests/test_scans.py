@@ -0,0 +1,88 @@
+# Scan routes (/charge, /stage1 .. /stage6), driven by the stage table, in both storages
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import scan
+from stages import STAGES
+
+STAGE_NAMES = [stage.name for stage in STAGES]
+
+
+def test_scan_requires_token(client):
+    response = client.post('/charge', json={'barcode_number': '0000054321080001'})
+    assert response.status_code == 401
+
+
+def test_charge_unknown_barcode(storage, client, token):
+    response = scan(client, token, 'charge', '0000099999080001')
+    assert response.status_code == 404
+    assert response.get_json()['message'] == 'Order not found for the given barcode number!'
+
+
+def test_charge_records_order_and_size(storage, client, token, labelled_order):
+    barcode_number = labelled_order()[0]
+    response = scan(client, token, 'charge', barcode_number)
+    assert response.status_code == 201
+    body = response.get_json()
+    assert body['message'] == 'Charge started successfully!'
+    assert body['order_number'] == '0000054321'
+    start_time = datetime.fromisoformat(body['start_time'])
+    assert datetime.fromisoformat(body['end_time']) - start_time == timedelta(minutes=45)
+
+
+def test_second_scan_of_a_stage_is_refused(storage, client, token, labelled_order):
+    barcode_number = labelled_order()[0]
+    assert scan(client, token, 'charge', barcode_number).status_code == 201
+    response = scan(client, token, 'charge', barcode_number)
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Barcode is already in use for an active charge!'
+
+
+def test_stage_requires_previous_stage(storage, client, token, labelled_order):
+    barcode_number = labelled_order()[0]
+    response = scan(client, token, 'stage1', barcode_number)
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Charge process for this barcode is not completed. Cannot proceed to Stage 1.'
+
+    assert scan(client, token, 'charge', barcode_number).status_code == 201
+    response = scan(client, token, 'stage3', barcode_number)
+    assert response.status_code == 404
+    assert response.get_json()['message'] == 'Stage2 data not found for this barcode!'
+
+
+# Every row of the stage table is a route, refusing a barcode that has not been through the previous row
+@pytest.mark.parametrize('stage', STAGES[1:], ids=STAGE_NAMES[1:])
+def test_each_stage_answers_from_its_row(storage, client, token, labelled_order, stage):
+    barcode_number = labelled_order()[0]
+    for stage_name in STAGE_NAMES[:stage.number - 1]:
+        assert scan(client, token, stage_name, barcode_number).status_code == 201
+    response = scan(client, token, stage.name, barcode_number)
+    assert (response.status_code, response.get_json()['message']) == (stage.missing_status, stage.missing_message)
+
+    assert scan(client, token, STAGE_NAMES[stage.number - 1], barcode_number).status_code == 201
+    response = scan(client, token, stage.name, barcode_number)
+    assert (response.status_code, response.get_json()['message']) == (201, stage.success_message)
+
+
+def test_full_route(storage, client, token, labelled_order):
+    barcode_number = labelled_order()[0]
+    bodies = {}
+    for stage_name in STAGE_NAMES:
+        response = scan(client, token, stage_name, barcode_number)
+        assert response.status_code == 201, (stage_name, response.get_json())
+        bodies[stage_name] = response.get_json()
+
+    assert bodies['stage1']['delay_status'] == 'On time'
+    assert bodies['stage2']['delay_message'] == 'On time'
+    # Stage6 starts 15 minutes after the end of stage5 (as stored, to the millisecond)
+    stage5_end = datetime.fromisoformat(bodies['stage5']['stage5_end_time'])
+    stage6_start = datetime.fromisoformat(bodies['stage6']['stage6_start_time'])
+    assert abs(stage6_start - stage5_end - timedelta(minutes=15)) < timedelta(milliseconds=1)
+
+
+def test_order_lookup(client, labelled_order):
+    barcode_number = labelled_order()[0]
+    assert client.get(f'/order/{barcode_number}').get_json() == {'order_number': '0000054321'}
+    assert client.get('/order/0000099999080001').status_code == 404
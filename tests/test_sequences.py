@@ -0,0 +1,82 @@
+# Block sequences: blocks reserved per process, numbers given out before the sequence, the upper bound
+
+import threading
+
+import mongomock
+import pytest
+
+from conftest import make_order
+from sequences import BlockSequence, SequenceExhausted
+
+
+@pytest.fixture
+def counters():
+    return mongomock.MongoClient().florence.counters
+
+
+def test_numbers_are_handed_out_from_reserved_blocks(counters):
+    sequence = BlockSequence(counters, 'sl_no', block_size=10, initial_value=lambda: 100000)
+
+    assert [sequence.next() for _ in range(3)] == [100000, 100001, 100002]
+    assert counters.find_one({'_id': 'sl_no'})['next'] == 100010
+
+    # Another process gets the next block, this one keeps handing out its own
+    other = BlockSequence(counters, 'sl_no', block_size=10, initial_value=lambda: 100000)
+    assert other.next() == 100010
+    assert sequence.next() == 100003
+    assert [sequence.next() for _ in range(7)][-1] == 100020
+
+
+def test_concurrent_processes_never_share_a_number(counters):
+    sequences = [BlockSequence(counters, 'sl_no', block_size=7, initial_value=lambda: 100000) for _ in range(4)]
+    numbers = []
+    lock = threading.Lock()
+
+    def draw(sequence):
+        drawn = [sequence.next() for _ in range(200)]
+        with lock:
+            numbers.extend(drawn)
+
+    threads = [threading.Thread(target=draw, args=(sequence,)) for sequence in sequences for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(numbers) == len(set(numbers)) == 1600
+    assert min(numbers) == 100000
+
+
+def test_taken_numbers_are_skipped(counters):
+    taken = {100001, 100002, 100005, 100006, 100007, 100008, 100009}
+    sequence = BlockSequence(counters, 'sl_no', block_size=5, initial_value=lambda: 100000,
+                             taken=lambda first, limit: [number for number in taken if first <= number < limit])
+
+    assert [sequence.next() for _ in range(4)] == [100000, 100003, 100004, 100010]
+
+
+def test_sequence_stops_at_max_value(counters):
+    sequence = BlockSequence(counters, 'sl_no', block_size=4, initial_value=lambda: 999995, max_value=999999)
+
+    assert [sequence.next() for _ in range(5)] == [999995, 999996, 999997, 999998, 999999]
+    with pytest.raises(SequenceExhausted):
+        sequence.next()
+
+
+# Random 6-digit Sl.No. of orders submitted before the sequence are not given again
+def test_submit_order_skips_existing_sl_nos(app_module, client):
+    app_module.orders_collection.insert_many([
+        make_order('0000000001', sl_no=100000), make_order('0000000002', sl_no=100001), make_order('0000000003', sl_no=999999),
+    ])
+    sl_nos = [client.post('/submit_order', json=make_order(f'00000001{number:02d}')).get_json()['sl_no'] for number in range(3)]
+    assert sl_nos[0] >= 100002
+    assert len(set(sl_nos)) == 3
+    assert all(100000 <= sl_no <= 999999 for sl_no in sl_nos)
+
+
+def test_submit_order_fails_once_the_sl_nos_are_used_up(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, 'sl_no_sequence', BlockSequence(
+        app_module.counters_collection, 'sl_no', initial_value=lambda: 1000000, max_value=999999))
+    response = client.post('/submit_order', json=make_order())
+    assert (response.status_code, response.get_json()['message']) == (503, 'No Sl.No. left for new orders!')
+    assert app_module.orders_collection.count_documents({}) == 0
@@ -0,0 +1,119 @@
+# Verified token cache: LRU and TTL eviction, tokens past their exp, invalidation
+
+import time
+import types
+
+import jwt
+import pytest
+
+import token_cache as token_cache_module
+from token_cache import TokenCache
+
+SECRET_KEY = 'test-secret'
+
+
+# time.time as seen by the cache, moved forward by the tests (jwt.decode keeps the real clock)
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(token_cache_module, 'time', types.SimpleNamespace(time=clock, perf_counter=time.perf_counter))
+    return clock
+
+
+def make_token(username, **claims):
+    return jwt.encode({'username': username, **claims}, SECRET_KEY, algorithm='HS256')
+
+
+def test_verified_token_is_answered_from_the_cache(clock):
+    cache = TokenCache(SECRET_KEY)
+    token = make_token('alice')
+
+    assert cache.verify(token)['username'] == 'alice'
+    assert cache.verify(token)['username'] == 'alice'
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['verifications'], stats['size']) == (1, 1, 1, 1)
+
+
+def test_least_recently_used_token_is_evicted(clock):
+    cache = TokenCache(SECRET_KEY, max_size=2)
+    alice, bob, carol = make_token('alice'), make_token('bob'), make_token('carol')
+
+    cache.verify(alice)
+    cache.verify(bob)
+    cache.verify(alice)
+    cache.verify(carol)
+
+    assert cache.stats()['evictions'] == 1
+    verifications = cache.stats()['verifications']
+    cache.verify(alice)
+    cache.verify(carol)
+    assert cache.stats()['verifications'] == verifications
+    cache.verify(bob)
+    assert cache.stats()['verifications'] == verifications + 1
+
+
+def test_token_is_verified_again_after_the_ttl(clock):
+    cache = TokenCache(SECRET_KEY, ttl=300)
+    token = make_token('alice')
+
+    cache.verify(token)
+    clock.now += 299
+    cache.verify(token)
+    assert cache.stats()['verifications'] == 1
+    clock.now += 2
+    cache.verify(token)
+    assert cache.stats()['verifications'] == 2
+
+
+# A cached token is never answered past its exp, even within the TTL
+def test_token_is_not_kept_past_its_exp(clock):
+    cache = TokenCache(SECRET_KEY, ttl=300)
+    token = make_token('alice', exp=int(clock.now) + 60)
+
+    cache.verify(token)
+    clock.now += 59
+    cache.verify(token)
+    assert cache.stats()['verifications'] == 1
+    clock.now += 2
+    cache.verify(token)
+    assert cache.stats()['verifications'] == 2
+
+
+def test_refused_tokens_are_not_cached(clock):
+    cache = TokenCache(SECRET_KEY)
+    forged = jwt.encode({'username': 'mallory'}, 'another-secret', algorithm='HS256')
+
+    for _ in range(2):
+        with pytest.raises(jwt.InvalidTokenError):
+            cache.verify(forged)
+    stats = cache.stats()
+    assert (stats['misses'], stats['verifications'], stats['size']) == (2, 2, 0)
+
+
+def test_clear_invalidates_every_token(clock):
+    cache = TokenCache(SECRET_KEY)
+    token = make_token('alice')
+    cache.verify(token)
+
+    cache.clear()
+    assert cache.stats()['size'] == 0
+    cache.verify(token)
+    assert cache.stats()['verifications'] == 2
+
+
+def test_routes_refuse_expired_and_forged_tokens(app_module, client, token):
+    expired = jwt.encode({'username': 'tester', 'exp': 1}, app_module.app.config['SECRET_KEY'], algorithm='HS256')
+    forged = jwt.encode({'username': 'tester'}, 'another-secret', algorithm='HS256')
+
+    for user_token, message in [(expired, 'Token has expired!'), (forged, 'Invalid token!')]:
+        response = client.post('/charge', json={'barcode_number': '0000054321080001'}, headers={'Authorization': user_token})
+        assert (response.status_code, response.get_json()['message']) == (401, message)
+    assert client.post('/charge', json={'barcode_number': '0000099999080001'}, headers={'Authorization': token}).status_code == 404
@@ -0,0 +1,61 @@
+# /view/<orderNumber>: the barcodes of an order streamed as JSON, NDJSON or CSV, optionally gzipped
+
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+SIZES_QUANTITIES = [{'size': '8', 'quantity': 12}, {'size': '9', 'quantity': 8}]
+
+
+@pytest.fixture
+def barcode_numbers(labelled_order):
+    return labelled_order(sizes_quantities=SIZES_QUANTITIES)
+
+
+def rows(barcode_numbers):
+    return [{'barcode_number': barcode_number, 'shoe_size': '8' if index < 12 else '9'}
+            for index, barcode_number in enumerate(barcode_numbers)]
+
+
+def test_view_formats(client, barcode_numbers):
+    expected = rows(barcode_numbers)
+    assert len(expected) == 20
+
+    response = client.get('/view/0000054321')
+    assert response.mimetype == 'application/json'
+    assert json.loads(response.data) == expected
+
+    response = client.get('/view/0000054321?format=ndjson')
+    assert response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line) for line in response.data.splitlines()] == expected
+
+    response = client.get('/view/0000054321?format=csv')
+    assert response.mimetype == 'text/csv'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=barcodes_0000054321.csv'
+    assert list(csv.DictReader(io.StringIO(response.data.decode()))) == expected
+
+
+def test_view_negotiates_format_and_compression(client, barcode_numbers):
+    response = client.get('/view/0000054321', headers={'Accept': 'text/csv', 'Accept-Encoding': 'gzip'})
+    assert response.mimetype == 'text/csv'
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert list(csv.DictReader(io.StringIO(gzip.decompress(response.data).decode()))) == rows(barcode_numbers)
+
+
+def test_view_refuses_unknown_format_and_order(client, barcode_numbers):
+    assert client.get('/view/0000054321?format=xml').status_code == 400
+    assert client.get('/view/0000099999').status_code == 404
+
+
+
+# The export is streamed a cursor batch at a time, the rows do not depend on the batch size
+@pytest.mark.parametrize('export_format', ['json', 'ndjson', 'csv'])
+def test_view_is_the_same_in_small_batches(app_module, client, barcode_numbers, monkeypatch, export_format):
+    whole = client.get(f'/view/0000054321?format={export_format}').data
+    monkeypatch.setitem(app_module.app.config, 'VIEW_BATCH_SIZE', 3)
+    response = client.get(f'/view/0000054321?format={export_format}')
+    assert response.is_streamed
+    assert response.data == whole
@@ -0,0 +1,134 @@
+# Live WIP board: counts per stage, transitions pushed to subscribers, polling and the SSE stream
+
+import json
+
+import pytest
+
+from conftest import scan
+from wip_board import WipBoard
+
+
+# A board over stages kept in a dict, standing for the stage records
+def make_board(stages, max_pending=1000):
+    return WipBoard(lambda order_number: dict(stages.get(order_number, {})), max_pending=max_pending)
+
+
+def test_counts_and_transitions():
+    stages = {'0000000001': {'a': 0, 'b': 0, 'c': 2}}
+    board = make_board(stages)
+    assert board.snapshot('0000000001') == {'charge': 2, 'stage1': 0, 'stage2': 1, 'stage3': 0, 'stage4': 0, 'stage5': 0, 'stage6': 0}
+
+    subscriber = board.subscribe('0000000001')
+    board.advance('0000000001', 'a', 1)
+    board.advance('0000000001', 'a', 1)       # reported twice (scan route and change stream)
+    board.advance('0000000001', 'c', 1)       # behind where the barcode is
+    board.advance('0000000002', 'x', 0)       # order nobody watches
+
+    event = subscriber.events.get_nowait()
+    assert (event['barcode_number'], event['stage']) == ('a', 'stage1')
+    assert event['counts']['charge'] == 1 and event['counts']['stage1'] == 1
+    assert subscriber.events.empty()
+    assert board.watched() == ['0000000001']
+
+    board.unsubscribe(subscriber)
+    assert board.watched() == []
+
+
+def test_refresh_reports_transitions_written_elsewhere():
+    stages = {'0000000001': {'a': 0}}
+    board = make_board(stages)
+    subscriber = board.subscribe('0000000001')
+
+    stages['0000000001'] = {'a': 1, 'b': 0}
+    board.refresh('0000000001')
+    events = [subscriber.events.get_nowait() for _ in range(2)]
+    assert sorted((event['barcode_number'], event['stage']) for event in events) == [('a', 'stage1'), ('b', 'charge')]
+    assert board.snapshot('0000000001')['charge'] == 1
+
+
+def test_subscriber_that_falls_behind_is_resynced():
+    board = make_board({'0000000001': {}}, max_pending=2)
+    subscriber = board.subscribe('0000000001')
+    for barcode_number in 'abc':
+        board.advance('0000000001', barcode_number, 0)
+
+    assert subscriber.resync
+    assert subscriber.events.qsize() == 2
+    assert board.snapshot('0000000001')['charge'] == 3
+
+
+# Server-sent events as (event, data) pairs, reading chunks of the stream one at a time
+def read_events(chunks, count):
+    events = []
+    while len(events) < count:
+        chunk = next(chunks)
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        if chunk.startswith(':'):
+            continue
+        lines = dict(line.split(': ', 1) for line in chunk.strip().splitlines())
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+@pytest.fixture
+def wip_config(app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'WIP_HEARTBEAT_SECONDS', 0.05)
+    monkeypatch.setitem(app_module.app.config, 'WIP_POLL_SECONDS', 0)
+    return app_module.app.config
+
+
+def test_events_stream_snapshot_then_transitions(wip_config, client, token, labelled_order):
+    barcode_numbers = labelled_order()
+    scan(client, token, 'charge', barcode_numbers[0])
+
+    response = client.get('/wip/0000054321/events', buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    chunks = iter(response.response)
+    assert read_events(chunks, 1) == [('snapshot', {'order_number': '0000054321', 'counts': {
+        'charge': 1, 'stage1': 0, 'stage2': 0, 'stage3': 0, 'stage4': 0, 'stage5': 0, 'stage6': 0}})]
+
+    scan(client, token, 'stage1', barcode_numbers[0])
+    scan(client, token, 'charge', barcode_numbers[1])
+    (_, first), (_, second) = read_events(chunks, 2)
+    assert (first['barcode_number'], first['stage'], first['counts']['stage1']) == (barcode_numbers[0], 'stage1', 1)
+    assert (second['barcode_number'], second['stage'], second['counts']['charge']) == (barcode_numbers[1], 'charge', 1)
+    response.close()
+
+
+def test_streams_past_the_cap_are_refused(app_module, wip_config, client, monkeypatch):
+    monkeypatch.setitem(wip_config, 'WIP_MAX_STREAMS', 1)
+    first = client.get('/wip/0000054321/events', buffered=False)
+    assert first.status_code == 200
+
+    refused = client.get('/wip/0000054321/events', buffered=False)
+    assert refused.status_code == 503
+    assert refused.headers['Retry-After'] == '30'
+
+    # The slot is given back when the stream is closed, even if it was never read
+    first.close()
+    second = client.get('/wip/0000054321/events', buffered=False)
+    assert second.status_code == 200
+    second.close()
+    assert app_module.wip_streams == 0
+
+
+# Without a change stream, a scan served by another worker reaches the board through polling
+def test_scans_of_other_workers_are_polled(app_module, wip_config, client, token, labelled_order, monkeypatch):
+    barcode_number = labelled_order()[0]
+    monkeypatch.setitem(wip_config, 'WIP_POLL_SECONDS', 0.05)
+    monkeypatch.setattr(app_module, 'wip_feed_stop', None)
+
+    response = client.get('/wip/0000054321/events', buffered=False)
+    chunks = iter(response.response)
+    try:
+        assert read_events(chunks, 1)[0][1]['counts']['charge'] == 0
+        # Written as another process would, without reporting it to this board
+        with monkeypatch.context() as patched:
+            patched.setattr(app_module.wip_board, 'advance', lambda *args: None)
+            scan(client, token, 'charge', barcode_number)
+        event, data = read_events(chunks, 1)[0]
+        assert (event, data['barcode_number'], data['counts']['charge']) == ('transition', barcode_number, 1)
+    finally:
+        response.close()
+        app_module.wip_feed_stop.set()
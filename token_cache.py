@@ -0,0 +1,89 @@
+# Verified token cache
+#
+# Scanners send the same session token with every scan, so verifying its
+# signature on each request repeats the same work thousands of times an hour.
+# A verified token's claims are kept here, keyed by a SHA-256 of the token,
+# until the token's exp (or the cache TTL, whichever comes first), and later
+# requests with the same token skip jwt.decode. Only tokens that verified are
+# cached: a bad or expired token is decoded, and refused, every time.
+#
+# The counters show how often the cache answers and what a verification costs.
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+
+class TokenCache:
+    def __init__(self, secret_key, algorithms=('HS256',), max_size=1024, ttl=300):
+        self.secret_key = secret_key
+        self.algorithms = list(algorithms)
+        self.max_size = max_size
+        self.ttl = ttl
+        # token hash -> (claims, expires_at), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.verifications = 0
+        self.verify_seconds = 0.0
+
+    # Claims of a token, raises jwt.ExpiredSignatureError / jwt.InvalidTokenError like jwt.decode
+    def verify(self, token):
+        key = hashlib.sha256(token.encode()).digest()
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now < entry[1]:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+
+        started = time.perf_counter()
+        try:
+            claims = jwt.decode(token, self.secret_key, algorithms=self.algorithms)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.verifications += 1
+                self.verify_seconds += elapsed
+
+        expires_at = now + self.ttl
+        if 'exp' in claims:
+            expires_at = min(expires_at, claims['exp'])
+
+        with self.lock:
+            self.entries[key] = (claims, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return claims
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'verifications': self.verifications,
+                'verify_seconds': self.verify_seconds,
+                'mean_verify_ms': 1000 * self.verify_seconds / self.verifications if self.verifications else 0.0
+            }
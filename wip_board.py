@@ -0,0 +1,191 @@
+# Live work-in-progress board
+#
+# Supervisors watch how many pairs of an order sit at each stage. Instead of
+# polling /report (a scan of the order's records per poll), a board keeps,
+# for every order someone is watching, the current stage of each of its
+# barcodes in memory. The scan routes report each transition they write with
+# advance(), which updates the counts and pushes the event to the order's
+# subscribers. The records are read once, when the first subscriber of an
+# order arrives, and the order is forgotten when its last subscriber leaves.
+#
+# advance() only ever moves a barcode forward, so the same transition can be
+# reported more than once. That lets a MongoDB change stream (watch_changes)
+# feed the board with the transitions written by every process of the
+# deployment, on top of the ones written locally, when the database is a
+# replica set. Without a change stream (a single node), poll_changes reads the
+# stages of the watched orders again every few seconds instead: a process only
+# learns of the scans served by the other workers through those reads.
+
+import queue
+import threading
+import traceback
+
+from pymongo.errors import PyMongoError
+
+from stages import STAGES
+
+
+class Subscriber:
+    def __init__(self, order_number, max_pending):
+        self.order_number = order_number
+        self.events = queue.Queue(maxsize=max_pending)
+        # Set when events were dropped because the client fell behind, it then gets a fresh snapshot
+        self.resync = False
+
+
+class WipBoard:
+    # load_stages(order_number) -> {barcode_number: current stage number} of an order's barcodes
+    def __init__(self, load_stages, max_pending=1000):
+        self.load_stages = load_stages
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        # order_number -> {'stages': {barcode_number: stage} or None while loading, 'counts': [per stage],
+        #                  'pending': transitions reported while loading, 'loaded': Event, 'subscribers': set}
+        self._orders = {}
+
+    def _counts(self, order):
+        return {stage.name: count for stage, count in zip(STAGES, order['counts'])}
+
+    # Move a barcode forward, returns False if it already is at or past the stage
+    def _move(self, order, barcode_number, stage):
+        current = order['stages'].get(barcode_number)
+        if current is not None and current >= stage:
+            return False
+        order['stages'][barcode_number] = stage
+        if current is not None:
+            order['counts'][current] -= 1
+        order['counts'][stage] += 1
+        return True
+
+    # Current counts of an order: {'charge': n, 'stage1': n, ...}
+    def snapshot(self, order_number):
+        with self._lock:
+            order = self._orders.get(order_number)
+            if order and order['stages'] is not None:
+                return self._counts(order)
+        counts = [0] * len(STAGES)
+        for stage in self.load_stages(order_number).values():
+            counts[stage] += 1
+        return {stage.name: count for stage, count in zip(STAGES, counts)}
+
+    def subscribe(self, order_number):
+        subscriber = Subscriber(order_number, self.max_pending)
+        with self._lock:
+            order = self._orders.get(order_number)
+            loading = order is None
+            if loading:
+                order = self._orders[order_number] = {
+                    'stages': None, 'counts': [0] * len(STAGES), 'pending': [],
+                    'loaded': threading.Event(), 'subscribers': set()
+                }
+            order['subscribers'].add(subscriber)
+
+        if not loading:
+            order['loaded'].wait()
+            if order['stages'] is None:
+                raise RuntimeError(f'Could not load the stages of order {order_number}')
+            return subscriber
+
+        # Transitions reported while the records are read are kept in pending and applied after them
+        try:
+            stages = self.load_stages(order_number)
+        except Exception:
+            with self._lock:
+                self._orders.pop(order_number, None)
+            order['loaded'].set()
+            raise
+        with self._lock:
+            order['stages'] = {}
+            for barcode_number, stage in stages.items():
+                self._move(order, barcode_number, stage)
+            for barcode_number, stage in order.pop('pending'):
+                self._move(order, barcode_number, stage)
+        order['loaded'].set()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            order = self._orders.get(subscriber.order_number)
+            if order:
+                order['subscribers'].discard(subscriber)
+                if not order['subscribers']:
+                    del self._orders[subscriber.order_number]
+
+    # Record that a barcode of an order reached a stage, ignored if the order is not watched
+    # or the barcode is already at or past that stage
+    def advance(self, order_number, barcode_number, stage):
+        with self._lock:
+            self._advance(order_number, barcode_number, stage)
+
+    def _advance(self, order_number, barcode_number, stage):
+        order = self._orders.get(order_number)
+        if not order:
+            return
+        if order['stages'] is None:
+            order['pending'].append((barcode_number, stage))
+            return
+        if not self._move(order, barcode_number, stage):
+            return
+
+        event = {
+            'order_number': order_number,
+            'barcode_number': barcode_number,
+            'stage': STAGES[stage].name,
+            'counts': self._counts(order)
+        }
+        for subscriber in order['subscribers']:
+            try:
+                subscriber.events.put_nowait(event)
+            except queue.Full:
+                subscriber.resync = True
+
+    # Order numbers that have subscribers
+    def watched(self):
+        with self._lock:
+            return list(self._orders)
+
+    # Read the stages of a watched order again, reporting the transitions written by other processes
+    def refresh(self, order_number):
+        stages = self.load_stages(order_number)
+        with self._lock:
+            for barcode_number, stage in stages.items():
+                self._advance(order_number, barcode_number, stage)
+
+
+# Feed a board by reading the stages of its watched orders every interval seconds, until stop is set
+def poll_changes(board, stop, interval):
+    while not stop.wait(interval):
+        for order_number in board.watched():
+            try:
+                board.refresh(order_number)
+            except PyMongoError:
+                traceback.print_exc()
+
+
+# Feed a board from a change stream on the stage collections (or on barcode_progress), until stop is set
+#   stage_numbers: {collection name: stage number} of the charge and stage collections
+def watch_changes(db, board, stage_numbers, progress_collection, stop, retry_after=5):
+    pipeline = [{'$match': {
+        'operationType': {'$in': ['insert', 'update', 'replace']},
+        'ns.coll': {'$in': list(stage_numbers) + [progress_collection]}
+    }}]
+    while not stop.is_set():
+        try:
+            with db.watch(pipeline, full_document='updateLookup', max_await_time_ms=1000) as stream:
+                while not stop.is_set():
+                    change = stream.try_next()
+                    if change is None:
+                        continue
+                    document = change.get('fullDocument')
+                    if not document:
+                        continue
+                    collection = change['ns']['coll']
+                    if collection == progress_collection:
+                        stage = document['current_stage']
+                    else:
+                        stage = stage_numbers[collection]
+                    board.advance(document['order_number'], document['barcode_number'], stage)
+        except PyMongoError:
+            # Typically a standalone server, which has no change streams
+            traceback.print_exc()
+            stop.wait(retry_after)